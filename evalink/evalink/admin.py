@@ -60,6 +60,11 @@ class APRSPositionAdmin(admin.ModelAdmin):
     list_filter = ('updated_at',)
     search_fields = ('callsign', 'comment')
 
+class DeadLetterAdmin(admin.ModelAdmin):
+    list_display = ('id', 'topic', 'attempts', 'error', 'created_at', 'updated_at')
+    list_filter = ('created_at',)
+    search_fields = ('topic', 'error')
+
 admin.site.register(Hardware, HardwareAdmin)
 admin.site.register(Station, StationAdmin)
 admin.site.register(StationProfile, StationProfileAdmin)
@@ -80,3 +85,4 @@ admin.site.register(Geofence, GeofenceAdmin)
 admin.site.register(Aircraft, AircraftAdmin)
 admin.site.register(AircraftPositionLog, AircraftPositionLogAdmin)
 admin.site.register(APRSPosition, APRSPositionAdmin)
+admin.site.register(DeadLetter, DeadLetterAdmin)
@@ -0,0 +1,94 @@
+"""
+Retry and dead-letter store for MQTT messages the handler failed on.
+
+mqtt.on_message hands a failed message to `retrier` and returns at once, so a
+bad payload or a short database outage never stalls the paho network thread.
+A daemon thread retries it after DEAD_LETTER_BACKOFF_MS, doubling each time,
+up to DEAD_LETTER_RETRIES attempts, then stores it as a DeadLetter row for
+`manage.py replay_dead_letters`. While the ingest queue runs, a retry is handed
+back to it (ingest_queue sets `resubmit`) so it is handled on its node's worker
+thread; otherwise this thread handles it.
+"""
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from django.conf import settings
+
+from evalink import handler, pipeline
+from evalink.models import DeadLetter
+
+# longest wait between attempts is backoff * 2 ** MAX_DOUBLINGS
+MAX_DOUBLINGS = 6
+
+
+def store(topic, payload, error, attempts):
+    return DeadLetter.objects.create(topic=topic, payload=payload, error=str(error), attempts=attempts)
+
+
+class Retrier:
+    def __init__(self, retries, backoff_ms):
+        self.retries = retries
+        self.backoff = backoff_ms / 1000.0
+        self.condition = threading.Condition()
+        # heap of (due, sequence, topic, payload, attempts, error)
+        self.pending = []
+        self.sequence = itertools.count()
+        self.thread = None
+        # resubmit(topic, payload, attempts) -> bool, see IngestQueue.resubmit
+        self.resubmit = None
+
+    def push(self, topic, payload, error, attempts=1):
+        """Schedule a message that failed `attempts` times; pass attempts=retries to store it without retrying."""
+        with self.condition:
+            self._schedule(topic, payload, attempts, error)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='ingest-retry', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def stats(self):
+        """Messages waiting for a retry or to be stored."""
+        with self.condition:
+            return {'pending': len(self.pending)}
+
+    def _schedule(self, topic, payload, attempts, error, delay=None):
+        if delay is None:
+            delay = 0 if attempts >= self.retries else self.backoff * 2 ** min(attempts - 1, MAX_DOUBLINGS)
+        heapq.heappush(self.pending, (time.monotonic() + delay, next(self.sequence), topic, payload, attempts, error))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending or self.pending[0][0] > time.monotonic():
+                    self.condition.wait(self.pending[0][0] - time.monotonic() if self.pending else None)
+                _, _, topic, payload, attempts, error = heapq.heappop(self.pending)
+            self.retry(topic, payload, attempts, error)
+
+    def retry(self, topic, payload, attempts, error):
+        """Run one scheduled attempt: handle the message again, or store it once retries are used up."""
+        try:
+            if attempts >= self.retries:
+                store(topic, payload, error, attempts)
+                return
+            if self.resubmit is not None and self.resubmit(topic, payload, attempts):
+                return
+            handler.dispatch(topic, payload, attempts)
+        except Exception as failure:
+            pipeline.recover_connection()
+            with self.condition:
+                if attempts >= self.retries:
+                    # the database itself is unreachable; keep it in memory and try again later
+                    print(f'dead letter for {topic} could not be stored: {failure}')
+                    self._schedule(topic, payload, attempts, error, delay=max(1.0, self.backoff * 2 ** MAX_DOUBLINGS))
+                else:
+                    print(f'retry {attempts} of {topic} failed: {failure} {traceback.print_tb(failure.__traceback__)}')
+                    self._schedule(topic, payload, attempts + 1, failure)
+
+
+retrier = Retrier(
+    getattr(settings, 'DEAD_LETTER_RETRIES', 5),
+    getattr(settings, 'DEAD_LETTER_BACKOFF_MS', 1000),
+)
@@ -0,0 +1,74 @@
+"""
+Drop mesh packets that already came in through another gateway.
+
+Every gateway that hears a packet republishes it under its own topic, so the
+same (from, id, type) arrives once per gateway. handler.dispatch checks
+`recent` before processing and records a packet once it was handled, keeping
+the last INGEST_DEDUP_SIZE packets for up to INGEST_DEDUP_SECONDS. A packet
+whose first copy failed is not recorded, so its retry or another gateway's
+copy still gets processed. Retries skip the check: a message whose write-behind
+flush failed was recorded before the flush ran.
+"""
+import collections
+import threading
+import time
+
+from django.conf import settings
+
+
+class RecentMessages:
+    def __init__(self, size, seconds):
+        self.size = max(1, size)
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        # key -> monotonic time it was recorded, oldest first
+        self.keys = collections.OrderedDict()
+        self.duplicates = collections.Counter()
+        self.accepted = collections.Counter()
+
+    def seen(self, key, gateway):
+        """True if the packet was already handled recently; counts the drop against its gateway."""
+        with self.lock:
+            recorded = self.keys.get(key)
+            if recorded is not None and time.monotonic() - recorded < self.seconds:
+                self.duplicates[gateway] += 1
+                return True
+            return False
+
+    def add(self, key, gateway):
+        now = time.monotonic()
+        with self.lock:
+            self.accepted[gateway] += 1
+            self.keys[key] = now
+            self.keys.move_to_end(key)
+            while self.keys:
+                oldest, recorded = next(iter(self.keys.items()))
+                if len(self.keys) <= self.size and now - recorded < self.seconds:
+                    break
+                del self.keys[oldest]
+
+    def stats(self):
+        """{gateway: {'accepted': n, 'duplicates': n}}"""
+        with self.lock:
+            return {
+                gateway: {'accepted': self.accepted[gateway], 'duplicates': self.duplicates[gateway]}
+                for gateway in sorted(set(self.accepted) | set(self.duplicates))
+            }
+
+
+def key(message):
+    """(from, id, type) of a mesh message, or None if it has no packet id."""
+    if message.get('id') is None:
+        return None
+    return message['from'], message['id'], message['type']
+
+
+def gateway(topic, message):
+    """The node that bridged the packet to MQTT: the JSON "sender", else the topic's last segment."""
+    return message.get('sender') or topic.rstrip('/').rsplit('/', 1)[-1]
+
+
+recent = RecentMessages(
+    getattr(settings, 'INGEST_DEDUP_SIZE', 10000),
+    getattr(settings, 'INGEST_DEDUP_SECONDS', 600),
+)
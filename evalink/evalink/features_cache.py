@@ -0,0 +1,137 @@
+"""
+Pre-serialized /features.json responses, shared by every client polling the map.
+
+A response is cached per campus and permission level under the current
+stamp: the features version plus the newest Station.updated_at. The version is
+bumped when a pipeline flush writes stations and by post_save/post_delete of
+the rows the map shows; the timestamp catches stations written by another
+process (run_mqtt_ingest, another web worker). So a change is picked up on the
+next poll and N clients cost one build per change. Entries also expire after
+FEATURES_CACHE_SECONDS because ages and planner positions move with the clock.
+
+Every build gets a `version` token, a hash of its features without their ages.
+`?since=<token>` returns only the features that changed since that build plus
+the ids of removed ones, diffed against a per-token digest kept for
+FEATURES_DELTA_SECONDS; an unknown or expired token gets the full collection.
+
+The features.json ETag is the stamp plus planner_position(). Ages are left
+out of it, since clients recompute them, so an unchanged map gets a 304 however
+long it polls; the planner, whose position moves with the clock, changes the
+tag only when it moves.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils import timezone
+from django.db.models.signals import post_save, post_delete
+
+from evalink.models import Campus, Geofence, Station, TextLog, PositionLog
+
+VERSION_KEY = 'features-version'
+# change with the clock, not with the station; clients recompute them from updated_at and now
+AGE_PROPERTIES = ('days_old', 'hours_old')
+
+
+def version():
+    """The current features version; changes whenever a station the map shows may have changed."""
+    current = cache.get(VERSION_KEY)
+    if current is None:
+        cache.add(VERSION_KEY, 0, None)
+        current = cache.get(VERSION_KEY, 0)
+    return current
+
+
+def bump(**kwargs):
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+
+
+def stamp():
+    """The features version and the newest station write; one indexed query."""
+    latest = Station.objects.aggregate(latest=Max('updated_at'))['latest']
+    return f'{version()}:{latest.timestamp() if latest else 0}'
+
+
+def planner_position():
+    """
+    Where the planner is drawn: the ids of its planned points around now, or
+    while it moves between two different points the interpolated spot rounded
+    to about a metre, as build_features places it. One query; it only changes
+    when the planner's position on the map does.
+    """
+    now = timezone.now()
+    planned = PositionLog.objects.filter(station__station_type='planner', timestamp__isnull=False) \
+        .values_list('id', 'timestamp', 'latitude', 'longitude')
+    around = sorted(
+        planned.filter(timestamp__lte=now).order_by('-timestamp')[:1].union(planned.filter(timestamp__gt=now).order_by('timestamp')[:1]),
+        key=lambda log: log[1],
+    )
+    if len(around) == 2 and around[0][2:] != around[1][2:]:
+        (_, start, latitude1, longitude1), (_, end, latitude2, longitude2) = around
+        factor = (now - start) / (end - start)
+        return round(latitude1 + (latitude2 - latitude1) * factor, 5), round(longitude1 + (longitude2 - longitude1) * factor, 5)
+    return tuple(log[0] for log in around)
+
+
+def get(campus_name, level, build):
+    """Return the cached features.json bytes for a campus and level, building the collection with build() on a miss."""
+    return current(campus_name, level, build)['content']
+
+
+def delta(campus_name, level, since, build):
+    """Return features.json bytes holding only what changed since the build with version token `since`."""
+    entry = current(campus_name, level, build)
+    if since == entry['version']:
+        changed, removed = [], []
+    else:
+        baseline = cache.get(_digests_key(campus_name, level, since))
+        if baseline is None:
+            return entry['content']
+        changed = [feature for station_id, (digest, feature) in entry['features'].items() if baseline.get(station_id) != digest]
+        removed = [station_id for station_id in baseline if station_id not in entry['features']]
+    return _dumps({
+        'type': 'FeatureCollection',
+        'features': changed,
+        'removed': removed,
+        'since': since,
+        'version': entry['version'],
+        'now': entry['now'],
+    })
+
+
+def current(campus_name, level, build):
+    """The cache entry for the current stamp: version token, build time, per-station digests and the response bytes."""
+    key = f'features:{campus_name}:{level}:{stamp()}'
+    entry = cache.get(key)
+    if entry is None:
+        data = build()
+        features = {}
+        for feature in data['features']:
+            properties = {name: value for name, value in feature['properties'].items() if name not in AGE_PROPERTIES}
+            comparable = json.dumps({**feature, 'properties': properties}, sort_keys=True, default=str)
+            features[str(feature['properties']['id'])] = (hashlib.sha1(comparable.encode()).hexdigest(), feature)
+        data['version'] = hashlib.sha1(''.join(f'{station_id}:{digest}' for station_id, (digest, _) in sorted(features.items())).encode()).hexdigest()[:16]
+        entry = {'version': data['version'], 'now': data.get('now'), 'features': features, 'content': _dumps(data)}
+        cache.set(key, entry, getattr(settings, 'FEATURES_CACHE_SECONDS', 10))
+        cache.set(_digests_key(campus_name, level, data['version']),
+                  {station_id: digest for station_id, (digest, _) in features.items()},
+                  getattr(settings, 'FEATURES_DELTA_SECONDS', 600))
+    return entry
+
+
+def _digests_key(campus_name, level, token):
+    return f'features-digests:{campus_name}:{level}:{token}'
+
+
+def _dumps(data):
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+for model in (Campus, Geofence, Station, TextLog, PositionLog):
+    post_save.connect(bump, sender=model, dispatch_uid=f'features_cache_save_{model.__name__}')
+    post_delete.connect(bump, sender=model, dispatch_uid=f'features_cache_delete_{model.__name__}')
@@ -2,49 +2,96 @@ import django
 django.setup()
 
 from evalink.models import *
-from django.db import IntegrityError
+from evalink import pipeline, ingest_cache, dedup, track_filter, metrics
 from datetime import datetime, timezone, timedelta
 from django.utils import timezone as django_timezone
-import pytz
+from django.conf import settings
 import os
+import copy
+import json
+import time
 
-def process_message(message):
+# fields every mesh message must carry; anything else on the topic is ignored
+REQUIRED_FIELDS = ('type', 'payload', 'timestamp', 'from')
+
+def topic_roots():
+    """MQTT_TOPIC plus the topic roots of other campuses in INGEST_CAMPUS_ROUTES."""
+    roots = [os.getenv('MQTT_TOPIC')] + [key for key in getattr(settings, 'INGEST_CAMPUS_ROUTES', {}) if not key.startswith('!')]
+    return list(dict.fromkeys(root for root in roots if root))
+
+def campus_name(topic, message=None):
+    """Campus for a message: by its gateway, else by the longest topic root it is under, else CAMPUS."""
+    routes = getattr(settings, 'INGEST_CAMPUS_ROUTES', {})
+    if message is not None and routes.get(dedup.gateway(topic, message)):
+        return routes[dedup.gateway(topic, message)]
+    for root in sorted(routes, key=len, reverse=True):
+        if not root.startswith('!') and topic.startswith(f'{root}/'):
+            return routes[root]
+    return os.getenv('CAMPUS')
+
+def dispatch(topic, payload, attempts=0):
+    """
+    Route one raw MQTT message to process_aircraft or process_message; raises if handling fails.
+    `attempts` counts earlier failures, so a retried message that fails again in a flush is not retried forever.
+    """
+    started = time.perf_counter()
+    message_type, gateway, outcome = 'unknown', topic.split('/')[0], metrics.ERROR
+    try:
+        for root in topic_roots():
+            if topic.startswith(f'{root}/aircraft/'):
+                message = json.loads(payload)
+                message_type = 'remoteid' if isinstance(message, dict) and 'ID' in message else 'adsb'
+                outcome = process_aircraft(topic.split('/')[-1], message, campus_name(topic)) or metrics.STORED
+                return
+        message = json.loads(payload)
+        if not all(field in message for field in REQUIRED_FIELDS):
+            outcome = metrics.IGNORED
+            return
+        message_type = str(message['type'])
+        # the same packet arrives once per gateway that heard it; a retry may have been recorded by its failed flush
+        key, gateway = dedup.key(message), dedup.gateway(topic, message)
+        if key is not None and not attempts and dedup.recent.seen(key, gateway):
+            outcome = metrics.DUPLICATE
+            return
+        with pipeline.writer.receiving(topic, payload, attempts):
+            outcome = process_message(message, campus_name(topic, message), retried=bool(attempts)) or metrics.STORED
+        if key is not None:
+            dedup.recent.add(key, gateway)
+    finally:
+        metrics.registry.observe(message_type, gateway, outcome, time.perf_counter() - started)
+
+def process_message(message, campus_name=None, retried=False):
+    """
+    Apply one mesh message to its station and queue the rows; returns a metrics outcome when nothing is stored.
+    A retried message is applied again even if its row was queued before: the station it changed was never written.
+    """
     number = message['from']
     payload = message['payload']
-    campus = Campus.objects.get(name=os.getenv('CAMPUS'))
-    tz = pytz.timezone(campus.time_zone)
+    campus, tz = ingest_cache.campus(campus_name or os.getenv('CAMPUS'))
     current_time = datetime.now(timezone.utc)
     today = datetime.now(tz).date()
-    station = Station.objects.filter(hardware_number=number).first()
+    station = pipeline.writer.station(number) or ingest_cache.station(number)
 
     if message['type'] == 'nodeinfo':
         # print(message)
         if station == None:
-            station_profile = StationProfile.objects.first()
-            if station_profile == None:
-                station_profile = StationProfile(name="default", configuration={"firmware": "2.2.17"}, compatible_firmwares=["2.2.17"])
-                station_profile.save()
-            hardware = Hardware.objects.filter(hardware_type=payload['hardware']).first()
-            if hardware == None:
-                hardware = Hardware(hardware_type=payload['hardware'], name='tbeam', station_type='infrastructure')
-                try:
-                    hardware.save()
-                except django.db.utils.IntegrityError as e:
-                    return
+            hardware = ingest_cache.hardware(payload['hardware'])
             station = Station(
                 hardware=hardware,
-                station_profile=station_profile,
+                station_profile=ingest_cache.station_profile(),
                 hardware_number=number,
                 hardware_node=payload['id'],
                 station_type=hardware.station_type,
                 short_name=(payload['shortname'] or 'blank!').replace('\x00', ''))
             station.updated_at = current_time
-            try:
-                print(f'adding new station {station} at {current_time} number {number}')
-                station.save()
-            except django.db.utils.IntegrityError as e:
-                print(e)
-                return
+            print(f'adding new station {station} at {current_time} number {number}')
+            # a node announced to two consumers at once gets the row the first one inserted
+            station = pipeline.insert_station(station)
+            ingest_cache.remember_station(station)
+        heard = heard_at(message, current_time)
+        if station.last_heard_at is not None and heard < station.last_heard_at:
+            # an older announcement (a retry, a late copy); the station already shows a newer one
+            return metrics.IGNORED
         station.updated_at = current_time
         station.name = payload['longname'] or 'blank'
         station.name = station.name.replace("\x00", "")
@@ -52,12 +99,17 @@ def process_message(message):
         if "properties" not in station.features: station.features["properties"] = {}
         station.features["properties"]["name"] = station.name
         station.features["properties"]["time"] = iso_time(message['timestamp'])
-        station.save()
+        station.last_heard_at = heard
+        pipeline.writer.add(station)
         return
 
     if station == None:
         # print(f'skipping this message because we do not know the station: {message}')
-        return
+        return metrics.UNKNOWN_STATION
+    heard = heard_at(message, current_time)
+    # a message older than the one the station shows (a retry, a late copy) only adds its rows
+    stale = station.last_heard_at is not None and heard < station.last_heard_at
+    if not stale: station.last_heard_at = heard
 
     if station.features == None: station.features = {
         "type": "Feature",
@@ -86,6 +138,7 @@ def process_message(message):
         "id": str(station.id)
     }
     if "texts" not in station.features["properties"]: station.features["properties"]["texts"] = [] # remove
+    station.features["properties"]["texts"] = recent_texts(station.features["properties"]["texts"])
     station.features["properties"]["node_type"] = station.station_type
 
     if message['type'] == 'position':
@@ -95,11 +148,12 @@ def process_message(message):
             timestamp = tz.localize(timestamp)
         lat = payload['latitude_i'] / 10000000
         lon = payload['longitude_i']  / 10000000
-        if round(lat, 3) == 0 and round(lon, 3) == 0: return
+        if round(lat, 3) == 0 and round(lon, 3) == 0: return metrics.IGNORED
         ground_track = payload.get('ground_track')
         if ground_track: ground_track = ground_track / 100000
         fence = campus.inner_geofence
         position_log = PositionLog(
+            message_id=message.get('id'),
             station=station,
             latitude=lat,
             longitude=lon,
@@ -109,10 +163,16 @@ def process_message(message):
             timestamp=timestamp or current_time,
             updated_on=today,
             updated_at=current_time)
+        if stale:
+            if not fence.outside(lat, lon): return metrics.INSIDE_FENCE
+            pipeline.writer.add(station, position_log)
+            return
         # log this location if it's away from the hab, or if it represents returning to the hab, or position was blank
-        if fence.outside(lat, lon) or station.last_position == None or station.outside(fence) or station.last_position.updated_on != today:
-            position_log.save()
-            station.last_position = position_log
+        always_log = station.last_position == None or station.last_position.updated_on != today or (station.outside(fence) and not fence.outside(lat, lon))
+        # away from the hab, track_filter thins out fixes that add nothing to the track
+        logged_positions = track_filter.keep(station, position_log, always_log) if always_log or fence.outside(lat, lon) else []
+        if logged_positions:
+            station.last_position = logged_positions[-1]
         if "geometry" not in station.features: station.features["geometry"] = {"type": "Point"}
         station.features["type"] = "Feature"
         station.features["geometry"]["type"] = "Point"
@@ -123,11 +183,14 @@ def process_message(message):
         station.features["properties"]["node_type"] = station.hardware.station_type
         station.features["properties"]["time"] = iso_time(message['timestamp'])
         station.updated_at = current_time
-        station.save()
-        log_measurements(station, station.features, current_time)
+        pipeline.writer.add(station, *logged_positions, station_measure(station, station.features, current_time))
+        if not logged_positions:
+            return metrics.THINNED if always_log or fence.outside(lat, lon) else metrics.INSIDE_FENCE
         return
 
     if message['type'] == 'telemetry':
+        if not retried and pipeline.writer.recently_queued(TelemetryLog, station.id, message.get('id')):
+            return metrics.DUPLICATE
         telemetry_log = TelemetryLog(
             message_id=message['id'],
             station=station,
@@ -144,9 +207,8 @@ def process_message(message):
             current=payload.get('current'),
             updated_on=today,
             updated_at=current_time)
-        try:
-            telemetry_log.save()
-        except IntegrityError as e:
+        if stale:
+            pipeline.writer.add(station, telemetry_log)
             return
         station.features["properties"]["temperature"] = telemetry_log.temperature or station.features["properties"].get("temperature")
         station.features["properties"]["relative_humidity"] = telemetry_log.relative_humidity or station.features["properties"].get("relative_humidity")
@@ -161,11 +223,12 @@ def process_message(message):
         station.features["properties"]["node_type"] = station.hardware.station_type
         station.features["properties"]["time"] = iso_time(message['timestamp'])
         station.updated_at = current_time
-        station.save()
-        log_measurements(station, station.features, current_time)
+        pipeline.writer.add(station, telemetry_log, station_measure(station, station.features, current_time))
         return
 
     if message['type'] == 'text':
+        if not retried and pipeline.writer.recently_queued(TextLog, station.id, message.get('id')):
+            return metrics.DUPLICATE
         text = payload.get('text').replace("\x00", "")
         print(f'@@text "{text}"')
         text_log = TextLog(
@@ -175,21 +238,43 @@ def process_message(message):
             text=text,
             updated_at=current_time,
             updated_on=current_time.astimezone(tz).date())
-        text_log.save()
+        if stale:
+            pipeline.writer.add(station, text_log)
+            return
 
         if "texts" not in station.features["properties"]: station.features["properties"]["texts"] = [] # remove
         station.features["properties"]["texts"].append({
             "text": text_log.text,
             "coordinates": station.features["geometry"].get("coordinates"),
             "updated_at": iso_time(message['timestamp']) })
+        station.features["properties"]["texts"] = recent_texts(station.features["properties"]["texts"])
         station.updated_at = current_time
-        station.save()
-        log_measurements(station, station.features, current_time)
+        pipeline.writer.add(station, text_log, station_measure(station, station.features, current_time))
         return
 
-def log_measurements(station, features, current_time):
-    measure = StationMeasure(station=station, features=features, updated_at=current_time)
-    measure.save()
+# station id -> (values, other properties) of the last StationMeasure queued in this process
+measured = {}
+
+def station_measure(station, features, current_time):
+    # typed readings plus only the other properties that changed; nothing if no reading changed
+    values, properties = StationMeasure.readings(features)
+    previous_values, previous_properties = measured.get(station.id, (None, {}))
+    changed = {k: v for k, v in properties.items() if previous_properties.get(k) != v}
+    if values == previous_values and not changed: return None
+    measured[station.id] = (values, properties)
+    return StationMeasure(station=station, features=copy.deepcopy(changed) or None, updated_at=current_time, **values)
+
+def heard_at(message, current_time):
+    # gateway receive time, never in the future
+    try:
+        return min(datetime.fromtimestamp(message['timestamp'], timezone.utc), current_time)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return current_time
+
+def recent_texts(texts):
+    # features only carry the last few texts; the full history is in TextLog (texts.json?station=<id>)
+    limit = getattr(settings, 'STATION_RECENT_TEXTS', 10)
+    return texts[-limit:] if limit > 0 else []
 
 def iso_time(_seconds):
     # nodes are reporting current time incorrectly, so disregard and return now in iso
@@ -198,7 +283,7 @@ def iso_time(_seconds):
 # ADS-B barometric/geometric altitudes (dump1090/readsb style) are in feet; store meters in DB.
 FEET_TO_METERS = 0.3048
 
-def process_aircraft(hex_code, message):
+def process_aircraft(hex_code, message, campus_name=None):
     def _as_float(value):
         try:
             if value is None:
@@ -254,37 +339,35 @@ def process_aircraft(hex_code, message):
     # Skip if no position data
     if lat is None or lon is None:
         # print(f'skipping aircraft {hex_code} because it has no position data')
-        return
+        return metrics.IGNORED
     
-    def _save_aircraft_for_campus(campus):
-        tz = pytz.timezone(campus.time_zone)
+    def _save_aircraft_for_campus(campus, tz):
         current_time = datetime.now(timezone.utc)
         current_time_tz = current_time.astimezone(tz)
         today = current_time_tz.date()
         timestamp = _parse_timestamp(message.get('iso'), current_time)
 
-        aircraft, created = Aircraft.objects.get_or_create(
-            hex=hex_code,
-            defaults={
-                'campus': campus,
-                'features': message,
-                'updated_at': current_time,
-                'updated_on': today,
-            }
-        )
+        seen = ingest_cache.aircraft(hex_code)
+        if seen is None:
+            # first message for this hex in this process; afterwards the cache holds its id and features
+            aircraft, _ = Aircraft.objects.get_or_create(
+                hex=hex_code,
+                defaults={
+                    'campus': campus,
+                    'features': {},
+                    'updated_at': current_time,
+                    'updated_on': today,
+                }
+            )
+            prev_features = aircraft.features if isinstance(aircraft.features, dict) else {}
+            seen = {'id': aircraft.id, 'features': prev_features, 'position': None}
+            ingest_cache.remember_aircraft(hex_code, seen)
 
-        prev_features = aircraft.features if isinstance(aircraft.features, dict) else {}
         if isinstance(message, dict):
-            merged_features = {**prev_features, **message}
+            merged_features = {**seen['features'], **message}
         else:
             merged_features = message
-
-        if not created:
-            aircraft.campus = campus
-            aircraft.features = merged_features
-            aircraft.updated_at = current_time
-            aircraft.updated_on = today
-            aircraft.save()
+        seen['features'] = merged_features if isinstance(merged_features, dict) else {}
 
         mf = merged_features if isinstance(merged_features, dict) else {}
         altitude_for_log = _altitude_meters_from_message(
@@ -296,74 +379,69 @@ def process_aircraft(hex_code, message):
         if django_timezone.is_naive(ts_for_minute):
             ts_for_minute = django_timezone.make_aware(ts_for_minute, timezone.utc)
         minute_start = ts_for_minute.replace(second=0, microsecond=0)
-        minute_end = minute_start + timedelta(minutes=1)
-        existing = (
-            AircraftPositionLog.objects.filter(
-                aircraft=aircraft,
-                latitude=lat,
-                longitude=lon,
-                timestamp__gte=minute_start,
-                timestamp__lt=minute_end,
-            )
-            .order_by('-timestamp')
-            .first()
-        )
+        ground_speed = _as_float(mf.get('speed', mf.get('gs')))
+        ground_track = _as_float(mf.get('course', mf.get('track')))
 
-        try:
-            if existing:
-                existing.campus = campus
-                existing.altitude = altitude_for_log
-                existing.ground_speed = _as_float(mf.get('speed', mf.get('gs')))
-                existing.ground_track = _as_float(mf.get('course', mf.get('track')))
-                existing.timestamp = timestamp
-                existing.timestamp_minute = minute_start
-                existing.updated_on = today
-                existing.updated_at = current_time
-                existing.save(
-                    update_fields=[
-                        'campus',
-                        'altitude',
-                        'ground_speed',
-                        'ground_track',
-                        'timestamp',
-                        'timestamp_minute',
-                        'updated_on',
-                        'updated_at',
-                    ]
-                )
-                return
+        # feeds repeat the same fix several times a second; only write when the row would change
+        position = (campus.id, lat, lon, minute_start, altitude_for_log, ground_speed, ground_track)
+        if seen['position'] == position:
+            # the merged features go out with the next fix that moves
+            return metrics.DUPLICATE
+
+        updated = Aircraft.objects.filter(id=seen['id']).update(
+            campus=campus,
+            features=merged_features,
+            updated_at=current_time,
+            updated_on=today,
+        )
+        if not updated:
+            # deleted since we cached it; start over with a fresh row
+            ingest_cache.forget_aircraft(hex_code)
+            return _save_aircraft_for_campus(campus, tz)
 
-            AircraftPositionLog.objects.create(
-                aircraft=aircraft,
+        # one INSERT ... ON CONFLICT (aircraft, latitude, longitude, timestamp_minute) DO UPDATE
+        AircraftPositionLog.objects.bulk_create(
+            [AircraftPositionLog(
+                aircraft_id=seen['id'],
                 campus=campus,
                 latitude=lat,
                 longitude=lon,
                 altitude=altitude_for_log,
-                ground_speed=_as_float(mf.get('speed', mf.get('gs'))),
-                ground_track=_as_float(mf.get('course', mf.get('track'))),
+                ground_speed=ground_speed,
+                ground_track=ground_track,
                 timestamp=timestamp,
                 timestamp_minute=minute_start,
                 updated_on=today,
                 updated_at=current_time,
-            )
-        except IntegrityError:
-            # Concurrent listener inserted an equivalent row first.
-            return
+            )],
+            update_conflicts=True,
+            unique_fields=['aircraft', 'latitude', 'longitude', 'timestamp_minute'],
+            update_fields=[
+                'campus',
+                'altitude',
+                'ground_speed',
+                'ground_track',
+                'timestamp',
+                'updated_on',
+                'updated_at',
+            ],
+        )
+        seen['position'] = position
 
-    # RemoteID messages should use explicit CAMPUS routing (previous run_remoteid_feed behavior)
+    # RemoteID messages should use explicit CAMPUS routing (previous run_remoteid_feed behavior),
+    # or the campus routed from their topic root
     if 'ID' in message:
-        campus_name = (os.getenv('CAMPUS') or '').strip()
+        campus_name = (campus_name or os.getenv('CAMPUS') or '').strip()
         if not campus_name:
-            return
-        campus = Campus.objects.filter(name=campus_name).first()
-        if campus is None:
-            return
-        _save_aircraft_for_campus(campus)
-        return
+            return metrics.OUTSIDE_CAMPUS
+        try:
+            campus, tz = ingest_cache.campus(campus_name)
+        except Campus.DoesNotExist:
+            return metrics.OUTSIDE_CAMPUS
+        return _save_aircraft_for_campus(campus, tz)
 
     # ADS-B style messages remain geofence-gated
-    campuses = Campus.objects.filter(outer_geofence__isnull=False).select_related('outer_geofence')
-    for campus in campuses:
-        if campus.outer_geofence and not campus.outer_geofence.outside(lat, lon):
-            _save_aircraft_for_campus(campus)
-            return
\ No newline at end of file
+    routed = ingest_cache.campus_at(lat, lon)
+    if routed is None:
+        return metrics.OUTSIDE_CAMPUS
+    return _save_aircraft_for_campus(*routed)
\ No newline at end of file
@@ -0,0 +1,218 @@
+"""
+Process-local cache of the rows the ingest path reads for every message: the
+campus (with its geofences and time zone), a grid of campus outer geofences
+for routing ADS-B aircraft, stations by hardware number, the station profile
+and hardware new stations are registered with, and the aircraft this process
+has written.
+
+Entries are dropped by post_save/post_delete signals when Campus, Geofence,
+Station, StationProfile, Hardware or Aircraft rows change in this process. Changes made by another
+process (admin in a web worker while run_mqtt_ingest owns ingest) are picked
+up once an entry is INGEST_CACHE_SECONDS old.
+"""
+import collections
+import math
+import threading
+import time
+
+import pytz
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from evalink.models import Campus, Geofence, Station, StationProfile, Hardware, PositionLog, Aircraft
+
+_lock = threading.Lock()
+_campuses = {}
+_stations = {}
+# 'profile' or ('hardware', hardware_type) -> (cached_at, row) for station registration
+_defaults = {}
+# (built_at, {(lat cell, lon cell): [(fence, campus, tz), ...]}) over campus outer fences
+_outer_grid = None
+# grid cell size in degrees; campus fences are a few km across so most cells hold one campus
+GRID_DEGREES = 0.5
+# hex -> (cached_at, {'id', 'features', 'position'}) for aircraft written by this process
+# (handler.process_aircraft), least recently used first
+_aircraft = collections.OrderedDict()
+# ADS-B brings in new hex codes all day; keep the busiest ones
+AIRCRAFT_CACHE_SIZE = 5000
+
+
+def _fresh(entry):
+    return entry is not None and time.monotonic() - entry[0] < getattr(settings, 'INGEST_CACHE_SECONDS', 60)
+
+
+def campus(name):
+    """Return (campus, tz) for a campus name; raises Campus.DoesNotExist like Campus.objects.get."""
+    entry = _campuses.get(name)
+    if not _fresh(entry):
+        found = Campus.objects.select_related('inner_geofence', 'outer_geofence').get(name=name)
+        entry = (time.monotonic(), (found, pytz.timezone(found.time_zone)))
+        with _lock:
+            _campuses[name] = entry
+    return entry[1]
+
+
+def station(number):
+    """Return the Station with this hardware number, or None; unknown numbers are cached too."""
+    entry = _stations.get(number)
+    if not _fresh(entry):
+        found = Station.objects.select_related('hardware', 'last_position').filter(hardware_number=number).first()
+        entry = (time.monotonic(), found)
+        with _lock:
+            _stations[number] = entry
+    return entry[1]
+
+
+def remember_station(found):
+    """Cache a station the ingest path inserted itself, so the next message does not look it up."""
+    with _lock:
+        _stations[found.hardware_number] = (time.monotonic(), found)
+
+
+def station_profile():
+    """Return the profile new stations get, creating the default one on a fresh database."""
+    entry = _defaults.get('profile')
+    if not _fresh(entry):
+        found = StationProfile.objects.order_by('id').first()
+        if found is None:
+            StationProfile.objects.create(name='default', configuration={'firmware': '2.2.17'}, compatible_firmwares=['2.2.17'])
+            # another consumer may have created one too; everyone settles on the oldest
+            found = StationProfile.objects.order_by('id').first()
+        entry = (time.monotonic(), found)
+        with _lock:
+            _defaults['profile'] = entry
+    return entry[1]
+
+
+def hardware(hardware_type):
+    """Return the Hardware row for a Meshtastic hardware model, inserting an infrastructure one if there is none."""
+    key = ('hardware', hardware_type)
+    entry = _defaults.get(key)
+    if not _fresh(entry):
+        found = Hardware.objects.filter(hardware_type=hardware_type).order_by('id').first()
+        if found is None:
+            # unique on (station_type, hardware_type), so a concurrent insert is not an error
+            Hardware.objects.bulk_create([Hardware(hardware_type=hardware_type, name='tbeam', station_type='infrastructure')],
+                                         ignore_conflicts=True)
+            found = Hardware.objects.filter(hardware_type=hardware_type).order_by('id').first()
+        entry = (time.monotonic(), found)
+        with _lock:
+            _defaults[key] = entry
+    return entry[1]
+
+
+def aircraft(hex_code):
+    """Return the cached {'id', 'features', 'position'} of an aircraft, or None; callers may update it in place."""
+    with _lock:
+        entry = _aircraft.get(hex_code)
+        if entry is None:
+            return None
+        if not _fresh(entry):
+            del _aircraft[hex_code]
+            return None
+        _aircraft.move_to_end(hex_code)
+        return entry[1]
+
+
+def remember_aircraft(hex_code, seen):
+    with _lock:
+        _aircraft[hex_code] = (time.monotonic(), seen)
+        _aircraft.move_to_end(hex_code)
+        while len(_aircraft) > AIRCRAFT_CACHE_SIZE:
+            _aircraft.popitem(last=False)
+
+
+def forget_aircraft(hex_code):
+    with _lock:
+        _aircraft.pop(hex_code, None)
+
+
+def _cell(lat, lon):
+    return math.floor(lat / GRID_DEGREES), math.floor(lon / GRID_DEGREES)
+
+
+def _build_outer_grid():
+    grid = {}
+    for found in Campus.objects.filter(outer_geofence__isnull=False).select_related('inner_geofence', 'outer_geofence').order_by('id'):
+        fence = found.outer_geofence
+        entry = (fence, found, pytz.timezone(found.time_zone))
+        low_lat, low_lon = _cell(fence.latitude1, fence.longitude1)
+        high_lat, high_lon = _cell(fence.latitude2, fence.longitude2)
+        for lat_cell in range(low_lat, high_lat + 1):
+            for lon_cell in range(low_lon, high_lon + 1):
+                grid.setdefault((lat_cell, lon_cell), []).append(entry)
+    return grid
+
+
+def campus_at(lat, lon):
+    """Return (campus, tz) for the first campus whose outer geofence contains the point, or None."""
+    global _outer_grid
+    entry = _outer_grid
+    if not _fresh(entry):
+        entry = (time.monotonic(), _build_outer_grid())
+        with _lock:
+            _outer_grid = entry
+    for fence, found, tz in entry[1].get(_cell(lat, lon), ()):
+        if not fence.outside(lat, lon):
+            return found, tz
+    return None
+
+
+def invalidate_campuses(**kwargs):
+    global _outer_grid
+    with _lock:
+        _campuses.clear()
+        _outer_grid = None
+
+
+def invalidate_stations(**kwargs):
+    with _lock:
+        _stations.clear()
+
+
+def invalidate_defaults(**kwargs):
+    with _lock:
+        _defaults.clear()
+
+
+def invalidate_profile(**kwargs):
+    with _lock:
+        _defaults.pop('profile', None)
+
+
+def invalidate_hardware(**kwargs):
+    # stations are cached with their hardware too
+    invalidate_stations()
+    with _lock:
+        for key in [key for key in _defaults if key != 'profile']:
+            del _defaults[key]
+
+
+def invalidate_aircraft(**kwargs):
+    with _lock:
+        _aircraft.clear()
+
+
+def _aircraft_changed(instance, **kwargs):
+    # per row: the ingest path creates aircraft itself and must not empty the cache each time
+    forget_aircraft(instance.hex)
+
+
+def invalidate(**kwargs):
+    invalidate_campuses()
+    invalidate_stations()
+    invalidate_defaults()
+    invalidate_aircraft()
+
+
+# a receiver only drops what its model feeds, so station_profile() creating the
+# default profile does not evict the hardware cached just before
+for model, receiver in ((Campus, invalidate_campuses), (Geofence, invalidate_campuses),
+                        (Station, invalidate_stations), (Hardware, invalidate_hardware),
+                        (StationProfile, invalidate_profile)):
+    post_save.connect(receiver, sender=model, dispatch_uid=f'ingest_cache_save_{model.__name__}')
+    post_delete.connect(receiver, sender=model, dispatch_uid=f'ingest_cache_delete_{model.__name__}')
+# Cached stations hold their last_position; deleting it must not leave a dangling reference.
+post_delete.connect(invalidate_stations, sender=PositionLog, dispatch_uid='ingest_cache_delete_PositionLog')
+post_save.connect(_aircraft_changed, sender=Aircraft, dispatch_uid='ingest_cache_save_Aircraft')
+post_delete.connect(_aircraft_changed, sender=Aircraft, dispatch_uid='ingest_cache_delete_Aircraft')
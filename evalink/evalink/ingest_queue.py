@@ -0,0 +1,228 @@
+"""
+Bounded queue between the MQTT network loop and the database.
+
+mqtt.on_message only calls `queue.put`; a worker thread takes messages in
+order and runs handler.dispatch, so a slow database never holds up paho's
+keepalives. With INGEST_WORKERS > 1 that thread hands each message to one of
+several DB worker threads, chosen by the sending node (or aircraft topic), so
+different nodes are processed concurrently while each node's messages stay in
+order. The dead-letter retrier hands its retries back through resubmit(), so
+they too run on their node's worker and never alongside it. When INGEST_QUEUE_SIZE messages are waiting, INGEST_QUEUE_OVERFLOW
+decides what happens to the next one:
+
+  block        on_message waits for room (backpressure onto the broker)
+  drop_oldest  the oldest waiting message is discarded and counted
+  spill        messages are appended to INGEST_SPILL_PATH until the queue
+               empties, then read back in order; nothing is lost. Only in
+               the run_mqtt_ingest process (INGEST_OWNS_FILES); web workers
+               share the path, so their queues block instead
+"""
+import base64
+import collections
+import json
+import os
+import queue as queues
+import re
+import threading
+import zlib
+import time
+import traceback
+
+from django.conf import settings
+
+from evalink import handler, deadletter, pipeline
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+SPILL = 'spill'
+OVERFLOW_MODES = (BLOCK, DROP_OLDEST, SPILL)
+# seconds between depth reports while the queue is busy
+REPORT_SECONDS = 60
+# messages each DB worker may have waiting before the dispatcher blocks
+SHARD_SIZE = 100
+# mesh payloads carry the sending node as "from"; cheaper than parsing the JSON twice
+FROM_PATTERN = re.compile(rb'"from"\s*:\s*(\d+)')
+
+
+def shard_key(topic, payload):
+    """What a message must stay in order with: its sending node, else its topic (one per aircraft)."""
+    found = FROM_PATTERN.search(payload)
+    return found.group(1) if found else topic.encode()
+
+
+class IngestQueue:
+    def __init__(self, maxsize, overflow, spill_path, process, workers=1):
+        if overflow not in OVERFLOW_MODES:
+            raise ValueError(f'INGEST_QUEUE_OVERFLOW must be one of {", ".join(OVERFLOW_MODES)}, not {overflow!r}')
+        self.maxsize = max(1, maxsize)
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.draining_path = f'{spill_path}.draining'
+        self.process = process
+        self.workers = max(1, workers)
+        self.shards = []
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.spill_file = None
+        self.counts = collections.Counter()
+        self.high_water = 0
+        self.reported_at = time.monotonic()
+        # a spill file left by the previous run is older than anything we receive now
+        self.spilled_pending = sum(_count_lines(path) for path in (self.spill_path, self.draining_path)) if overflow == SPILL else 0
+        self.spilling = overflow == SPILL and os.path.exists(self.spill_path)
+
+    def put(self, topic, payload):
+        """Accept one message from the network loop."""
+        with self.condition:
+            self.counts['received'] += 1
+            if self.overflow == SPILL and (self.spilling or len(self.items) >= self.maxsize):
+                try:
+                    self._spill(topic, payload)
+                except OSError as error:
+                    # keep the message rather than lose it; the queue just grows past its bound
+                    print(f'ingest spill to {self.spill_path} failed: {error}')
+                    self.items.append((topic, payload, 0))
+            else:
+                if len(self.items) >= self.maxsize:
+                    if self.overflow == DROP_OLDEST:
+                        self.items.popleft()
+                        self.counts['dropped'] += 1
+                    else:
+                        self.counts['blocked'] += 1
+                        while len(self.items) >= self.maxsize:
+                            self.condition.wait()
+                self.items.append((topic, payload, 0))
+            self.high_water = max(self.high_water, len(self.items))
+            if self.thread is None:
+                self._start()
+            self.condition.notify_all()
+
+    def resubmit(self, topic, payload, attempts):
+        """
+        Queue a retry from deadletter.retrier ahead of new messages, past the
+        size bound. Returns False if the queue is not running, so the retrier
+        handles it on its own thread.
+        """
+        with self.condition:
+            if self.thread is None:
+                return False
+            self.items.appendleft((topic, payload, attempts))
+            self.condition.notify_all()
+        return True
+
+    def _start(self):
+        if self.workers > 1:
+            self.shards = [queues.Queue(SHARD_SIZE) for _ in range(self.workers)]
+            for number, shard in enumerate(self.shards):
+                threading.Thread(target=self._work, args=(shard,), name=f'ingest-worker-{number}', daemon=True).start()
+        self.thread = threading.Thread(target=self._run, name='ingest-dispatch', daemon=True)
+        self.thread.start()
+
+    def stats(self):
+        """Queue depth and counters, for reports and metrics."""
+        with self.condition:
+            return {
+                'depth': len(self.items) + sum(shard.qsize() for shard in self.shards),
+                'high_water': self.high_water,
+                'spilled_pending': self.spilled_pending,
+                **self.counts,
+            }
+
+    def _spill(self, topic, payload):
+        if self.spill_file is None:
+            self.spill_file = open(self.spill_path, 'a')
+        self.spill_file.write(json.dumps([topic, base64.b64encode(payload).decode('ascii')]) + '\n')
+        self.spill_file.flush()
+        self.spilling = True
+        self.spilled_pending += 1
+        self.counts['spilled'] += 1
+
+    def _run(self):
+        if self.overflow == SPILL and os.path.exists(self.draining_path):
+            self._drain()
+        while True:
+            with self.condition:
+                while not self.items and not self.spilling:
+                    self.condition.wait()
+                if self.items:
+                    topic, payload, attempts = self.items.popleft()
+                    self.condition.notify_all()
+                else:
+                    # everything received before the first spilled message is done;
+                    # new messages queue in memory again while the file is read back
+                    topic = None
+                    if self.spill_file is not None:
+                        self.spill_file.close()
+                        self.spill_file = None
+                    os.replace(self.spill_path, self.draining_path)
+                    self.spilling = False
+            if topic is None:
+                self._drain()
+            else:
+                self._route(topic, payload, attempts)
+            self._report()
+
+    def _route(self, topic, payload, attempts=0):
+        if not self.shards:
+            self.handle(topic, payload, attempts)
+            return
+        self.shards[zlib.crc32(shard_key(topic, payload)) % len(self.shards)].put((topic, payload, attempts))
+
+    def _work(self, shard):
+        while True:
+            topic, payload, attempts = shard.get()
+            self.handle(topic, payload, attempts)
+
+    def _drain(self):
+        with open(self.draining_path) as spilled:
+            for line in spilled:
+                topic, encoded = json.loads(line)
+                self._route(topic, base64.b64decode(encoded))
+                with self.condition:
+                    self.spilled_pending -= 1
+        os.remove(self.draining_path)
+
+    def handle(self, topic, payload, attempts=0):
+        """Process one message that failed `attempts` times before; failures go to the dead-letter retrier."""
+        try:
+            self.process(topic, payload, attempts)
+        except json.JSONDecodeError as error:
+            print(f'handler could not decode {topic}: {error}')
+            deadletter.retrier.push(topic, payload, error, attempts=deadletter.retrier.retries)
+        except Exception as error:
+            print(f'handler failed to process {topic}: {error} {traceback.print_tb(error.__traceback__)}')
+            pipeline.recover_connection()
+            deadletter.retrier.push(topic, payload, error, attempts + 1)
+        with self.condition:
+            self.counts['processed'] += 1
+
+    def _report(self):
+        if time.monotonic() - self.reported_at < REPORT_SECONDS:
+            return
+        self.reported_at = time.monotonic()
+        stats = self.stats()
+        if stats['depth'] or stats['spilled_pending'] or stats['high_water'] >= self.maxsize:
+            print('ingest queue ' + ' '.join(f'{key}={value}' for key, value in stats.items()))
+        with self.condition:
+            self.high_water = len(self.items)
+
+
+def _count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as spilled:
+        return sum(1 for _ in spilled)
+
+
+overflow = getattr(settings, 'INGEST_QUEUE_OVERFLOW', SPILL)
+if overflow == SPILL and not getattr(settings, 'INGEST_OWNS_FILES', False):
+    overflow = BLOCK
+queue = IngestQueue(
+    getattr(settings, 'INGEST_QUEUE_SIZE', 10000),
+    overflow,
+    str(getattr(settings, 'INGEST_SPILL_PATH', 'ingest-spill.jsonl')),
+    handler.dispatch,
+    getattr(settings, 'INGEST_WORKERS', 1),
+)
+deadletter.retrier.resubmit = queue.resubmit
@@ -0,0 +1,154 @@
+"""
+Live change feed for the map, sent as Server-Sent Events from /live.
+
+While anyone is subscribed, one producer thread per process reads a cheap
+stamp per channel every LIVE_POLL_MS: stations (the features_cache version
+and the newest Station.updated_at), aircraft (the newest Aircraft.updated_at)
+and texts (the newest TextLog id). When a stamp moves, that channel's sequence
+is bumped and every subscriber wakes, so any number of viewers cost the same
+three queries. Events only name the channel that changed; the map then fetches
+features.json?since=..., aircraft.json or texts.json, which are cached or
+cheap. A subscriber that has had no event for LIVE_HEARTBEAT_S gets a comment
+line, so proxies keep the stream open.
+
+stream() is for WSGI workers, where each viewer holds a worker thread;
+astream() is for ASGI servers, where a viewer is a coroutine waiting on a
+future.
+"""
+import asyncio
+import json
+import threading
+import time
+
+from django import db
+from django.conf import settings
+from django.db.models import Max
+
+from evalink import features_cache
+from evalink.models import Aircraft, TextLog
+
+CHANNELS = ('stations', 'aircraft', 'texts')
+
+
+def read_stamps():
+    """{channel: value that changes whenever the channel's data does}"""
+    return {
+        'stations': features_cache.stamp(),
+        'aircraft': Aircraft.objects.aggregate(latest=Max('updated_at'))['latest'],
+        'texts': TextLog.objects.aggregate(latest=Max('id'))['latest'],
+    }
+
+
+class Hub:
+    def __init__(self, poll_ms, heartbeat_s):
+        self.poll = poll_ms / 1000.0
+        self.heartbeat = heartbeat_s
+        self.condition = threading.Condition()
+        self.sequences = dict.fromkeys(CHANNELS, 0)
+        self.subscribers = 0
+        # (loop, future) of astream() subscribers waiting for the next change
+        self.waiters = set()
+        self.thread = None
+
+    def publish(self, changed):
+        """Bump the sequence of each changed channel and wake every subscriber."""
+        with self.condition:
+            for channel in changed:
+                self.sequences[channel] += 1
+            self.condition.notify_all()
+            waiters, self.waiters = self.waiters, set()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def stream(self):
+        """Yield Server-Sent Events until the client goes away."""
+        seen = self._subscribe()
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.sequences != seen, timeout=self.heartbeat)
+                    current = dict(self.sequences)
+                if current == seen:
+                    yield ': ping\n\n'
+                    continue
+                yield from _events(seen, current)
+                seen = current
+        finally:
+            self._unsubscribe()
+
+    async def astream(self):
+        """stream() for ASGI: waits on a future instead of holding a thread."""
+        seen = self._subscribe()
+        loop = asyncio.get_running_loop()
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                future = None
+                with self.condition:
+                    current = dict(self.sequences)
+                    if current == seen:
+                        future = loop.create_future()
+                        self.waiters.add((loop, future))
+                if future is not None:
+                    try:
+                        await asyncio.wait_for(future, self.heartbeat)
+                    except asyncio.TimeoutError:
+                        with self.condition:
+                            self.waiters.discard((loop, future))
+                        yield ': ping\n\n'
+                    continue
+                for event in _events(seen, current):
+                    yield event
+                seen = current
+        finally:
+            self._unsubscribe()
+
+    def _subscribe(self):
+        with self.condition:
+            self.subscribers += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='live-hub', daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+            return dict(self.sequences)
+
+    def _unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def _run(self):
+        stamps = None
+        while True:
+            with self.condition:
+                if not self.subscribers:
+                    # nobody is watching; start from a fresh baseline when someone is
+                    stamps = None
+                    self.condition.wait_for(lambda: self.subscribers > 0)
+            try:
+                current = read_stamps()
+            except Exception as error:
+                print(f'live feed could not read stamps: {error}')
+                db.close_old_connections()
+                current = stamps
+            if stamps is not None and current != stamps:
+                self.publish([channel for channel in CHANNELS if current[channel] != stamps[channel]])
+            stamps = current
+            time.sleep(self.poll)
+
+
+def _events(seen, current):
+    for channel in CHANNELS:
+        if current[channel] != seen[channel]:
+            yield f'event: {channel}\ndata: {json.dumps({"sequence": current[channel]})}\n\n'
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+hub = Hub(
+    getattr(settings, 'LIVE_POLL_MS', 1000),
+    getattr(settings, 'LIVE_HEARTBEAT_S', 15),
+)
@@ -0,0 +1,227 @@
+"""
+Measure how fast the ingest handlers go against the configured database.
+
+  python manage.py bench_ingest [--messages 2000] [--stations 50] [--aircraft 50]
+  python manage.py bench_ingest --archive evalink/mqtt-archive/mqtt-20250301T14.jsonl.gz
+
+Generated traffic covers Meshtastic nodeinfo, position, telemetry and text and
+ADS-B/RemoteID aircraft, in the payload shapes mqtt.on_message receives, for a
+throwaway "Benchmark" campus. --archive replays recorded traffic instead, for
+the campus named by CAMPUS. Messages go through handler.dispatch on this
+thread with the write-behind buffer flushing every --batch-size messages, and
+everything is rolled back at the end unless --keep is given.
+"""
+import contextlib
+import itertools
+import json
+import os
+import random
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from evalink import handler, ingest_cache, pipeline, raw_archive
+from evalink.models import Campus, Geofence
+
+TYPES = ('nodeinfo', 'position', 'telemetry', 'text', 'adsb', 'remoteid')
+BENCH_CAMPUS = 'Benchmark'
+# hardware numbers well away from real Meshtastic node numbers
+FIRST_NUMBER = 4000000000
+
+
+class Command(BaseCommand):
+    help = 'Benchmark handler.dispatch throughput, latency and queries per message type'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=2000,
+            help='Generated messages per type, after one nodeinfo per station (default: 2000)',
+        )
+        parser.add_argument(
+            '--stations',
+            type=int,
+            default=50,
+            help='Generated mesh stations (default: 50)',
+        )
+        parser.add_argument(
+            '--aircraft',
+            type=int,
+            default=50,
+            help='Generated ADS-B and RemoteID aircraft (default: 50)',
+        )
+        parser.add_argument(
+            '--types',
+            default=','.join(TYPES),
+            help=f'Comma-separated message types to run (default: {",".join(TYPES)})',
+        )
+        parser.add_argument(
+            '--archive',
+            nargs='+',
+            help='Replay raw MQTT archive files instead of generated traffic',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=getattr(settings, 'INGEST_BATCH_SIZE', 100),
+            help='Write-behind batch size (default: INGEST_BATCH_SIZE)',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Commit the benchmark rows instead of rolling them back',
+        )
+
+    def handle(self, *args, **options):
+        types = [name for name in options['types'].split(',') if name]
+        unknown = set(types) - set(TYPES)
+        if unknown:
+            raise CommandError(f'Unknown types: {", ".join(sorted(unknown))}')
+        os.environ.setdefault('MQTT_TOPIC', 'bench')
+        prefix = os.environ['MQTT_TOPIC']
+
+        writer = pipeline.writer
+        pipeline.writer = pipeline.WriteBehind(options['batch_size'], 0)
+        try:
+            with transaction.atomic():
+                if options['archive']:
+                    corpus = self.load(options['archive'], prefix)
+                else:
+                    self.create_campus()
+                    corpus = self.generate(options, prefix)
+                results = self.run(corpus, types)
+                if not options['keep']:
+                    transaction.set_rollback(True)
+        finally:
+            pipeline.writer = writer
+            ingest_cache.invalidate()
+            handler.measured.clear()
+
+        self.report(results)
+
+    def create_campus(self):
+        os.environ['CAMPUS'] = BENCH_CAMPUS
+        if Campus.objects.filter(name=BENCH_CAMPUS).exists():
+            return
+        inner = Geofence.objects.create(latitude1=39.99, longitude1=-105.01, latitude2=40.01, longitude2=-104.99)
+        outer = Geofence.objects.create(latitude1=39.5, longitude1=-105.5, latitude2=40.5, longitude2=-104.5)
+        Campus.objects.create(name=BENCH_CAMPUS, latitude=40.0, longitude=-105.0,
+                              inner_geofence=inner, outer_geofence=outer)
+
+    def generate(self, options, prefix):
+        """Return {type: [(topic, payload), ...]} of synthetic traffic around the benchmark campus."""
+        rng = random.Random(2141)
+        ids = itertools.count(int(time.time() * 1000))
+        stations = [FIRST_NUMBER + index for index in range(options['stations'])]
+        hexes = [f'b{index:05x}' for index in range(options['aircraft'])]
+        count = options['messages']
+        mesh_topic = f'{prefix}/2/json/LongFast/!bench'
+
+        def mesh(message_type, number, payload):
+            return mesh_topic, json.dumps({
+                'type': message_type,
+                'payload': payload,
+                'from': number,
+                'channel': 0,
+                'timestamp': int(time.time()),
+                'id': next(ids),
+            }).encode()
+
+        def near(spread):
+            return 40.0 + rng.uniform(-spread, spread), -105.0 + rng.uniform(-spread, spread)
+
+        corpus = defaultdict(list)
+        for number in stations:
+            corpus['nodeinfo'].append(mesh('nodeinfo', number, {
+                'id': f'!{number:08x}', 'longname': f'Bench {number}', 'shortname': 'BNCH', 'hardware': 43,
+            }))
+        for _ in range(count):
+            lat, lon = near(0.05)
+            corpus['position'].append(mesh('position', rng.choice(stations), {
+                'latitude_i': int(lat * 1e7), 'longitude_i': int(lon * 1e7),
+                'altitude': rng.randint(1500, 1700), 'ground_speed': rng.randint(0, 3),
+                'ground_track': rng.randint(0, 36000000), 'time': int(time.time()),
+            }))
+            corpus['telemetry'].append(mesh('telemetry', rng.choice(stations), {
+                'battery_level': rng.randint(0, 100), 'voltage': round(rng.uniform(3.3, 4.2), 2),
+                'temperature': round(rng.uniform(-10, 30), 1), 'relative_humidity': round(rng.uniform(5, 60), 1),
+                'barometric_pressure': round(rng.uniform(830, 850), 1),
+            }))
+            corpus['text'].append(mesh('text', rng.choice(stations), {'text': f'bench {rng.randint(0, 10 ** 6)}'}))
+            lat, lon = near(0.4)
+            aircraft = rng.choice(hexes)
+            corpus['adsb'].append((f'{prefix}/aircraft/{aircraft}', json.dumps({
+                'hex': aircraft, 'lat': lat, 'lon': lon, 'alt_baro': rng.randint(6000, 30000),
+                'gs': rng.uniform(80, 450), 'track': rng.uniform(0, 360),
+            }).encode()))
+            lat, lon = near(0.02)
+            drone = rng.choice(hexes).upper()
+            corpus['remoteid'].append((f'{prefix}/aircraft/{drone}', json.dumps({
+                'ID': drone, 'lat': lat, 'lon': lon, 'alt': rng.randint(1550, 1700),
+                'speed': rng.uniform(0, 15), 'course': rng.uniform(0, 360), 'source': 'remoteid',
+            }).encode()))
+        return corpus
+
+    def load(self, paths, prefix):
+        """Return {type: [(topic, payload), ...]} from raw archive files, keeping arrival order per type."""
+        if not os.getenv('CAMPUS'):
+            raise CommandError('Set CAMPUS to the campus the archived traffic belongs to')
+        corpus = defaultdict(list)
+        for path in paths:
+            for _, topic, payload in raw_archive.read(path):
+                try:
+                    message = json.loads(payload)
+                except ValueError:
+                    continue
+                if topic.startswith(f'{prefix}/aircraft/'):
+                    corpus['remoteid' if 'ID' in message else 'adsb'].append((topic, payload))
+                elif isinstance(message, dict) and message.get('type') in TYPES:
+                    corpus[message['type']].append((topic, payload))
+        return corpus
+
+    def run(self, corpus, types):
+        ingest_cache.invalidate()
+        handler.measured.clear()
+        results = {}
+        # handler prints per message; keep the report readable
+        with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):
+            for name in types:
+                messages = corpus.get(name)
+                if not messages:
+                    continue
+                latencies = []
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    for topic, payload in messages:
+                        before = time.perf_counter()
+                        handler.dispatch(topic, payload)
+                        latencies.append(time.perf_counter() - before)
+                    pipeline.writer.flush()
+                    elapsed = time.perf_counter() - started
+                results[name] = (len(messages), elapsed, sorted(latencies), len(queries.captured_queries))
+        return results
+
+    def report(self, results):
+        self.stdout.write(f'{"type":<10} {"msgs":>7} {"msgs/sec":>9} {"p50 ms":>8} {"p99 ms":>8} {"queries/msg":>12}')
+        total_messages = 0
+        total_elapsed = 0
+        for name, (count, elapsed, latencies, queries) in results.items():
+            self.stdout.write(
+                f'{name:<10} {count:>7} {count / elapsed:>9.0f} {_percentile(latencies, 0.5) * 1000:>8.2f} '
+                f'{_percentile(latencies, 0.99) * 1000:>8.2f} {queries / count:>12.2f}'
+            )
+            total_messages += count
+            total_elapsed += elapsed
+        if total_elapsed:
+            self.stdout.write(self.style.SUCCESS(
+                f'\n{total_messages} messages in {total_elapsed:.1f}s ({total_messages / total_elapsed:.0f} msgs/sec)'
+            ))
+
+
+def _percentile(ordered, fraction):
+    return ordered[round(fraction * (len(ordered) - 1))]
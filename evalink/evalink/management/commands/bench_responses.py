@@ -0,0 +1,109 @@
+"""
+Measure what the map's JSON endpoints cost on the wire and in CPU.
+
+  python manage.py bench_responses [--user admin] [--repeat 20] [--url '/search/?latitude1=...']
+
+Each endpoint is requested through the full middleware stack as --user, once
+the old way (indented, uncompressed, ?pretty=1) and once the new way
+(compact). The report gives the bytes of each form and of the compact body
+gzip- and brotli-encoded, the CPU milliseconds per request of the view, and
+the CPU milliseconds of encoding the body once. Reused encodings of identical
+bodies cost nothing, so the encoding figure is the worst case. brotli is only
+measured when the package is installed.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from evalink import responses
+from evalink.models import Station
+
+ENDPOINTS = ('/features.json', '/aircraft.json', '/texts.json', '/campuses.json', '/aprs.json')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark bytes on the wire and CPU per request of the JSON endpoints, pretty vs compact and compressed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            help='Username to request as (default: the first superuser)',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=20,
+            help='Requests per endpoint and form (default: 20)',
+        )
+        parser.add_argument(
+            '--url',
+            action='append',
+            default=[],
+            help='Extra endpoint to measure, e.g. a /search/ query; may be repeated',
+        )
+
+    def handle(self, *args, **options):
+        users = get_user_model().objects
+        user = users.filter(username=options['user']).first() if options['user'] else users.filter(is_superuser=True).first()
+        if user is None:
+            raise CommandError('No such user; pass --user')
+        host = next((name for name in settings.ALLOWED_HOSTS if name != '*' and not name.startswith('.')), 'localhost')
+        client = Client(HTTP_HOST=host)
+        client.force_login(user)
+
+        urls = list(ENDPOINTS)
+        station = Station.objects.order_by('id').first()
+        if station is not None:
+            urls.append(f'/path.json?id={station.id}')
+        urls += options['url']
+
+        codings = ['gzip'] + (['br'] if responses.brotli is not None else [])
+        self.stdout.write(f'{"endpoint":<28} {"pretty B":>10} {"compact B":>10} '
+                          + ''.join(f'{coding + " B":>10}' for coding in codings)
+                          + f' {"pretty ms":>10} {"compact ms":>10} '
+                          + ''.join(f'{coding + " ms":>9}' for coding in codings))
+        before_bytes = after_bytes = 0
+        for url in urls:
+            pretty_body, pretty_ms = self.measure(client, url, True, options['repeat'])
+            compact_body, compact_ms = self.measure(client, url, False, options['repeat'])
+            if pretty_body is None or compact_body is None:
+                self.stdout.write(f'{url:<28} failed')
+                continue
+            encoded = {coding: self.encode(compact_body, coding, options['repeat']) for coding in codings}
+            self.stdout.write(
+                f'{url[:28]:<28} {len(pretty_body):>10} {len(compact_body):>10} '
+                + ''.join(f'{len(encoded[coding][0]):>10}' for coding in codings)
+                + f' {pretty_ms:>10.2f} {compact_ms:>10.2f} '
+                + ''.join(f'{encoded[coding][1]:>9.2f}' for coding in codings)
+            )
+            before_bytes += len(pretty_body)
+            after_bytes += min([len(compact_body)] + [len(body) for body, _ in encoded.values()])
+
+        if before_bytes:
+            self.stdout.write(self.style.SUCCESS(
+                f'\n{before_bytes} bytes before, {after_bytes} after ({after_bytes / before_bytes:.0%})'
+            ))
+
+    def measure(self, client, url, pretty, repeat):
+        """(identity-encoded body, CPU ms per request) of a GET, or (None, 0) if it fails."""
+        if pretty:
+            url += ('&' if '?' in url else '?') + 'pretty=1'
+        body = None
+        started = time.process_time()
+        for _ in range(repeat):
+            response = client.get(url)
+            if response.status_code != 200:
+                self.stderr.write(f'{url}: HTTP {response.status_code}')
+                return None, 0
+            body = response.content
+        return body, (time.process_time() - started) / repeat * 1000
+
+    def encode(self, body, coding, repeat):
+        """(encoded body, CPU ms per encoding) without the middleware's reuse."""
+        started = time.process_time()
+        for _ in range(repeat):
+            encoded = responses.compress(body, coding)
+        return encoded, (time.process_time() - started) / repeat * 1000
@@ -0,0 +1,89 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from evalink.models import Station, StationMeasure
+
+
+class Command(BaseCommand):
+    help = 'Convert full-features StationMeasure snapshots to typed columns plus changed properties, dropping rows that changed nothing'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count what would be converted and deleted without changing anything',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of measures to read per batch (default: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        batch_size = options['batch_size']
+
+        if dry_run:
+            self.stdout.write(
+                self.style.WARNING('DRY RUN MODE - No changes will be made')
+            )
+
+        total_updated = 0
+        total_deleted = 0
+        for station_id in Station.objects.order_by('id').values_list('id', flat=True):
+            updated, deleted = self.compact_station(station_id, dry_run, batch_size)
+            if updated or deleted:
+                self.stdout.write(f'  Station {station_id}: {updated} converted, {deleted} unchanged removed')
+            total_updated += updated
+            total_deleted += deleted
+
+        self.stdout.write(
+            self.style.SUCCESS(f'\nCompaction completed: {total_updated} converted, {total_deleted} removed')
+        )
+        if total_deleted and not dry_run:
+            self.stdout.write('Run VACUUM (FULL) on evalink_stationmeasure to return the space to the OS.')
+
+    def compact_station(self, station_id, dry_run, batch_size):
+        """Walk one station's measures in order, keeping the running state so each row becomes a delta"""
+        fields = ['features', 'latitude', 'longitude'] + list(StationMeasure.NUMERIC_PROPERTIES)
+        previous_values = None
+        previous_properties = {}
+        last_id = 0
+        updated_count = 0
+        deleted_count = 0
+
+        while True:
+            batch = list(StationMeasure.objects.filter(station_id=station_id, id__gt=last_id).order_by('id')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            to_update = []
+            to_delete = []
+            for measure in batch:
+                features = measure.features or {}
+                if 'properties' not in features:
+                    # Already compact: replay it onto the running state
+                    previous_values = {name: getattr(measure, name) for name in fields[1:]}
+                    previous_properties = {**previous_properties, **features}
+                    continue
+                values, properties = StationMeasure.readings(features)
+                changed = {k: v for k, v in properties.items() if previous_properties.get(k) != v}
+                if values == previous_values and not changed:
+                    to_delete.append(measure.id)
+                    continue
+                measure.features = changed or None
+                for name, value in values.items():
+                    setattr(measure, name, value)
+                to_update.append(measure)
+                previous_values = values
+                previous_properties = properties
+
+            if not dry_run:
+                with transaction.atomic():
+                    StationMeasure.objects.bulk_update(to_update, fields)
+                    StationMeasure.objects.filter(id__in=to_delete).delete()
+            updated_count += len(to_update)
+            deleted_count += len(to_delete)
+
+        return updated_count, deleted_count
@@ -0,0 +1,92 @@
+"""
+Show the ingest metrics of a running ingest process.
+
+  python manage.py ingest_metrics [--url http://127.0.0.1:9108/metrics] [--raw]
+
+Reads the /metrics endpoint `run_mqtt_ingest` serves on INGEST_METRICS_PORT
+and prints messages per type and outcome with their mean handling time, flush
+times and the queue figures. --raw prints the Prometheus text unchanged.
+"""
+import re
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+SAMPLE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(?P<labels>.*)\})? (?P<value>\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+class Command(BaseCommand):
+    help = 'Print ingest counters, latencies and queue figures from a running ingest process'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url',
+            default=f'http://127.0.0.1:{getattr(settings, "INGEST_METRICS_PORT", 9108)}/metrics',
+            help='Metrics endpoint to read (default: INGEST_METRICS_PORT on this host)',
+        )
+        parser.add_argument(
+            '--raw',
+            action='store_true',
+            help='Print the Prometheus text as served',
+        )
+
+    def handle(self, *args, **options):
+        request = urllib.request.Request(options['url'])
+        token = getattr(settings, 'METRICS_TOKEN', '')
+        if token:
+            request.add_header('Authorization', f'Bearer {token}')
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                text = response.read().decode()
+        except (urllib.error.URLError, OSError) as error:
+            raise CommandError(f'Could not read {options["url"]}: {error}')
+
+        if options['raw']:
+            self.stdout.write(text, ending='')
+            return
+        self.report(parse(text))
+
+    def report(self, samples):
+        outcomes = defaultdict(lambda: defaultdict(float))
+        for labels, value in samples.get('evalink_ingest_messages_total', []):
+            outcomes[labels['type']][labels['outcome']] += value
+        seconds = {labels['type']: value for labels, value in samples.get('evalink_ingest_seconds_sum', [])}
+        columns = sorted({outcome for counts in outcomes.values() for outcome in counts})
+
+        self.stdout.write(f'{"type":<10} {"msgs":>8} {"mean ms":>8} ' + ' '.join(f'{column:>22}' for column in columns))
+        for kind, counts in sorted(outcomes.items()):
+            total = sum(counts.values())
+            mean = seconds.get(kind, 0) / total * 1000 if total else 0
+            self.stdout.write(f'{kind:<10} {total:>8.0f} {mean:>8.2f} '
+                              + ' '.join(f'{counts.get(column, 0):>22.0f}' for column in columns))
+
+        flushes = _value(samples, 'evalink_ingest_flush_seconds_count')
+        if flushes:
+            mean = _value(samples, 'evalink_ingest_flush_seconds_sum') / flushes * 1000
+            self.stdout.write(f'\n{flushes:.0f} flushes, {mean:.1f} ms mean database time')
+        skipped = samples.get('evalink_ingest_rows_skipped_total', [])
+        if skipped:
+            self.stdout.write('duplicate rows skipped: ' + ', '.join(f'{labels["model"]} {value:.0f}' for labels, value in skipped))
+        self.stdout.write(f'queue depth {_value(samples, "evalink_ingest_queue_depth"):.0f}, '
+                          f'retries pending {_value(samples, "evalink_ingest_retry_pending"):.0f}')
+
+
+def parse(text):
+    """{metric name: [(labels, value), ...]} from Prometheus text."""
+    samples = defaultdict(list)
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match is None:
+            continue
+        labels = {key: value.replace('\\"', '"').replace('\\n', '\n').replace('\\\\', '\\')
+                  for key, value in LABEL.findall(match['labels'] or '')}
+        samples[match['name']].append((labels, float(match['value'])))
+    return samples
+
+
+def _value(samples, name):
+    return sum(value for _, value in samples.get(name, []))
@@ -0,0 +1,69 @@
+"""
+Feed stored dead letters back through the MQTT handler.
+
+  python manage.py replay_dead_letters [--topic SUBSTRING] [--limit N]
+
+Letters are deleted once the rows they produced are written, a chunk at a
+time; a letter that fails keeps its row with the new error and one more
+attempt counted, and if writing a chunk fails all its letters are kept.
+"""
+from django.core.management.base import BaseCommand
+
+from evalink import handler, pipeline
+from evalink.models import DeadLetter
+
+
+class Command(BaseCommand):
+    help = 'Reprocess MQTT messages stored in the dead-letter table'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--topic',
+            help='Only replay messages whose topic contains this text',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Replay at most this many messages, oldest first',
+        )
+
+    def handle(self, *args, **options):
+        letters = DeadLetter.objects.order_by('id')
+        if options['topic']:
+            letters = letters.filter(topic__contains=options['topic'])
+        if options['limit'] is not None:
+            letters = letters[:options['limit']]
+
+        # ids first: a failed replay may drop the connection, which would end a server-side cursor
+        ids = list(letters.values_list('id', flat=True))
+        replayed = 0
+        failed = 0
+        with pipeline.writer.replaying():
+            for start in range(0, len(ids), pipeline.CHUNK_SIZE):
+                chunk = ids[start:start + pipeline.CHUNK_SIZE]
+                failures = pipeline.writer.failures
+                done = [letter.id for letter in DeadLetter.objects.filter(id__in=chunk).order_by('id') if self.replay(letter)]
+                # mesh messages are queued on the write-behind buffer; a letter is only done once they are written
+                pipeline.writer.flush()
+                if pipeline.writer.failures != failures:
+                    self.stdout.write(self.style.WARNING(f'  writing the rows failed; keeping {len(done)} letters'))
+                    done = []
+                DeadLetter.objects.filter(id__in=done).delete()
+                replayed += len(done)
+                failed += len(chunk) - len(done)
+
+        self.stdout.write(self.style.SUCCESS(f'\nReplay completed: {replayed} replayed, {failed} still failing'))
+
+    def replay(self, letter):
+        """Dispatch one letter, or count the attempt if that fails. Returns whether it worked."""
+        try:
+            handler.dispatch(letter.topic, bytes(letter.payload))
+        except Exception as error:
+            pipeline.recover_connection()
+            letter.attempts += 1
+            letter.error = str(error)
+            letter.save(update_fields=['attempts', 'error', 'updated_at'])
+            self.stdout.write(self.style.WARNING(f'  {letter.id} {letter.topic}: {error}'))
+            return False
+        return True
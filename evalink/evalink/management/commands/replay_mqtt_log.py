@@ -0,0 +1,114 @@
+"""
+Feed archived MQTT traffic back through the handler as fast as it will go.
+
+  python manage.py replay_mqtt_log [PATH ...] [--since ISO] [--until ISO] [--topic SUBSTRING]
+
+PATH is an archive file or directory; the default is MQTT_ARCHIVE_DIR. Use it
+to rebuild derived tables after a schema change or handler fix, or to measure
+ingest speed on real mission traffic. Run it with the live subscriber stopped
+or pointed at another database, since both would write the same stations.
+"""
+import os
+import time
+import traceback
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from evalink import handler, pipeline, raw_archive
+
+
+class Command(BaseCommand):
+    help = 'Replay raw MQTT archive files through handler.dispatch'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='*',
+            help='Archive files or directories (default: MQTT_ARCHIVE_DIR)',
+        )
+        parser.add_argument(
+            '--since',
+            type=datetime.fromisoformat,
+            help='Skip messages received before this ISO time (naive means UTC)',
+        )
+        parser.add_argument(
+            '--until',
+            type=datetime.fromisoformat,
+            help='Stop at messages received after this ISO time (naive means UTC)',
+        )
+        parser.add_argument(
+            '--topic',
+            help='Only replay messages whose topic contains this text',
+        )
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or [getattr(settings, 'MQTT_ARCHIVE_DIR', '')]
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(raw_archive.files(path))
+            elif os.path.isfile(path):
+                files.append(path)
+            else:
+                raise CommandError(f'No archive at {path!r}')
+        since = _epoch(options['since'])
+        until = _epoch(options['until'])
+        topic_filter = options['topic']
+
+        replayed = 0
+        failed = 0
+        # dispatched since the last flush; they only count as replayed once it succeeds
+        pending = 0
+        started = time.perf_counter()
+        self.failures = pipeline.writer.failures
+        with pipeline.writer.replaying():
+            for path in files:
+                self.stdout.write(f'  {path}')
+                for received_at, topic, payload in raw_archive.read(path):
+                    if since is not None and received_at < since:
+                        continue
+                    if until is not None and received_at > until:
+                        break
+                    if topic_filter and topic_filter not in topic:
+                        continue
+                    try:
+                        handler.dispatch(topic, payload)
+                        pending += 1
+                    except Exception as error:
+                        failed += 1
+                        if failed <= 10:
+                            self.stderr.write(f'  {topic}: {error} {traceback.format_exc(limit=3)}')
+                        pipeline.recover_connection()
+                    if pending >= pipeline.CHUNK_SIZE:
+                        replayed, failed, pending = self.flush(replayed, failed, pending)
+            replayed, failed, _ = self.flush(replayed, failed, pending)
+        elapsed = time.perf_counter() - started
+
+        rate = replayed / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'\nReplay completed: {replayed} replayed, {failed} failed in {elapsed:.1f}s ({rate:.0f} msgs/sec)'
+        ))
+
+    def flush(self, replayed, failed, pending):
+        """
+        Write what the pending messages queued; returns the counts with them
+        added as replayed, or as failed if this or any flush since the last
+        one failed.
+        """
+        # mesh messages are queued on the write-behind buffer
+        pipeline.writer.flush()
+        failures, self.failures = self.failures, pipeline.writer.failures
+        if self.failures != failures:
+            self.stderr.write(f'  writing the rows of {pending} messages failed')
+            return replayed, failed + pending, 0
+        return replayed + pending, failed, 0
+
+
+def _epoch(moment):
+    if moment is None:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
@@ -0,0 +1,58 @@
+"""
+Run the MQTT subscriber as a dedicated ingest process.
+
+  python manage.py run_mqtt_ingest
+
+Set MQTT_INGEST_IN_WEB=0 for the web (Gunicorn) processes so this is the only
+subscriber; otherwise every web worker processes the same messages again.
+Uses the same MQTT_* and CAMPUS settings as the web app. Ingest metrics are
+served at http://INGEST_METRICS_HOST:INGEST_METRICS_PORT/metrics, localhost
+only by default and behind METRICS_TOKEN when it is set (--metrics-port 0
+turns that off).
+"""
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from evalink import metrics, mqtt
+
+
+class Command(BaseCommand):
+    help = 'Subscribe to the MQTT uplink topics and ingest messages in the foreground'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--metrics-port',
+            type=int,
+            default=getattr(settings, 'INGEST_METRICS_PORT', 9108),
+            help='Port to serve /metrics on, 0 for none (default: INGEST_METRICS_PORT)',
+        )
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'MQTT_ENABLED', True):
+            self.stderr.write(self.style.ERROR('MQTT is disabled (MQTT_ENABLED = False).'))
+            return
+
+        client = mqtt.client
+        if client is None:
+            client = mqtt.connect()
+        else:
+            # The import-time subscriber is already running in this process;
+            # take over its network loop rather than opening a second session.
+            self.stdout.write(self.style.WARNING(
+                'MQTT_INGEST_IN_WEB is enabled, so web workers are ingesting too. '
+                'Set MQTT_INGEST_IN_WEB=0 for the web processes.'
+            ))
+            client.loop_stop()
+
+        if options['metrics_port']:
+            host = getattr(settings, 'INGEST_METRICS_HOST', '127.0.0.1')
+            metrics.serve(options['metrics_port'], host, getattr(settings, 'METRICS_TOKEN', ''))
+            self.stdout.write('Serving ingest metrics on %s:%s' % (host, options['metrics_port']))
+        self.stdout.write('Ingesting %s from %s:%s' % (
+            os.getenv('MQTT_TOPIC'), os.getenv('MQTT_SERVER'), os.getenv('MQTT_PORT')))
+        try:
+            client.loop_forever(retry_first_connection=True)
+        except KeyboardInterrupt:
+            client.disconnect()
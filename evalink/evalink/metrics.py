@@ -0,0 +1,163 @@
+"""
+In-process ingest metrics in the Prometheus text format.
+
+handler.dispatch counts every message by type, gateway and outcome and times
+it, mqtt.on_message counts what arrives per topic root and pipeline times each
+flush. Queue depth, dedup, dead-letter and skipped-row figures are read from
+their modules when the metrics are rendered. The web process serves them at
+/metrics; a dedicated `run_mqtt_ingest` process serves them on
+INGEST_METRICS_PORT, and `manage.py ingest_metrics` prints them from there.
+"""
+import bisect
+import collections
+import hmac
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds; a cached message takes well under a millisecond, a flush tens of them
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# outcomes of handler.dispatch
+STORED = 'stored'
+INSIDE_FENCE = 'filtered_inside_fence'
+THINNED = 'filtered_track'
+OUTSIDE_CAMPUS = 'filtered_outside_campus'
+DUPLICATE = 'duplicate'
+UNKNOWN_STATION = 'unknown_station'
+IGNORED = 'ignored'
+ERROR = 'error'
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels=''):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}'
+        suffix = f'{{{labels}}}' if labels else ''
+        yield f'{name}_sum{suffix} {self.sum:.6f}'
+        yield f'{name}_count{suffix} {cumulative}'
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (type, gateway, outcome) -> messages
+        self.messages = collections.Counter()
+        # type -> Histogram of handler.dispatch seconds
+        self.latency = collections.defaultdict(Histogram)
+        # topic root -> messages / bytes received from the broker
+        self.received = collections.Counter()
+        self.received_bytes = collections.Counter()
+        self.flushes = Histogram()
+        # model name -> rows written by pipeline flushes
+        self.written = collections.Counter()
+
+    def observe(self, message_type, gateway, outcome, seconds):
+        with self.lock:
+            self.messages[(message_type, gateway, outcome)] += 1
+            self.latency[message_type].observe(seconds)
+
+    def receive(self, topic, size):
+        root = topic.split('/')[0]
+        with self.lock:
+            self.received[root] += 1
+            self.received_bytes[root] += size
+
+    def observe_flush(self, seconds, written):
+        with self.lock:
+            self.flushes.observe(seconds)
+            self.written.update(written)
+
+    def render(self):
+        """All metrics, in the Prometheus text exposition format."""
+        # imported here: these modules record into `registry` themselves
+        from evalink import deadletter, dedup, ingest_queue, pipeline
+
+        out = []
+        with self.lock:
+            out += _family('evalink_mqtt_messages_received_total', 'counter', 'Messages received from the broker',
+                           ((f'root="{_escape(root)}"', count) for root, count in sorted(self.received.items())))
+            out += _family('evalink_mqtt_bytes_received_total', 'counter', 'Payload bytes received from the broker',
+                           ((f'root="{_escape(root)}"', count) for root, count in sorted(self.received_bytes.items())))
+            out += _family('evalink_ingest_messages_total', 'counter', 'Messages handled, by type, gateway and outcome',
+                           ((f'type="{_escape(kind)}",gateway="{_escape(gateway)}",outcome="{outcome}"', count)
+                            for (kind, gateway, outcome), count in sorted(self.messages.items())))
+            out += ['# HELP evalink_ingest_seconds Time handling one message, by type',
+                    '# TYPE evalink_ingest_seconds histogram']
+            for kind, histogram in sorted(self.latency.items()):
+                out += histogram.lines('evalink_ingest_seconds', f'type="{_escape(kind)}"')
+            out += ['# HELP evalink_ingest_flush_seconds Time writing one write-behind batch to the database',
+                    '# TYPE evalink_ingest_flush_seconds histogram']
+            out += self.flushes.lines('evalink_ingest_flush_seconds')
+            out += _family('evalink_ingest_rows_written_total', 'counter', 'Rows written by write-behind flushes',
+                           ((f'model="{model}"', count) for model, count in sorted(self.written.items())))
+
+        out += _family('evalink_ingest_rows_skipped_total', 'counter', 'Rows dropped at insert as duplicates of stored rows',
+                       ((f'model="{model}"', count) for model, count in sorted(pipeline.writer.stats().items())))
+        queue_stats = ingest_queue.queue.stats()
+        out += _family('evalink_ingest_queue_depth', 'gauge', 'Messages waiting for an ingest worker',
+                       [('', queue_stats.pop('depth'))])
+        out += _family('evalink_ingest_queue', 'gauge', 'Ingest queue high water mark, spilled backlog and overflow counters',
+                       ((f'stat="{name}"', value) for name, value in sorted(queue_stats.items())))
+        dedup_stats = dedup.recent.stats()
+        out += _family('evalink_ingest_gateway_packets_total', 'counter', 'Mesh packets per gateway, first copies and duplicates',
+                       ((f'gateway="{_escape(gateway)}",copy="{copy}"', counts[copy])
+                        for gateway, counts in dedup_stats.items() for copy in ('accepted', 'duplicates')))
+        out += _family('evalink_ingest_retry_pending', 'gauge', 'Failed messages waiting for a retry',
+                       [('', deadletter.retrier.stats()['pending'])])
+        return '\n'.join(out) + '\n'
+
+
+def _family(name, kind, help_text, samples):
+    yield f'# HELP {name} {help_text}'
+    yield f'# TYPE {name} {kind}'
+    for labels, value in samples:
+        yield f'{name}{{{labels}}} {value}' if labels else f'{name} {value}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        token = self.server.token
+        if token and not hmac.compare_digest(self.headers.get('Authorization', ''), f'Bearer {token}'):
+            self.send_error(401)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1', token=''):
+    """
+    Serve /metrics from this process on a daemon thread; returns the server.
+    With a token, requests need "Authorization: Bearer <token>".
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.token = token
+    threading.Thread(target=server.serve_forever, name='ingest-metrics', daemon=True).start()
+    return server
+
+
+registry = Registry()
@@ -0,0 +1,93 @@
+# Generated by Django 4.2.16 on 2026-10-18 16:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evalink', '0040_aircraftpositionlog_aircraft_lat_lon_minute_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='altitude',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='barometric_pressure',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='battery_level',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='current',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='ground_speed',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='ground_track',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='latitude',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='longitude',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='relative_humidity',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='temperature',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='voltage',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='wind_direction',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='wind_gust',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='wind_lull',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='stationmeasure',
+            name='wind_speed',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='stationmeasure',
+            name='features',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
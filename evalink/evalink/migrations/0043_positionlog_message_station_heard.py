@@ -0,0 +1,34 @@
+# Generated by Django 4.2.16 on 2026-10-18 16:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evalink', '0042_deadletter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='station',
+            name='last_heard_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # Positions were never written with a message id before, but clear any
+        # duplicates so the constraint can be created.
+        migrations.RunSQL(
+            """
+            UPDATE evalink_positionlog AS p SET message_id = NULL
+            WHERE p.message_id IS NOT NULL AND EXISTS (
+                SELECT 1 FROM evalink_positionlog AS q
+                WHERE q.station_id = p.station_id AND q.message_id = p.message_id AND q.id < p.id
+            )
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='positionlog',
+            constraint=models.UniqueConstraint(fields=('station', 'message_id'), name='unique_positionlog_station_message'),
+        ),
+    ]
@@ -37,15 +37,57 @@ class Station(models.Model):
     hardware_node = models.CharField(max_length=64, db_index=True, null=False)
     hardware_number = models.BigIntegerField(db_index=True, unique=True)
     updated_at = models.DateTimeField(null=False, db_index=True, auto_now=True)
+    # receive time of the newest message applied to this row; older ones must not overwrite it
+    last_heard_at = models.DateTimeField(null=True, blank=True)
     station_type = models.CharField(max_length=255)
     def outside(self, fence):
         return self.last_position and fence.outside(self.last_position.latitude, self.last_position.longitude)
 
 class StationMeasure(models.Model):
+    """Station readings as typed columns; features only holds the other properties that changed since the previous measure."""
+    NUMERIC_PROPERTIES = ('altitude', 'ground_speed', 'ground_track', 'temperature', 'relative_humidity', 'barometric_pressure',
+                          'wind_direction', 'wind_speed', 'wind_gust', 'wind_lull', 'battery_level', 'voltage', 'current')
+    # chat history lives in TextLog and time changes with every message
+    SKIPPED_PROPERTIES = ('texts', 'time')
     station = models.ForeignKey(Station, on_delete=models.CASCADE, null=False, db_index=True)
-    features = models.JSONField(null=False, blank=False)
+    features = models.JSONField(null=True, blank=True)
+    latitude = models.FloatField(null=True)
+    longitude = models.FloatField(null=True)
+    altitude = models.FloatField(null=True)
+    ground_speed = models.FloatField(null=True)
+    ground_track = models.FloatField(null=True)
+    temperature = models.FloatField(null=True)
+    relative_humidity = models.FloatField(null=True)
+    barometric_pressure = models.FloatField(null=True)
+    wind_direction = models.FloatField(null=True)
+    wind_speed = models.FloatField(null=True)
+    wind_gust = models.FloatField(null=True)
+    wind_lull = models.FloatField(null=True)
+    battery_level = models.FloatField(null=True)
+    voltage = models.FloatField(null=True)
+    current = models.FloatField(null=True)
     updated_at = models.DateTimeField(null=False, db_index=True, auto_now=True)
 
+    @classmethod
+    def readings(cls, features):
+        """Split station GeoJSON features into ({column: float}, {property: value}) for the other properties."""
+        features = features or {}
+        properties = features.get('properties') or {}
+        coordinates = (features.get('geometry') or {}).get('coordinates') or [None, None]
+        values = {'longitude': _as_float(coordinates[0]), 'latitude': _as_float(coordinates[1])}
+        for name in cls.NUMERIC_PROPERTIES:
+            values[name] = _as_float(properties.get(name))
+        others = {k: v for k, v in properties.items() if k not in cls.NUMERIC_PROPERTIES and k not in cls.SKIPPED_PROPERTIES}
+        return values, others
+
+def _as_float(value):
+    try:
+        if value is None:
+            return None
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
 class PositionLog(models.Model):
     message_id = models.BigIntegerField(db_index=True, null=True)
     station = models.ForeignKey(Station, on_delete=models.CASCADE, db_index=True)
@@ -59,6 +101,12 @@ class PositionLog(models.Model):
     updated_at = models.DateTimeField(null=False, db_index=True, auto_now=True)
     updated_on = models.DateField(null=True, db_index=True)
 
+    class Meta:
+        constraints = [
+            # the same packet heard by several gateways or consumers is one row
+            models.UniqueConstraint(fields=['station', 'message_id'], name='unique_positionlog_station_message'),
+        ]
+
 class AircraftPositionLog(models.Model):
     message_id = models.BigIntegerField(db_index=True, null=True)
     aircraft = models.ForeignKey('Aircraft', on_delete=models.CASCADE, db_index=True)
@@ -223,6 +271,16 @@ class Aircraft(models.Model):
     updated_on = models.DateField(null=True, db_index=True)
 
 
+class DeadLetter(models.Model):
+    """An MQTT message the handler still failed on after its retries; see `manage.py replay_dead_letters`."""
+    topic = models.CharField(max_length=255, db_index=True)
+    payload = models.BinaryField()
+    error = models.TextField()
+    attempts = models.IntegerField(default=0)
+    created_at = models.DateTimeField(null=False, db_index=True, auto_now_add=True)
+    updated_at = models.DateTimeField(null=False, db_index=True, auto_now=True)
+
+
 class APRSPosition(models.Model):
     """Cache of last-seen APRS positions from the background feed (run_aprs_feed)."""
     callsign = models.CharField(max_length=32, db_index=True, unique=True)
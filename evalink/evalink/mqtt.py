@@ -1,61 +1,29 @@
 import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
-from django import db
-from django.db import IntegrityError
-import time
 import os
-import json
-from . import handler
-import traceback
+from . import handler, ingest_queue, raw_archive, metrics
 from django.conf import settings
 
 def on_connect(client, _userdata, _flags, _rc):
-    client.subscribe(f'{os.getenv("MQTT_TOPIC")}/+/json/#')
-    client.subscribe(f'{os.getenv("MQTT_TOPIC")}/aircraft/+')
+    # With a share group the broker hands each message to one ingest process of the group
+    group = getattr(settings, 'MQTT_SHARE_GROUP', '')
+    prefix = f'$share/{group}/' if group else ''
+    for root in handler.topic_roots():
+        client.subscribe(f'{prefix}{root}/+/json/#')
+        client.subscribe(f'{prefix}{root}/aircraft/+')
 
 def on_disconnect(client, _userdata, _rc):
     pass #print("on_disconnect?")
 
 def on_message(_client, _userdata, msg):
-    # Handle aircraft messages
-    aircraft_topic_prefix = f'{os.getenv("MQTT_TOPIC")}/aircraft/'
-    if msg.topic.startswith(aircraft_topic_prefix):
-        try:
-            hex_code = msg.topic.split('/')[-1]
-            message = json.loads(msg.payload)
-            handler.process_aircraft(hex_code, message)
-        except IntegrityError as error:
-            if 'unique_aircraftpositionlog_aircraft_lat_lon_minute' in str(error):
-                return
-            print(f'handler failed to process aircraft {msg.topic}: {error} {traceback.print_tb(error.__traceback__)}')
-            db.close_old_connections()
-            time.sleep(1)
-        except Exception as error:
-            print(f'handler failed to process aircraft {msg.topic}: {error} {traceback.print_tb(error.__traceback__)}')
-            db.close_old_connections()
-            time.sleep(1)
-        return
-    
-    # Handle regular messages
-    message = json.loads(msg.payload)
-    if not verify(message, 'type'): return
-    if not verify(message, 'payload'): return
-    if not verify(message, 'timestamp'): return
-    if not verify(message, 'from'): return
-    try:
-        handler.process_message(message)
-    except Exception as error:
-        print(f'handler failed to process {message}: {error} {traceback.print_tb(error.__traceback__)}')
-        db.close_old_connections()
-        time.sleep(1)
+    metrics.registry.receive(msg.topic, len(msg.payload))
+    if raw_archive.archive is not None:
+        raw_archive.archive.append(msg.topic, msg.payload)
+    # Database work happens on the ingest_queue worker; never block the network loop here
+    ingest_queue.queue.put(msg.topic, msg.payload)
 
-def verify(message, field):
-    return field in message
-
-load_dotenv()
-
-# Only create MQTT client if not in test mode
-if not hasattr(settings, 'MQTT_ENABLED') or settings.MQTT_ENABLED:
+def connect():
+    """Create a client with the ingest callbacks and connect it to the broker."""
     client = mqtt.Client()
     client.on_connect = on_connect
     client.on_message = on_message
@@ -63,6 +31,14 @@ if not hasattr(settings, 'MQTT_ENABLED') or settings.MQTT_ENABLED:
     if os.getenv('MQTT_TLS'): client.tls_set()
     client.username_pw_set(username=os.getenv('MQTT_USER'), password=os.getenv('MQTT_PASSWORD'))
     client.connect(os.getenv('MQTT_SERVER'), int(os.getenv('MQTT_PORT')), 60)
+    return client
+
+load_dotenv()
+
+# Web workers subscribe at import time unless MQTT_INGEST_IN_WEB is off, in which
+# case a single `manage.py run_mqtt_ingest` process owns ingest. Tests set
+# MQTT_ENABLED = False so no client is created at all.
+if getattr(settings, 'MQTT_ENABLED', True) and getattr(settings, 'MQTT_INGEST_IN_WEB', True):
+    client = connect()
 else:
-    # Create a mock client for tests
-    client = None
\ No newline at end of file
+    client = None
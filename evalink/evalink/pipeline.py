@@ -0,0 +1,434 @@
+"""
+Write-behind buffer for the MQTT ingest path.
+
+handler.process_message applies each message to an in-memory Station and hands
+the rows it produces to `writer`. Rows are written with a few multi-row
+statements once INGEST_BATCH_SIZE messages are queued or INGEST_FLUSH_MS has
+passed, instead of several single-row commits per message. Stations change
+with nearly every message, so they are coalesced for longer: each dirty
+station is written once per STATION_FLUSH_MS, sending only the features keys
+that changed since this process last wrote it.
+
+If a flush fails, the raw messages behind everything it would have written go
+to deadletter.retrier, and the cached stations, whose last_position may be a
+row that was never inserted, are dropped so the retries start from the
+database.
+"""
+import atexit
+import collections
+import contextlib
+import copy
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from evalink import features_cache, ingest_cache, metrics, track_filter
+from evalink.models import PositionLog, TelemetryLog, TextLog, StationMeasure, Station
+
+# Insert order matters: telemetry and text rows point at position rows created
+# in the same batch, and stations point at their new last_position.
+ROW_MODELS = (PositionLog, TelemetryLog, TextLog, StationMeasure)
+# Duplicate mesh ids are dropped by the unique message_id/serial_number columns
+# (INSERT ... ON CONFLICT DO NOTHING) and counted in WriteBehind.skipped.
+IGNORE_CONFLICTS = (TelemetryLog, TextLog)
+# Positions are upserted on (station, message id) instead, because the rows
+# pointing at a duplicate still need its id.
+UPSERT_COLUMNS = {PositionLog: ('station_id', 'message_id')}
+# Station values sent on flush, with their types for the VALUES list. `features`
+# is the whole document for a station's first write; after that `top` and
+# `properties` hold only the keys that changed.
+STATION_COLUMNS = (('id', 'bigint'), ('name', 'varchar'), ('features', 'jsonb'), ('top', 'jsonb'), ('properties', 'jsonb'),
+                   ('last_position_id', 'bigint'), ('updated_at', 'timestamptz'), ('last_heard_at', 'timestamptz'))
+# Rows per statement; well under Postgres' 65535 parameter limit.
+CHUNK_SIZE = 1000
+# telemetry and text rows remembered by recently_queued()
+RECENT_ROWS = 10000
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    def __init__(self, batch_size, flush_ms, station_flush_ms=0):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_ms / 1000.0
+        self.station_interval = station_flush_ms / 1000.0
+        # guards the buffers below; flushing keeps flushes apart, see flush()
+        self.lock = threading.RLock()
+        self.flushing = threading.Lock()
+        # the message the current thread is handling, see receiving()
+        self.current = threading.local()
+        self.thread = None
+        self.stations_flushed_at = time.monotonic()
+        # station id -> features as last written by this process, to send deltas against
+        self.written = {}
+        # hardware number -> Station of the flush in progress
+        self.in_flight = {}
+        # model name -> rows dropped as duplicates of stored rows
+        self.skipped = collections.Counter()
+        # flushes that failed; their messages go to the retrier unless replaying()
+        self.failures = 0
+        self.retry_failed = True
+        # (model, station id, message id) of the last RECENT_ROWS telemetry and text rows queued
+        self.recent = collections.OrderedDict()
+        self._reset_rows()
+        self._reset_stations()
+
+    def _reset_rows(self):
+        self.rows = {model: [] for model in ROW_MODELS}
+        self.messages = 0
+
+    def _reset_stations(self):
+        self.stations = {}
+        self.snapshots = {}
+        # (topic, payload, attempts) of every message queued since the
+        # last station flush; their rows may be written, their stations are not
+        self.sources = []
+
+    @contextlib.contextmanager
+    def receiving(self, topic, payload, attempts=0):
+        """Attribute what add() queues on this thread to a raw message, so a failed flush can retry it."""
+        self.current.source = (topic, payload, attempts)
+        try:
+            yield
+        finally:
+            self.current.source = None
+
+    @contextlib.contextmanager
+    def replaying(self):
+        """
+        Keep the messages of failed flushes away from the retrier, whose thread
+        dies with a management command; the command compares `failures` before
+        and after its own flush and keeps what it replayed if one failed.
+        """
+        self.retry_failed = False
+        try:
+            yield
+        finally:
+            self.retry_failed = True
+
+    def station(self, number):
+        """Return the queued Station for a hardware number; it is newer than the database row."""
+        with self.lock:
+            return self.stations.get(number) or self.in_flight.get(number)
+
+    def add(self, station, *rows):
+        """Queue the station update and rows produced by one message."""
+        with self.lock:
+            source = getattr(self.current, 'source', None)
+            if source is not None:
+                self.sources.append(source)
+            self.stations[station.hardware_number] = station
+            # the handler keeps changing `station` on its own thread while a flush
+            # serializes it, so what gets written is a copy taken here
+            self.snapshots[station.hardware_number] = Station(
+                id=station.id,
+                name=station.name,
+                features=copy.deepcopy(station.features),
+                last_position=station.last_position,
+                updated_at=station.updated_at,
+                last_heard_at=station.last_heard_at,
+            )
+            for row in rows:
+                if row is not None:
+                    self.rows[type(row)].append(row)
+                    if type(row) in IGNORE_CONFLICTS:
+                        self._remember(row)
+            self.messages += 1
+            due = self.messages >= self.batch_size
+            if not due and self.thread is None and self.flush_interval > 0:
+                self.thread = threading.Thread(target=self._run, name='ingest-flush', daemon=True)
+                self.thread.start()
+        if due:
+            self.flush(stations=self._stations_due())
+
+    def _remember(self, row):
+        key = (type(row), row.station_id, row.message_id if type(row) is TelemetryLog else row.serial_number)
+        if key[2] is None:
+            return
+        self.recent[key] = True
+        self.recent.move_to_end(key)
+        while len(self.recent) > RECENT_ROWS:
+            self.recent.popitem(last=False)
+
+    def recently_queued(self, model, station_id, message_id):
+        """True if this process queued the telemetry or text row of a mesh message lately, flushed or not."""
+        with self.lock:
+            return (model, station_id, message_id) in self.recent
+
+    def _stations_due(self):
+        return time.monotonic() - self.stations_flushed_at >= self.station_interval
+
+    def flush(self, stations=True):
+        """
+        Write the queued rows, and the dirty stations too unless stations=False.
+        The lock is only held to take the buffers, so handler threads keep
+        queueing while the statements run; the stations being written stay
+        visible through station() until they are. Flushes run one at a time.
+        """
+        with self.flushing:
+            with self.lock:
+                snapshots = list(self.snapshots.values()) if stations else []
+                if not self.messages and not snapshots:
+                    return
+                rows = self.rows
+                # without stations, self.sources stays queued and is read again on failure
+                sources = self.sources if stations else []
+                dirty = [snapshot.id for snapshot in self.snapshots.values()]
+                self._reset_rows()
+                if stations:
+                    self.in_flight = self.stations
+                    self._reset_stations()
+                    self.stations_flushed_at = time.monotonic()
+            try:
+                skipped = collections.Counter()
+                written = collections.Counter()
+                started = time.perf_counter()
+                with transaction.atomic():
+                    for model in ROW_MODELS:
+                        if not rows[model]:
+                            continue
+                        if model in UPSERT_COLUMNS:
+                            stored = upsert(model, rows[model], UPSERT_COLUMNS[model])
+                        elif model in IGNORE_CONFLICTS:
+                            stored = insert_ignore(model, rows[model])
+                        else:
+                            stored = len(model.objects.bulk_create(rows[model]))
+                        written[model.__name__] = stored
+                        if stored < len(rows[model]):
+                            skipped[model.__name__] = len(rows[model]) - stored
+                    update_stations(snapshots, self.written)
+                written[Station.__name__] = len(snapshots)
+                metrics.registry.observe_flush(time.perf_counter() - started, written)
+                if snapshots:
+                    features_cache.bump()
+                if skipped:
+                    with self.lock:
+                        self.skipped.update(skipped)
+                    print('ingest flush skipped duplicates ' + ' '.join(f'{name}={count}' for name, count in skipped.items()))
+            except Exception as error:
+                recover_connection()
+                with self.lock:
+                    # messages queued meanwhile built on the stations that were not written
+                    sources = sources + self.sources
+                    dirty += [snapshot.id for snapshot in self.snapshots.values()]
+                    logger.exception('ingest flush of %d rows and %d stations failed; retrying %d messages',
+                                     sum(len(queued) for queued in rows.values()), len(snapshots), len(sources))
+                    self.failures += 1
+                    for station_id in dirty:
+                        self.written.pop(station_id, None)
+                    self._reset_rows()
+                    self._reset_stations()
+                    self._retry(sources, dirty, error)
+            finally:
+                with self.lock:
+                    self.in_flight = {}
+
+    def _retry(self, sources, stations, error):
+        """Hand the messages of a failed flush to the retrier, starting them over from the database."""
+        # imported here: these modules import pipeline
+        from evalink import deadletter, handler
+
+        # cached stations and measures were changed by messages that were never written
+        ingest_cache.invalidate_stations()
+        handler.measured.clear()
+        # the track filter took their fixes as stored; a retried fix would be held back as a repeat of itself
+        for station_id in stations:
+            track_filter.tracks.pop(station_id, None)
+        if not self.retry_failed:
+            return
+        for topic, payload, attempts in sources:
+            deadletter.retrier.push(topic, payload, error, attempts + 1)
+
+    def stats(self):
+        """{model name: duplicate rows skipped} since start."""
+        with self.lock:
+            return dict(self.skipped)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush(stations=self._stations_due())
+
+
+def recover_connection():
+    """
+    After a database error, drop the connection if it is broken or past
+    CONN_MAX_AGE, like close_old_connections, but never inside a transaction,
+    where closing it would break the caller's atomic block.
+    """
+    if not connection.in_atomic_block:
+        connection.close_if_unusable_or_obsolete()
+
+
+def upsert(model, objs, unique):
+    """
+    INSERT ... ON CONFLICT (unique) DO UPDATE ... RETURNING id, so duplicates get
+    the stored row's id. Returns how many of `objs` were new rows.
+    """
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    first = {}
+    distinct = []
+    for obj in objs:
+        key = tuple(getattr(obj, column) for column in unique)
+        if None in key:
+            distinct.append(obj)
+        else:
+            # Postgres refuses to update one row twice in a statement
+            first.setdefault(key, obj)
+            if first[key] is obj:
+                distinct.append(obj)
+
+    _prepare_related(distinct)
+    qn = connection.ops.quote_name
+    placeholders = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    inserted = 0
+    for start in range(0, len(distinct), CHUNK_SIZE):
+        chunk = distinct[start:start + CHUNK_SIZE]
+        params = [field.get_db_prep_save(field.pre_save(obj, True), connection) for obj in chunk for field in fields]
+        sql = (
+            f'INSERT INTO {qn(model._meta.db_table)} ({", ".join(qn(field.column) for field in fields)}) '
+            f'VALUES {", ".join([placeholders] * len(chunk))} '
+            f'ON CONFLICT ({", ".join(qn(column) for column in unique)}) '
+            f'DO UPDATE SET {qn("updated_at")} = EXCLUDED.{qn("updated_at")} '
+            # xmax is only set on the stored row when the conflict branch updated it
+            f'RETURNING {qn(model._meta.pk.column)}, xmax = 0'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            returned = cursor.fetchall()
+        ids = [row[0] for row in returned]
+        inserted += sum(1 for row in returned if row[1])
+        for obj, pk in zip(chunk, ids):
+            obj.pk = pk
+            obj._state.adding = False
+            obj._state.db = connection.alias
+    for obj in objs:
+        if obj.pk is None:
+            obj.pk = first[tuple(getattr(obj, column) for column in unique)].pk
+    return inserted
+
+
+def insert_ignore(model, objs):
+    """
+    INSERT ... ON CONFLICT DO NOTHING; rows clashing with a unique column are
+    dropped without an error. Returns how many rows were inserted. The new rows
+    do not get their ids back, like bulk_create(ignore_conflicts=True).
+    """
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    _prepare_related(objs)
+    qn = connection.ops.quote_name
+    placeholders = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    inserted = 0
+    for start in range(0, len(objs), CHUNK_SIZE):
+        chunk = objs[start:start + CHUNK_SIZE]
+        params = [field.get_db_prep_save(field.pre_save(obj, True), connection) for obj in chunk for field in fields]
+        sql = (
+            f'INSERT INTO {qn(model._meta.db_table)} ({", ".join(qn(field.column) for field in fields)}) '
+            f'VALUES {", ".join([placeholders] * len(chunk))} '
+            f'ON CONFLICT DO NOTHING'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            inserted += cursor.rowcount
+    return inserted
+
+
+def _prepare_related(objs):
+    """
+    Copy the pk of each related object into its foreign key column, as
+    bulk_create does: a row queued with position_log=<position in the same
+    batch> still has position_log_id None until that position is inserted.
+    """
+    for obj in objs:
+        obj._prepare_related_fields_for_save(operation_name='insert')
+
+
+def insert_station(station):
+    """
+    Register a new station in one statement: INSERT ... ON CONFLICT
+    (hardware_number) DO UPDATE ... RETURNING *. If another consumer inserted
+    the node first its row comes back instead, so no nodeinfo is dropped.
+    """
+    fields = [field for field in Station._meta.concrete_fields if not field.primary_key]
+    qn = connection.ops.quote_name
+    sql = (
+        f'INSERT INTO {qn(Station._meta.db_table)} ({", ".join(qn(field.column) for field in fields)}) '
+        f'VALUES ({", ".join(["%s"] * len(fields))}) '
+        f'ON CONFLICT ({qn("hardware_number")}) DO UPDATE SET {qn("hardware_number")} = EXCLUDED.{qn("hardware_number")} '
+        f'RETURNING *'
+    )
+    params = [field.get_db_prep_save(field.pre_save(station, True), connection) for field in fields]
+    stored = list(Station.objects.raw(sql, params))[0]
+    if stored.hardware_id == station.hardware_id:
+        stored.hardware = station.hardware
+    if stored.station_profile_id == station.station_profile_id:
+        stored.station_profile = station.station_profile
+    return stored
+
+
+def update_stations(stations, written):
+    """
+    Write queued stations with one UPDATE ... FROM (VALUES ...). A station this
+    process wrote before only gets the features keys that changed since (a
+    JSONB merge), and one whose features did not change keeps its stored value.
+    A station the database already holds from a later message (another
+    consumer of a shared subscription got there first) is left alone.
+    `written` maps station id to the features last written and is updated.
+    """
+    qn = connection.ops.quote_name
+    columns = [column for column, _ in STATION_COLUMNS]
+    placeholders = '(' + ', '.join(f'%s::{kind}' for _, kind in STATION_COLUMNS) + ')'
+    features_field = Station._meta.get_field('features')
+    for start in range(0, len(stations), CHUNK_SIZE):
+        chunk = stations[start:start + CHUNK_SIZE]
+        params = []
+        for station in chunk:
+            features = station.features or {}
+            full, top, properties = features, {}, {}
+            previous = written.get(station.id)
+            if previous is not None and not set(previous) - set(features) \
+                    and not set(previous.get('properties') or {}) - set(features.get('properties') or {}):
+                full = None
+                top = {key: value for key, value in features.items() if key != 'properties' and previous.get(key) != value}
+                properties = {key: value for key, value in (features.get('properties') or {}).items()
+                              if (previous.get('properties') or {}).get(key) != value}
+            written[station.id] = features
+            params.extend([
+                station.id,
+                station.name,
+                features_field.get_db_prep_save(full, connection),
+                features_field.get_db_prep_save(top, connection),
+                features_field.get_db_prep_save(properties, connection),
+                # the position may have been inserted after the snapshot was taken
+                station.last_position.pk if station.last_position else None,
+                Station._meta.get_field('updated_at').get_db_prep_save(station.updated_at, connection),
+                Station._meta.get_field('last_heard_at').get_db_prep_save(station.last_heard_at, connection),
+            ])
+        sql = (
+            f'UPDATE {qn(Station._meta.db_table)} AS s SET '
+            f'{qn("name")} = v.{qn("name")}, '
+            f'{qn("features")} = CASE '
+            f'WHEN v.{qn("features")} IS NOT NULL THEN v.{qn("features")} '
+            f"WHEN v.top = '{{}}'::jsonb AND v.properties = '{{}}'::jsonb THEN s.{qn('features')} "
+            f"WHEN v.properties = '{{}}'::jsonb THEN COALESCE(s.{qn('features')}, '{{}}'::jsonb) || v.top "
+            f"ELSE (COALESCE(s.{qn('features')}, '{{}}'::jsonb) || v.top) || jsonb_build_object('properties', "
+            f"COALESCE(s.{qn('features')} -> 'properties', '{{}}'::jsonb) || v.properties) END, "
+            f'{qn("last_position_id")} = v.{qn("last_position_id")}, '
+            f'{qn("updated_at")} = v.{qn("updated_at")}, '
+            f'{qn("last_heard_at")} = v.{qn("last_heard_at")} '
+            f'FROM (VALUES {", ".join([placeholders] * len(chunk))}) AS v ({", ".join(qn(column) for column in columns)}) '
+            f'WHERE s.id = v.id AND (s.last_heard_at IS NULL OR v.last_heard_at IS NULL OR s.last_heard_at <= v.last_heard_at)'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+
+writer = WriteBehind(
+    getattr(settings, 'INGEST_BATCH_SIZE', 100),
+    getattr(settings, 'INGEST_FLUSH_MS', 500),
+    getattr(settings, 'STATION_FLUSH_MS', 5000),
+)
+atexit.register(writer.flush)
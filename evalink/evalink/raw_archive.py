@@ -0,0 +1,108 @@
+"""
+Append-only archive of every message mqtt.on_message receives.
+
+Each line is [received_at, topic, payload] as JSON, written to an hourly
+gzip file `mqtt-YYYYMMDDTHH.jsonl.gz` under MQTT_ARCHIVE_DIR (UTC hours). The
+stream is sync-flushed every few seconds, so a crash loses at most that much.
+`manage.py replay_mqtt_log` feeds the files back through handler.dispatch.
+Whenever a new hour starts, files older than MQTT_ARCHIVE_DAYS are deleted.
+Only the run_mqtt_ingest process archives (INGEST_OWNS_FILES): web workers
+ingesting with MQTT_INGEST_IN_WEB each get every message, and their streams
+would interleave in the same hourly file.
+"""
+import atexit
+import gzip
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+# cheapest level; JSON payloads still shrink several times over
+COMPRESS_LEVEL = 1
+FLUSH_SECONDS = 5
+NAME_FORMAT = 'mqtt-%Y%m%dT%H.jsonl.gz'
+
+
+class RawArchive:
+    def __init__(self, directory, days=0):
+        self.directory = directory
+        # 0 keeps every file
+        self.days = days
+        self.lock = threading.Lock()
+        self.file = None
+        self.name = None
+        self.flushed_at = 0
+
+    def append(self, topic, payload, received_at=None):
+        received_at = time.time() if received_at is None else received_at
+        name = datetime.fromtimestamp(received_at, timezone.utc).strftime(NAME_FORMAT)
+        # surrogateescape keeps non-UTF-8 bytes recoverable without base64 bloating JSON payloads
+        line = json.dumps([received_at, topic, payload.decode('utf-8', 'surrogateescape')]) + '\n'
+        with self.lock:
+            if name != self.name:
+                self._open(name)
+                self.prune(received_at)
+            self.file.write(line.encode('utf-8', 'surrogatepass'))
+            if received_at - self.flushed_at >= FLUSH_SECONDS:
+                self.file.flush(zlib.Z_SYNC_FLUSH)
+                self.flushed_at = received_at
+
+    def _open(self, name):
+        self.close()
+        os.makedirs(self.directory, exist_ok=True)
+        # appending starts a new gzip member, which gzip readers concatenate
+        self.file = gzip.open(os.path.join(self.directory, name), 'ab', compresslevel=COMPRESS_LEVEL)
+        self.name = name
+
+    def prune(self, now):
+        """Delete archive files whose hour ended more than `days` days before `now`."""
+        if self.days <= 0:
+            return
+        for path in files(self.directory):
+            try:
+                hour = datetime.strptime(os.path.basename(path), NAME_FORMAT).replace(tzinfo=timezone.utc)
+            except ValueError:
+                continue
+            if now - hour.timestamp() - 3600 > self.days * 86400:
+                try:
+                    os.remove(path)
+                except OSError as error:
+                    print(f'could not remove old archive {path}: {error}')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.name = None
+
+
+def files(directory):
+    """Archive files in a directory, oldest first."""
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith('mqtt-') and name.endswith('.jsonl.gz')
+    )
+
+
+def read(path):
+    """Yield (received_at, topic, payload) from one archive file; a tail cut off by a crash is skipped."""
+    try:
+        with gzip.open(path, 'rb') as archived:
+            for line in archived:
+                try:
+                    received_at, topic, payload = json.loads(line.decode('utf-8', 'surrogatepass'))
+                except ValueError:
+                    break
+                yield received_at, topic, payload.encode('utf-8', 'surrogateescape')
+    except (EOFError, gzip.BadGzipFile, zlib.error):
+        return
+
+
+archive = RawArchive(settings.MQTT_ARCHIVE_DIR, getattr(settings, 'MQTT_ARCHIVE_DAYS', 0)) \
+    if getattr(settings, 'MQTT_ARCHIVE_DIR', '') and getattr(settings, 'INGEST_OWNS_FILES', False) else None
+if archive is not None:
+    atexit.register(archive.close)
@@ -0,0 +1,115 @@
+"""
+Compact, compressed JSON for the endpoints the map polls over slow links.
+
+json_response() writes JSON without indentation unless the request asks for
+?pretty=1. CompressionMiddleware encodes JSON bodies of at least
+COMPRESS_MIN_BYTES with brotli (when the `brotli` package is installed) or
+gzip, whichever the client accepts, and keeps the last few encoded bodies so
+the identical responses many pollers get (features.json, aircraft.json) are
+compressed once. Only JSON is encoded: HTML pages carry the CSRF token, and
+compressing them without BREACH mitigation would expose it. Streaming
+responses, including the /live event stream, and anything already encoded
+pass through untouched.
+"""
+import collections
+import gzip
+import hashlib
+import threading
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json',)
+# encoded bodies kept for reuse, keyed by (coding, body digest)
+REUSE_ENTRIES = 32
+
+
+def pretty(request):
+    return request.GET.get('pretty') == '1'
+
+
+def json_params(request):
+    """json.dumps keyword arguments for a response to this request."""
+    return {'indent': 2} if pretty(request) else {'separators': (',', ':')}
+
+
+def json_response(request, data, **kwargs):
+    """JsonResponse, compact unless the request has ?pretty=1."""
+    return JsonResponse(data, json_dumps_params=json_params(request), **kwargs)
+
+
+def accepted_coding(accept_encoding):
+    """'br', 'gzip' or None for an Accept-Encoding header, preferring brotli when it is available."""
+    offered = {}
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.partition(';')
+        quality = params.strip().removeprefix('q=')
+        try:
+            offered[coding.strip()] = float(quality) if quality else 1.0
+        except ValueError:
+            continue
+    if brotli is not None and offered.get('br', 0) > 0:
+        return 'br'
+    if offered.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+def compress(content, coding):
+    if coding == 'br':
+        return brotli.compress(content, quality=getattr(settings, 'COMPRESS_BROTLI_QUALITY', 5))
+    # mtime=0 so equal bodies give equal bytes
+    return gzip.compress(content, compresslevel=getattr(settings, 'COMPRESS_GZIP_LEVEL', 6), mtime=0)
+
+
+class CompressionMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_bytes = getattr(settings, 'COMPRESS_MIN_BYTES', 1024)
+        self.lock = threading.Lock()
+        self.recent = collections.OrderedDict()
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if response.get('Content-Type', '').split(';')[0].strip() not in COMPRESSIBLE_TYPES:
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < self.min_bytes:
+            return response
+        coding = accepted_coding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if coding is None:
+            return response
+
+        encoded = self.encode(response.content, coding)
+        if len(encoded) >= len(response.content):
+            return response
+        response.content = encoded
+        response['Content-Length'] = str(len(encoded))
+        response['Content-Encoding'] = coding
+        # as django.middleware.gzip: the encoded body is a different representation
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
+
+    def encode(self, content, coding):
+        key = (coding, hashlib.sha1(content).digest())
+        with self.lock:
+            encoded = self.recent.get(key)
+            if encoded is not None:
+                self.recent.move_to_end(key)
+                return encoded
+        encoded = compress(content, coding)
+        with self.lock:
+            self.recent[key] = encoded
+            while len(self.recent) > REUSE_ENTRIES:
+                self.recent.popitem(last=False)
+        return encoded
@@ -56,6 +56,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'evalink.responses.CompressionMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -181,3 +182,112 @@ if os.getenv('DJANGO_BEHIND_PROXY', '0') in ('1', 'true', 'True'):
     USE_X_FORWARDED_HOST = True
 
 LOGGING_CONFIG = None
+
+# MQTT ingest. By default every web worker also runs the MQTT subscriber
+# (started from evalink/__init__.py). Set MQTT_INGEST_IN_WEB=0 for the web
+# processes and run `python manage.py run_mqtt_ingest` once so a single
+# process owns ingest and web workers can be scaled independently.
+MQTT_INGEST_IN_WEB = os.getenv('MQTT_INGEST_IN_WEB', '1') not in ('0', 'false', 'False', '')
+
+# Ingest write-behind (evalink/pipeline.py): rows produced by MQTT messages
+# are written in one batch every INGEST_BATCH_SIZE messages or INGEST_FLUSH_MS
+# milliseconds, whichever comes first.
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '100'))
+INGEST_FLUSH_MS = int(os.getenv('INGEST_FLUSH_MS', '500'))
+# Station rows change with nearly every message, so each dirty station is written
+# at most once per STATION_FLUSH_MS milliseconds, with only its changed features keys.
+STATION_FLUSH_MS = int(os.getenv('STATION_FLUSH_MS', '5000'))
+
+# Seconds the ingest path may reuse a cached campus/station row (evalink/ingest_cache.py)
+# before re-reading it; edits in the same process invalidate it immediately.
+INGEST_CACHE_SECONDS = int(os.getenv('INGEST_CACHE_SECONDS', '60'))
+
+# Texts kept in Station.features["properties"]["texts"]; older ones are only in TextLog.
+STATION_RECENT_TEXTS = int(os.getenv('STATION_RECENT_TEXTS', '10'))
+
+# Messages the handler fails on are retried off the MQTT network thread
+# (evalink/deadletter.py) after DEAD_LETTER_BACKOFF_MS, doubling each time, and
+# stored as DeadLetter rows after DEAD_LETTER_RETRIES attempts.
+DEAD_LETTER_RETRIES = int(os.getenv('DEAD_LETTER_RETRIES', '5'))
+DEAD_LETTER_BACKOFF_MS = int(os.getenv('DEAD_LETTER_BACKOFF_MS', '1000'))
+
+# Bounded queue between the MQTT network loop and the database (evalink/ingest_queue.py).
+# INGEST_QUEUE_OVERFLOW is what happens when it is full: block, drop_oldest or
+# spill (append to INGEST_SPILL_PATH and read back once the database catches up).
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '10000'))
+INGEST_QUEUE_OVERFLOW = os.getenv('INGEST_QUEUE_OVERFLOW', 'spill')
+INGEST_SPILL_PATH = os.getenv('INGEST_SPILL_PATH', str(BASE_DIR / 'ingest-spill.jsonl'))
+# Only a `run_mqtt_ingest` process writes ingest files. Web workers ingesting
+# with MQTT_INGEST_IN_WEB each receive every message and would share the files,
+# so their queues block instead of spilling. Several run_mqtt_ingest processes
+# on one host (MQTT_SHARE_GROUP) need their own INGEST_SPILL_PATH each.
+INGEST_OWNS_FILES = 'run_mqtt_ingest' in sys.argv
+
+# Every message a run_mqtt_ingest process receives is appended to hourly gzip
+# files here (evalink/raw_archive.py) for `manage.py replay_mqtt_log`; empty
+# disables it. Web workers never archive (see INGEST_OWNS_FILES), and several
+# run_mqtt_ingest processes on one host need a directory each.
+MQTT_ARCHIVE_DIR = os.getenv('MQTT_ARCHIVE_DIR', str(BASE_DIR / 'mqtt-archive'))
+# Archive files older than this many days are deleted as new hours start; 0 keeps them all.
+MQTT_ARCHIVE_DAYS = int(os.getenv('MQTT_ARCHIVE_DAYS', '30'))
+
+# DB worker threads behind the ingest queue. Messages are assigned by sending
+# node (or aircraft), so each node's messages are still handled in order.
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '4'))
+
+# Subscribe through `$share/<group>/...` so several run_mqtt_ingest processes
+# split the uplink between them; empty subscribes normally.
+MQTT_SHARE_GROUP = os.getenv('MQTT_SHARE_GROUP', '')
+
+# Packets already handled through another gateway are dropped (evalink/dedup.py);
+# the last INGEST_DEDUP_SIZE (from, id, type) keys are kept for INGEST_DEDUP_SECONDS.
+INGEST_DEDUP_SIZE = int(os.getenv('INGEST_DEDUP_SIZE', '10000'))
+INGEST_DEDUP_SECONDS = int(os.getenv('INGEST_DEDUP_SECONDS', '600'))
+
+# One ingest process can serve several campuses: comma-separated
+# "<topic root or !gateway id>=<Campus name>" pairs, e.g.
+# "msh/FMARS=FMARS,!a1b2c3d4=MDRS". Topic roots are subscribed alongside
+# MQTT_TOPIC; messages matching no route go to CAMPUS.
+INGEST_CAMPUS_ROUTES = dict(
+    (key.strip(), name.strip()) for key, name in
+    (item.split('=', 1) for item in _csv_env('INGEST_CAMPUS_ROUTES') if '=' in item)
+)
+
+# Positions outside the inner geofence are thinned at ingest (evalink/track_filter.py):
+# stored after moving TRACK_MIN_DISTANCE_M and TRACK_MIN_INTERVAL_S, at least every
+# TRACK_MAX_INTERVAL_S, plus turns of TRACK_MIN_TURN_DEG. Station.configuration
+# ["track_filter"] overrides these per station; 0 disables a rule.
+TRACK_MIN_DISTANCE_M = float(os.getenv('TRACK_MIN_DISTANCE_M', '10'))
+TRACK_MIN_INTERVAL_S = float(os.getenv('TRACK_MIN_INTERVAL_S', '0'))
+TRACK_MAX_INTERVAL_S = float(os.getenv('TRACK_MAX_INTERVAL_S', '900'))
+TRACK_MIN_TURN_DEG = float(os.getenv('TRACK_MIN_TURN_DEG', '30'))
+
+# Ingest metrics (evalink/metrics.py) in Prometheus text format. The web app serves
+# them at /metrics to staff users or to "Authorization: Bearer <METRICS_TOKEN>";
+# run_mqtt_ingest serves them on INGEST_METRICS_HOST:INGEST_METRICS_PORT (port 0
+# disables) for its own process, also behind METRICS_TOKEN when it is set. Set
+# INGEST_METRICS_HOST=0.0.0.0 to let a scraper on another host reach it.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+INGEST_METRICS_PORT = int(os.getenv('INGEST_METRICS_PORT', '9108'))
+INGEST_METRICS_HOST = os.getenv('INGEST_METRICS_HOST', '127.0.0.1')
+
+# /features.json is built once per change and shared by all pollers (evalink/features_cache.py);
+# entries also expire after FEATURES_CACHE_SECONDS since station ages move with the clock.
+FEATURES_CACHE_SECONDS = int(os.getenv('FEATURES_CACHE_SECONDS', '10'))
+# How long a features.json version stays usable as ?since=; older ones get the full collection.
+FEATURES_DELTA_SECONDS = int(os.getenv('FEATURES_DELTA_SECONDS', '600'))
+
+# /live pushes "stations/aircraft/texts changed" to the map as Server-Sent Events
+# (evalink/live.py), with polling as the fallback. Each open stream holds a worker
+# thread under WSGI, so only turn LIVE_STREAM on behind an ASGI server or with
+# plenty of gunicorn threads. One query set per LIVE_POLL_MS serves all viewers.
+LIVE_STREAM = os.getenv('LIVE_STREAM', '0') == '1'
+LIVE_POLL_MS = int(os.getenv('LIVE_POLL_MS', '1000'))
+LIVE_HEARTBEAT_S = int(os.getenv('LIVE_HEARTBEAT_S', '15'))
+
+# JSON responses are compact unless ?pretty=1 (evalink/responses.py). JSON bodies of at least
+# COMPRESS_MIN_BYTES are sent brotli-encoded when the optional `brotli` package is installed
+# and the client accepts it, else gzip; COMPRESS_BROTLI_QUALITY/COMPRESS_GZIP_LEVEL trade CPU for size.
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', '5'))
+COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', '6'))
@@ -8,6 +8,14 @@ from .settings import *
 # Disable MQTT during tests
 MQTT_ENABLED = False
 
+# Do not archive raw MQTT traffic from tests
+MQTT_ARCHIVE_DIR = ''
+
+# Write ingest rows as each message is handled so tests can assert on them
+INGEST_BATCH_SIZE = 1
+INGEST_FLUSH_MS = 0
+STATION_FLUSH_MS = 0
+
 # Use a test-specific database
 DATABASES = {
     'default': {
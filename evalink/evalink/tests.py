@@ -1,13 +1,28 @@
-from django.test import TestCase, Client
+from django.test import TestCase, SimpleTestCase, Client, RequestFactory, override_settings
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.contrib.auth.models import User, Group
 from django.urls import reverse
 from django.utils import timezone
 from datetime import datetime, timedelta
+import gzip
+import asyncio
+import collections
+import itertools
 import json
+from io import StringIO
 import os
-from unittest.mock import patch
-from .models import Campus, Station, Hardware, Geofence, StationProfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from unittest.mock import patch, Mock
+from .models import Campus, Station, Hardware, Geofence, StationProfile, PositionLog, TelemetryLog, StationMeasure, TextLog, Aircraft, AircraftPositionLog, DeadLetter
 from .test_mqtt_utils import mock_mqtt_client, create_test_mqtt_message
+from . import handler, pipeline, ingest_cache, deadletter, mqtt, ingest_queue, raw_archive, dedup, track_filter, metrics, views, features_cache, live, responses
 
 
 class FeaturesEndpointTestCase(TestCase):
@@ -334,6 +349,101 @@ class FeaturesEndpointTestCase(TestCase):
             # Verify the exception is Campus.DoesNotExist
             self.assertIn('Campus matching query does not exist', str(context.exception))
 
+    @patch.dict(os.environ, {'CAMPUS': 'Test Campus'})
+    def test_features_are_built_once_per_change(self):
+        """Test that polls share one cached build until a station changes"""
+        self.client.login(username='testuser', password='testpass123')
+        with patch.object(views, 'build_features', wraps=views.build_features) as build:
+            first = self.client.get('/features.json')
+            second = self.client.get('/features.json')
+            self.assertEqual(build.call_count, 1)
+            self.assertEqual(first.content, second.content)
+
+            self.station1.features['properties']['name'] = 'Renamed'
+            self.station1.save()
+            third = self.client.get('/features.json')
+            self.assertEqual(build.call_count, 2)
+
+        names = [feature['properties']['name'] for feature in json.loads(third.content)['features']]
+        self.assertIn('Renamed', names)
+
+    @patch.dict(os.environ, {'CAMPUS': 'Test Campus'})
+    def test_since_returns_only_changed_stations(self):
+        """Test that ?since=<version> carries changed and removed stations and a new version"""
+        self.client.login(username='testuser', password='testpass123')
+        station3 = Station.objects.create(
+            name='Test Station 3', short_name='TS3', hardware=self.hardware, hardware_node='node3',
+            hardware_number=12347, station_type='active', station_profile=self.station_profile,
+            features={'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [-105.0, 40.0]},
+                      'properties': {'name': 'Test Station 3'}},
+        )
+        full = json.loads(self.client.get('/features.json').content)
+        # migrations also seed a planner station, which is left out of the checks
+        ours = {self.station1.id, station3.id}
+        self.assertEqual({feature['properties']['id'] for feature in full['features']} & ours, ours)
+
+        unchanged = json.loads(self.client.get(f'/features.json?since={full["version"]}').content)
+        self.assertEqual((unchanged['features'], unchanged['removed']), ([], []))
+        self.assertEqual(unchanged['version'], full['version'])
+
+        self.station1.features['geometry']['coordinates'] = [-105.02, 40.02]
+        self.station1.save()
+        station3.station_type = 'ignore'
+        station3.save()
+        delta = json.loads(self.client.get(f'/features.json?since={full["version"]}').content)
+        self.assertEqual([feature['properties']['id'] for feature in delta['features']], [self.station1.id])
+        self.assertEqual(delta['removed'], [str(station3.id)])
+        self.assertNotEqual(delta['version'], full['version'])
+
+        expired = json.loads(self.client.get('/features.json?since=unknown').content)
+        self.assertNotIn('since', expired)
+        self.assertEqual({feature['properties']['id'] for feature in expired['features']} & ours, {self.station1.id})
+
+    @patch.dict(os.environ, {'CAMPUS': 'Test Campus'})
+    def test_unchanged_poll_gets_not_modified(self):
+        """Test that a poll with the last ETag gets an empty 304 until a station changes"""
+        self.client.login(username='testuser', password='testpass123')
+        first = self.client.get('/features.json')
+        self.assertIn('no-cache', first['Cache-Control'])
+        with patch.object(views, 'build_features', wraps=views.build_features) as build:
+            again = self.client.get('/features.json', HTTP_IF_NONE_MATCH=first['ETag'])
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.content, b'')
+            self.assertEqual(build.call_count, 0)
+
+        self.station1.name = 'Renamed'
+        self.station1.save()
+        changed = self.client.get('/features.json', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+
+    @patch.dict(os.environ, {'CAMPUS': 'Test Campus'})
+    def test_etag_moves_with_planner_not_clock(self):
+        """Test that an unchanged map keeps its ETag as time passes, unless the planner moves along its plan"""
+        self.client.login(username='testuser', password='testpass123')
+        now = timezone.now()
+        first = self.client.get('/features.json')['ETag']
+        with patch('evalink.features_cache.timezone.now', return_value=now + timedelta(minutes=30)):
+            self.assertEqual(self.client.get('/features.json', HTTP_IF_NONE_MATCH=first).status_code, 304)
+
+        planner = Station.objects.filter(station_type='planner').first()
+        for offset, latitude in ((-1, 40.0), (1, 40.05)):
+            PositionLog.objects.create(station=planner, latitude=latitude, longitude=-105.0, timestamp=now + timedelta(hours=offset),
+                                       updated_at=now, updated_on=now.date())
+        with patch('evalink.features_cache.timezone.now', return_value=now):
+            moving = self.client.get('/features.json')['ETag']
+        with patch('evalink.features_cache.timezone.now', return_value=now + timedelta(minutes=30)):
+            self.assertNotEqual(self.client.get('/features.json', HTTP_IF_NONE_MATCH=moving)['ETag'], moving)
+
+    @patch.dict(os.environ, {'CAMPUS': 'Test Campus'})
+    def test_ingest_flush_invalidates_features(self):
+        """Test that a write-behind flush of stations moves the features version on"""
+        before = features_cache.version()
+        writer = pipeline.WriteBehind(batch_size=100, flush_ms=0)
+        writer.add(self.station1)
+        writer.flush()
+        self.assertGreater(features_cache.version(), before)
+
     @mock_mqtt_client()
     def test_mqtt_functionality_with_mock(self):
         """Test that MQTT functionality works with mocked client"""
@@ -354,3 +464,958 @@ class FeaturesEndpointTestCase(TestCase):
         self.assertIn('timestamp', test_message)
         self.assertEqual(test_message['type'], 'text')
         self.assertEqual(test_message['from'], 12345)
+
+
+@patch.dict(os.environ, {'CAMPUS': 'Test Campus'})
+class HandlerPipelineTestCase(TestCase):
+    def setUp(self):
+        """Set up a campus with an inner geofence and one known station"""
+        geofence = Geofence.objects.create(
+            latitude1=39.9,
+            longitude1=-105.1,
+            latitude2=40.1,
+            longitude2=-104.9
+        )
+        Campus.objects.create(
+            name='Test Campus',
+            latitude=40.0,
+            longitude=-105.0,
+            time_zone='America/Denver',
+            inner_geofence=geofence
+        )
+        hardware = Hardware.objects.create(
+            name='Test Hardware',
+            hardware_type=1,
+            station_type='person'
+        )
+        self.station = Station.objects.create(
+            name='Test Station 1',
+            short_name='TS1',
+            hardware=hardware,
+            hardware_node='node1',
+            hardware_number=12345,
+            station_type='person'
+        )
+        ingest_cache.invalidate()
+        handler.measured.clear()
+        track_filter.tracks.clear()
+        # Batch everything until the test flushes explicitly
+        self.writer = pipeline.WriteBehind(batch_size=100, flush_ms=0)
+        patcher = patch.object(pipeline, 'writer', self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ids = itertools.count()
+
+    def position(self, latitude, longitude):
+        message = create_test_mqtt_message(
+            message_type='position',
+            payload={'latitude_i': round(latitude * 10000000), 'longitude_i': round(longitude * 10000000)},
+        )
+        # each call is a different packet, even within one millisecond
+        message['id'] += next(self.ids)
+        return message
+
+    def test_positions_are_written_on_flush(self):
+        """Test that queued positions are written together and the last one becomes last_position"""
+        handler.process_message(self.position(41.0, -106.0))
+        handler.process_message(self.position(41.1, -106.1))
+        self.assertEqual(PositionLog.objects.count(), 0)
+
+        self.writer.flush()
+
+        self.assertEqual(PositionLog.objects.count(), 2)
+        self.assertEqual(StationMeasure.objects.count(), 2)
+        station = Station.objects.get(pk=self.station.pk)
+        self.assertEqual(station.last_position.latitude, 41.1)
+        self.assertEqual(station.features['geometry']['coordinates'], [-106.1, 41.1])
+
+    def test_position_inside_fence_is_logged_once_per_day(self):
+        """Test that repeated positions inside the inner geofence only log the first one"""
+        handler.process_message(self.position(40.0, -105.0))
+        handler.process_message(self.position(40.01, -105.01))
+        self.writer.flush()
+
+        self.assertEqual(PositionLog.objects.count(), 1)
+        station = Station.objects.get(pk=self.station.pk)
+        self.assertEqual(station.features['geometry']['coordinates'], [-105.01, 40.01])
+
+    def test_duplicate_telemetry_is_ignored(self):
+        """Test that telemetry republished with the same id is stored once"""
+        message = create_test_mqtt_message(message_type='telemetry', payload={'temperature': 21.5})
+        handler.process_message(message)
+        handler.process_message(dict(message))
+        self.writer.flush()
+
+        self.assertEqual(TelemetryLog.objects.count(), 1)
+        station = Station.objects.get(pk=self.station.pk)
+        self.assertEqual(station.features['properties']['temperature'], 21.5)
+
+    def test_replayed_rows_are_not_applied_again(self):
+        """Test that telemetry and text already stored are neither queued nor applied to the station again"""
+        telemetry = create_test_mqtt_message(message_type='telemetry', payload={'temperature': 21.5})
+        text = create_test_mqtt_message(message_type='text', payload={'text': 'hello'})
+        text['id'] += 1
+        handler.process_message(dict(telemetry))
+        handler.process_message(dict(text))
+        self.writer.flush()
+        self.assertEqual(handler.process_message(dict(telemetry)), metrics.DUPLICATE)
+        self.assertEqual(handler.process_message(dict(text)), metrics.DUPLICATE)
+        self.writer.flush()
+
+        self.assertEqual(TelemetryLog.objects.count(), 1)
+        self.assertEqual(TextLog.objects.count(), 1)
+        self.assertEqual(len(Station.objects.get(pk=self.station.pk).features['properties']['texts']), 1)
+
+    def test_rows_stored_meanwhile_are_counted_as_skipped(self):
+        """Test that a row another consumer stored between queueing and flush is skipped without an error and counted"""
+        text = create_test_mqtt_message(message_type='text', payload={'text': 'hello'})
+        handler.process_message(text)
+        TextLog.objects.create(station=self.station, serial_number=text['id'], text='hello',
+                               updated_at=timezone.now(), updated_on=timezone.now().date())
+        self.writer.flush()
+
+        self.assertEqual(TextLog.objects.count(), 1)
+        self.assertEqual(self.writer.stats(), {'TextLog': 1})
+
+    def test_failed_flush_is_retried_from_database(self):
+        """Test that a flush the database rejects hands its messages to the retrier, which then stores them"""
+        retrier = Mock()
+        payload = json.dumps(self.position(41.0, -106.0)).encode()
+        with patch.object(deadletter, 'retrier', retrier), \
+                patch.object(dedup, 'recent', dedup.RecentMessages(size=10, seconds=60)), \
+                patch.object(pipeline, 'update_stations', side_effect=Exception('database went away')):
+            handler.dispatch('msh/2/json/LongFast/!gw', payload)
+            self.writer.flush()
+            self.assertEqual(PositionLog.objects.count(), 0)
+            topic, pushed, _, attempts = retrier.push.call_args[0]
+            self.assertEqual((pushed, attempts), (payload, 1))
+        handler.dispatch(topic, pushed, attempts)
+        self.writer.flush()
+
+        position = PositionLog.objects.get()
+        self.assertEqual(Station.objects.get(pk=self.station.pk).last_position, position)
+
+    def test_retried_position_is_not_thinned_against_itself(self):
+        """Test that a position whose flush failed is stored when retried, although the track filter saw it"""
+        retrier = Mock()
+        handler.process_message(self.position(41.0, -106.0))
+        self.writer.flush()
+        payload = json.dumps(self.position(41.1, -106.1)).encode()
+        with patch.object(deadletter, 'retrier', retrier), \
+                patch.object(dedup, 'recent', dedup.RecentMessages(size=10, seconds=60)), \
+                patch.object(pipeline, 'update_stations', side_effect=Exception('database went away')):
+            handler.dispatch('msh/2/json/LongFast/!gw', payload)
+            self.writer.flush()
+        handler.dispatch(*retrier.push.call_args[0][:2], 1)
+        self.writer.flush()
+
+        self.assertEqual(sorted(PositionLog.objects.values_list('latitude', flat=True)), [41.0, 41.1])
+
+    def test_retry_reapplies_rows_written_before_the_failed_flush(self):
+        """Test that a retried message whose row was already written still updates the station that was not"""
+        retrier = Mock()
+        telemetry = create_test_mqtt_message(message_type='telemetry', payload={'temperature': 21.5})
+        with patch.object(deadletter, 'retrier', retrier), \
+                patch.object(dedup, 'recent', dedup.RecentMessages(size=10, seconds=60)):
+            handler.dispatch('msh/2/json/LongFast/!gw', json.dumps(telemetry).encode())
+            self.writer.flush(stations=False)
+            with patch.object(pipeline, 'update_stations', side_effect=Exception('database went away')):
+                self.writer.flush()
+        for call in retrier.push.call_args_list:
+            topic, payload, _, attempts = call.args
+            handler.dispatch(topic, payload, attempts)
+        self.writer.flush()
+
+        self.assertEqual(TelemetryLog.objects.count(), 1)
+        self.assertEqual(Station.objects.get(pk=self.station.pk).features['properties']['temperature'], 21.5)
+        # a plain copy is still recognised, from memory
+        with self.assertNumQueries(0):
+            self.assertEqual(handler.process_message(dict(telemetry)), metrics.DUPLICATE)
+
+    def test_messages_are_queued_while_a_flush_writes(self):
+        """Test that another thread queues a message, on the station being written, while a flush runs its statements"""
+        handler.process_message(self.position(41.0, -106.0))
+        original = pipeline.update_stations
+        seen = {}
+
+        def other_thread():
+            seen['station'] = self.writer.station(12345)
+            handler.process_message(self.position(41.1, -106.1))
+
+        def update_stations(stations, written):
+            thread = threading.Thread(target=other_thread, daemon=True)
+            thread.start()
+            thread.join(5)
+            seen['finished'] = not thread.is_alive()
+            return original(stations, written)
+
+        with patch.object(pipeline, 'update_stations', side_effect=update_stations):
+            self.writer.flush()
+        self.assertTrue(seen['finished'])
+        self.assertEqual(seen['station'].pk, self.station.pk)
+        self.writer.flush()
+
+        self.assertEqual(PositionLog.objects.count(), 2)
+        self.assertEqual(Station.objects.get(pk=self.station.pk).features['geometry']['coordinates'], [-106.1, 41.1])
+
+    def test_replayed_letter_is_kept_until_written(self):
+        """Test that replay_dead_letters keeps a letter whose rows could not be written, without the retrier"""
+        payload = json.dumps(self.position(41.0, -106.0)).encode()
+        deadletter.store('msh/2/json/LongFast/!gw', payload, 'down', 5)
+        retrier = Mock()
+        # a separate run of the command starts with an empty dedup window
+        with patch.object(deadletter, 'retrier', retrier), \
+                patch.object(dedup, 'recent', dedup.RecentMessages(size=10, seconds=60)), \
+                patch.object(pipeline, 'update_stations', side_effect=Exception('database went away')):
+            call_command('replay_dead_letters', stdout=StringIO())
+        retrier.push.assert_not_called()
+        self.assertEqual(DeadLetter.objects.count(), 1)
+        self.assertFalse(PositionLog.objects.exists())
+
+        call_command('replay_dead_letters', stdout=StringIO())
+        self.assertFalse(DeadLetter.objects.exists())
+        self.assertEqual(PositionLog.objects.get().latitude, 41.0)
+
+    def test_rows_point_at_position_from_same_flush(self):
+        """Test that a text queued after a position in the same batch is stored with that position"""
+        handler.process_message(self.position(41.0, -106.0))
+        text = create_test_mqtt_message(message_type='text', payload={'text': 'hello'})
+        text['id'] += next(self.ids) + 1000
+        handler.process_message(text)
+        self.writer.flush()
+
+        text_log = TextLog.objects.get()
+        self.assertIsNotNone(text_log.position_log_id)
+        self.assertEqual(text_log.position_log_id, PositionLog.objects.get().id)
+
+    def test_position_heard_twice_is_stored_once(self):
+        """Test that a position republished with the same id, in one batch or a later one, is one row"""
+        message = self.position(41.0, -106.0)
+        handler.process_message(message)
+        handler.process_message(dict(message))
+        self.writer.flush()
+        handler.process_message(dict(message))
+        self.writer.flush()
+
+        position = PositionLog.objects.get()
+        self.assertEqual(position.message_id, message['id'])
+        self.assertEqual(Station.objects.get(pk=self.station.pk).last_position, position)
+
+    def test_older_message_does_not_overwrite_station(self):
+        """Test that a flush from a message older than the stored one leaves the station alone"""
+        handler.process_message(self.position(41.0, -106.0))
+        self.writer.flush()
+        Station.objects.filter(pk=self.station.pk).update(last_heard_at=timezone.now() + timedelta(hours=1))
+
+        handler.process_message(self.position(41.1, -106.1))
+        self.writer.flush()
+
+        station = Station.objects.get(pk=self.station.pk)
+        self.assertEqual(station.features['geometry']['coordinates'], [-106.0, 41.0])
+        self.assertEqual(PositionLog.objects.count(), 2)
+
+    def test_older_message_only_adds_its_rows(self):
+        """Test that a message older than the one the station shows is stored but does not move the station"""
+        handler.process_message(self.position(41.1, -106.1))
+        older = self.position(41.0, -106.0)
+        older['timestamp'] -= 60
+        handler.process_message(older)
+        self.writer.flush()
+
+        station = Station.objects.get(pk=self.station.pk)
+        self.assertEqual(station.features['geometry']['coordinates'], [-106.1, 41.1])
+        self.assertEqual(station.last_position.latitude, 41.1)
+        self.assertEqual(sorted(PositionLog.objects.values_list('latitude', flat=True)), [41.0, 41.1])
+
+    def test_station_write_waits_for_station_interval(self):
+        """Test that rows flush on schedule while the station row waits for STATION_FLUSH_MS"""
+        self.writer = pipeline.WriteBehind(batch_size=1, flush_ms=0, station_flush_ms=60000)
+        with patch.object(pipeline, 'writer', self.writer):
+            handler.process_message(self.position(41.0, -106.0))
+            handler.process_message(self.position(41.1, -106.1))
+
+            self.assertEqual(PositionLog.objects.count(), 2)
+            self.assertIsNone(Station.objects.get(pk=self.station.pk).last_position)
+            self.assertEqual(self.writer.station(12345).last_position.latitude, 41.1)
+
+            self.writer.flush()
+
+        self.assertEqual(Station.objects.get(pk=self.station.pk).last_position.latitude, 41.1)
+
+    def test_station_update_merges_changed_keys(self):
+        """Test that a station written before only gets its changed features keys, keeping keys set elsewhere"""
+        handler.process_message(self.position(41.0, -106.0))
+        self.writer.flush()
+        station = Station.objects.get(pk=self.station.pk)
+        station.features['properties']['note'] = 'set in admin'
+        Station.objects.filter(pk=station.pk).update(features=station.features)
+
+        handler.process_message(self.position(41.1, -106.1))
+        self.writer.flush()
+
+        station = Station.objects.get(pk=self.station.pk)
+        self.assertEqual(station.features['geometry']['coordinates'], [-106.1, 41.1])
+        self.assertEqual(station.features['properties']['note'], 'set in admin')
+
+    def nodeinfo(self, number, hardware=1):
+        return create_test_mqtt_message(
+            message_type='nodeinfo',
+            from_node=number,
+            payload={'id': f'!{number:08x}', 'longname': f'Node {number}', 'shortname': 'ND', 'hardware': hardware},
+        )
+
+    def test_new_node_is_registered_in_one_statement(self):
+        """Test that with profile and hardware cached a new node costs one insert and is cached afterwards"""
+        ingest_cache.campus('Test Campus')
+        ingest_cache.station(777)
+        ingest_cache.hardware(1)
+        ingest_cache.station_profile()
+        with self.assertNumQueries(1):
+            handler.process_message(self.nodeinfo(777))
+        self.writer.flush()
+
+        station = Station.objects.get(hardware_number=777)
+        self.assertEqual(station.name, 'Node 777')
+        self.assertEqual(station.station_type, 'person')
+        self.assertIsNotNone(station.station_profile)
+        self.assertEqual(ingest_cache.station(777).pk, station.pk)
+
+    def test_node_registered_elsewhere_is_not_dropped(self):
+        """Test that a nodeinfo for a node another consumer just inserted updates that row instead of failing"""
+        with patch.object(ingest_cache, 'station', return_value=None):
+            handler.process_message(self.nodeinfo(12345))
+        self.writer.flush()
+
+        self.assertEqual(Station.objects.filter(hardware_number=12345).count(), 1)
+        self.assertEqual(Station.objects.get(hardware_number=12345).name, 'Node 12345')
+
+    def test_unknown_hardware_is_created_once(self):
+        """Test that the first node of an unknown hardware model adds an infrastructure Hardware row"""
+        handler.process_message(self.nodeinfo(778, hardware=99))
+        handler.process_message(self.nodeinfo(779, hardware=99))
+
+        self.assertEqual(Hardware.objects.filter(hardware_type=99, station_type='infrastructure').count(), 1)
+        self.assertEqual(Station.objects.filter(hardware__hardware_type=99).count(), 2)
+
+    def test_cached_position_needs_no_queries(self):
+        """Test that once campus and station are cached a queued position costs no queries"""
+        handler.process_message(self.position(41.0, -106.0))
+        with self.assertNumQueries(0):
+            handler.process_message(self.position(41.1, -106.1))
+
+    def test_station_change_invalidates_cache(self):
+        """Test that saving a station drops the cached copy"""
+        self.assertEqual(ingest_cache.station(12345).name, 'Test Station 1')
+        Station.objects.filter(pk=self.station.pk).update(name='Renamed')
+        self.assertEqual(ingest_cache.station(12345).name, 'Test Station 1')
+
+        self.station.name = 'Renamed'
+        self.station.save()
+        self.assertEqual(ingest_cache.station(12345).name, 'Renamed')
+
+    def test_measures_store_readings_and_changes_only(self):
+        """Test that StationMeasure rows hold typed readings and skip messages that change nothing"""
+        handler.process_message(self.position(41.0, -106.0))
+        handler.process_message(self.position(41.1, -106.1))
+        handler.process_message(self.position(41.1, -106.1))
+        self.writer.flush()
+
+        first, second = StationMeasure.objects.order_by('id')
+        self.assertEqual(first.features['node_type'], 'person')
+        self.assertNotIn('texts', first.features)
+        self.assertIsNone(second.features)
+        self.assertEqual(second.latitude, 41.1)
+        self.assertEqual(second.longitude, -106.1)
+
+    @override_settings(STATION_RECENT_TEXTS=2)
+    def test_station_keeps_only_recent_texts(self):
+        """Test that features keep a bounded window of texts while TextLog keeps them all"""
+        handler.process_message(self.position(41.0, -106.0))
+        for number in range(4):
+            message = create_test_mqtt_message(message_type='text', payload={'text': f'message {number}'})
+            message['id'] += number
+            handler.process_message(message)
+        self.writer.flush()
+
+        station = Station.objects.get(pk=self.station.pk)
+        texts = [text['text'] for text in station.features['properties']['texts']]
+        self.assertEqual(texts, ['message 2', 'message 3'])
+        self.assertEqual(TextLog.objects.filter(station=station).count(), 4)
+
+
+class AircraftRoutingTestCase(TestCase):
+    def setUp(self):
+        """Set up two campuses with outer geofences in different grid cells"""
+        for name, latitude, longitude in (('North', 45.0, -110.0), ('South', 40.0, -105.0)):
+            fence = Geofence.objects.create(
+                latitude1=latitude - 0.2,
+                longitude1=longitude - 0.2,
+                latitude2=latitude + 0.2,
+                longitude2=longitude + 0.2
+            )
+            Campus.objects.create(
+                name=name,
+                latitude=latitude,
+                longitude=longitude,
+                time_zone='America/Denver',
+                outer_geofence=fence
+            )
+        ingest_cache.invalidate()
+
+    def test_adsb_routed_to_containing_campus(self):
+        """Test that ADS-B messages go to the campus whose outer fence holds them and others are dropped"""
+        handler.process_aircraft('abc123', {'lat': 40.1, 'lon': -105.1, 'alt_baro': 1000})
+        handler.process_aircraft('def456', {'lat': 50.0, 'lon': -120.0})
+
+        aircraft = Aircraft.objects.get()
+        self.assertEqual(aircraft.hex, 'abc123')
+        self.assertEqual(aircraft.campus.name, 'South')
+        self.assertEqual(AircraftPositionLog.objects.get().campus.name, 'South')
+
+    def test_repeated_fix_is_not_written(self):
+        """Test that an aircraft fix identical to the last one written costs no queries"""
+        message = {'lat': 40.1, 'lon': -105.1, 'alt_baro': 1000}
+        handler.process_aircraft('abc123', dict(message))
+        with self.assertNumQueries(0):
+            self.assertEqual(handler.process_aircraft('abc123', dict(message)), metrics.DUPLICATE)
+
+    def test_aircraft_cache_is_bounded_and_follows_edits(self):
+        """Test that an admin edit drops the cached aircraft and old hex codes fall out"""
+        handler.process_aircraft('abc123', {'lat': 40.1, 'lon': -105.1})
+        self.assertIsNotNone(ingest_cache.aircraft('abc123'))
+        aircraft = Aircraft.objects.get(hex='abc123')
+        aircraft.features = {}
+        aircraft.save()
+        self.assertIsNone(ingest_cache.aircraft('abc123'))
+
+        with patch.object(ingest_cache, 'AIRCRAFT_CACHE_SIZE', 2):
+            for hex_code in ('a1', 'a2', 'a3'):
+                ingest_cache.remember_aircraft(hex_code, {'id': 0, 'features': {}, 'position': None})
+        self.assertIsNone(ingest_cache.aircraft('a1'))
+        self.assertIsNotNone(ingest_cache.aircraft('a3'))
+
+    def test_routing_needs_no_queries_once_cached(self):
+        """Test that the outer fence grid answers from memory"""
+        ingest_cache.campus_at(45.0, -110.0)
+        with self.assertNumQueries(0):
+            campus, tz = ingest_cache.campus_at(45.1, -109.9)
+            self.assertIsNone(ingest_cache.campus_at(0.0, 0.0))
+        self.assertEqual(campus.name, 'North')
+        self.assertEqual(str(tz), 'America/Denver')
+
+    def test_fence_change_rebuilds_grid(self):
+        """Test that moving a campus fence is picked up by the next lookup"""
+        self.assertIsNotNone(ingest_cache.campus_at(45.0, -110.0))
+        fence = Campus.objects.get(name='North').outer_geofence
+        fence.latitude1, fence.latitude2 = 30.0, 30.5
+        fence.save()
+        self.assertIsNone(ingest_cache.campus_at(45.0, -110.0))
+        self.assertEqual(ingest_cache.campus_at(30.2, -110.0)[0].name, 'North')
+
+
+@patch.dict(os.environ, {'MQTT_TOPIC': 'msh'})
+class DeadLetterTestCase(TestCase):
+    def setUp(self):
+        """Set up one campus for aircraft replays"""
+        fence = Geofence.objects.create(
+            latitude1=39.9,
+            longitude1=-105.1,
+            latitude2=40.1,
+            longitude2=-104.9
+        )
+        Campus.objects.create(
+            name='Test Campus',
+            latitude=40.0,
+            longitude=-105.0,
+            time_zone='America/Denver',
+            outer_geofence=fence
+        )
+        ingest_cache.invalidate()
+
+    def test_failed_message_handed_to_retrier(self):
+        """Test that a failing message is queued for retry instead of sleeping on the ingest thread"""
+        retrier = Mock(retries=5)
+        topic, payload = 'msh/aircraft/abc123', b'{"lat": 40.0, "lon": -105.0}'
+        queue = ingest_queue.IngestQueue(10, ingest_queue.BLOCK, 'unused', handler.dispatch)
+        with patch.object(deadletter, 'retrier', retrier), \
+                patch.object(handler, 'process_aircraft', side_effect=RuntimeError('database is down')), \
+                patch('time.sleep') as sleep:
+            queue.handle(topic, payload)
+        sleep.assert_not_called()
+        retrier.push.assert_called_once()
+        self.assertEqual(retrier.push.call_args.args[:2], (topic, payload))
+
+    def test_retries_exhausted_then_stored(self):
+        """Test that a message is retried until its attempts run out and then stored"""
+        retrier = deadletter.Retrier(retries=2, backoff_ms=0)
+        with patch.object(handler, 'process_aircraft', side_effect=RuntimeError('still down')) as process:
+            retrier.retry('msh/aircraft/abc123', b'{}', 1, 'down')
+            _, _, topic, payload, attempts, error = retrier.pending.pop()
+            self.assertEqual(attempts, 2)
+            retrier.retry(topic, payload, attempts, error)
+        self.assertEqual(process.call_count, 1)
+        letter = DeadLetter.objects.get()
+        self.assertEqual(letter.topic, 'msh/aircraft/abc123')
+        self.assertEqual(letter.error, 'still down')
+        self.assertEqual(letter.attempts, 2)
+
+    def test_replay_deletes_processed_letters(self):
+        """Test that replay_dead_letters reprocesses good payloads and keeps bad ones"""
+        deadletter.store('msh/aircraft/abc123', b'{"lat": 40.0, "lon": -105.0}', 'down', 5)
+        deadletter.store('msh/aircraft/def456', b'not json', 'bad payload', 5)
+
+        call_command('replay_dead_letters', stdout=StringIO())
+
+        self.assertTrue(Aircraft.objects.filter(hex='abc123').exists())
+        letter = DeadLetter.objects.get()
+        self.assertEqual(letter.topic, 'msh/aircraft/def456')
+        self.assertEqual(letter.attempts, 6)
+
+
+class IngestQueueTestCase(SimpleTestCase):
+    def setUp(self):
+        """Set up a queue whose worker waits until the test releases it"""
+        self.release = threading.Event()
+        self.done = threading.Event()
+        self.processed = []
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spill_path = os.path.join(directory.name, 'spill.jsonl')
+
+    def process(self, topic, payload, attempts=0):
+        self.release.wait(5)
+        self.processed.append(payload)
+        if payload == b'last':
+            self.done.set()
+
+    def fill(self, queue, count):
+        for number in range(count):
+            queue.put('msh/test', str(number).encode())
+        queue.put('msh/test', b'last')
+
+    def test_spill_keeps_order_and_loses_nothing(self):
+        """Test that overflow goes to the spill file and is read back in order"""
+        queue = ingest_queue.IngestQueue(2, ingest_queue.SPILL, self.spill_path, self.process)
+        self.fill(queue, 10)
+        stats = queue.stats()
+        self.assertGreater(stats['spilled'], 0)
+        self.assertLessEqual(stats['depth'], 2)
+
+        self.release.set()
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.processed, [str(number).encode() for number in range(10)] + [b'last'])
+        # the worker removes the drained file just after handling its last line
+        for _ in range(50):
+            if not os.path.exists(self.spill_path + '.draining'):
+                break
+            time.sleep(0.1)
+        self.assertFalse(os.path.exists(self.spill_path + '.draining'))
+        self.assertEqual(queue.stats()['spilled_pending'], 0)
+
+    def test_workers_keep_each_node_in_order(self):
+        """Test that sharded workers process every message and keep per-node order"""
+        processed = collections.defaultdict(list)
+        finished = threading.Semaphore(0)
+
+        def process(topic, payload, attempts=0):
+            message = json.loads(payload)
+            processed[message['from']].append(message['id'])
+            finished.release()
+
+        queue = ingest_queue.IngestQueue(1000, ingest_queue.BLOCK, self.spill_path, process, workers=3)
+        for number in range(200):
+            queue.put('msh/2/json/LongFast/!gateway', json.dumps({'from': number % 7, 'id': number}).encode())
+        for _ in range(200):
+            self.assertTrue(finished.acquire(timeout=5))
+
+        self.assertEqual(sorted(processed), list(range(7)))
+        for node, ids in processed.items():
+            self.assertEqual(ids, [number for number in range(200) if number % 7 == node])
+
+    def test_queue_without_spill_leaves_spill_file_alone(self):
+        """Test that a queue that does not spill (a web worker) never reads the ingest process's spill file"""
+        with open(self.spill_path, 'w') as spilled:
+            spilled.write(json.dumps(['msh/test', 'eA==']) + '\n')
+        queue = ingest_queue.IngestQueue(10, ingest_queue.BLOCK, self.spill_path, self.process)
+        self.release.set()
+        queue.put('msh/test', b'last')
+        self.assertTrue(self.done.wait(5))
+
+        self.assertEqual(self.processed, [b'last'])
+        self.assertTrue(os.path.exists(self.spill_path))
+        self.assertEqual(queue.stats()['spilled_pending'], 0)
+
+    def test_retries_run_on_the_node_worker(self):
+        """Test that the retrier hands a retry to the worker that handles the node's other messages"""
+        threads = {}
+        finished = threading.Semaphore(0)
+
+        def process(topic, payload, attempts=0):
+            threads[attempts] = threading.current_thread().name
+            finished.release()
+
+        queue = ingest_queue.IngestQueue(10, ingest_queue.BLOCK, self.spill_path, process, workers=2)
+        retrier = deadletter.Retrier(retries=5, backoff_ms=0)
+        retrier.resubmit = queue.resubmit
+        payload = json.dumps({'from': 7, 'id': 1}).encode()
+        queue.put('msh/test', payload)
+        self.assertTrue(finished.acquire(timeout=5))
+        retrier.retry('msh/test', payload, 1, 'down')
+        self.assertTrue(finished.acquire(timeout=5))
+
+        self.assertTrue(threads[0].startswith('ingest-worker'))
+        self.assertEqual(threads[1], threads[0])
+
+    def test_drop_oldest_counts_drops(self):
+        """Test that drop_oldest keeps the queue bounded and keeps the newest messages"""
+        queue = ingest_queue.IngestQueue(2, ingest_queue.DROP_OLDEST, self.spill_path, self.process)
+        self.fill(queue, 10)
+        self.assertLessEqual(queue.stats()['depth'], 2)
+
+        self.release.set()
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.processed[-1], b'last')
+        self.assertEqual(queue.stats()['dropped'] + len(self.processed), 11)
+
+
+class RawArchiveTestCase(SimpleTestCase):
+    def setUp(self):
+        """Set up an empty archive directory"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_round_trip_across_restarts(self):
+        """Test that messages come back byte for byte, in order, across hourly files and restarts"""
+        archive = raw_archive.RawArchive(self.directory)
+        archive.append('msh/US/2/json/LongFast/!a1b2c3d4', b'{"text": "caf\xc3\xa9"}', 1700000000)
+        archive.append('msh/aircraft/abc123', b'\xff not utf-8', 1700000001)
+        archive.close()
+        archive = raw_archive.RawArchive(self.directory)
+        archive.append('msh/aircraft/abc123', b'{}', 1700003600)
+        # left open, as after a crash: only the sync-flushed part has to be readable
+        archive.file.fileobj.flush()
+
+        files = raw_archive.files(self.directory)
+        self.assertEqual([os.path.basename(path) for path in files], ['mqtt-20231114T22.jsonl.gz', 'mqtt-20231114T23.jsonl.gz'])
+        messages = [message for path in files for message in raw_archive.read(path)]
+        self.assertEqual(messages, [
+            (1700000000, 'msh/US/2/json/LongFast/!a1b2c3d4', b'{"text": "caf\xc3\xa9"}'),
+            (1700000001, 'msh/aircraft/abc123', b'\xff not utf-8'),
+            (1700003600, 'msh/aircraft/abc123', b'{}'),
+        ])
+
+    def test_old_hours_are_pruned(self):
+        """Test that starting a new hour deletes files older than the retention and keeps the rest"""
+        archive = raw_archive.RawArchive(self.directory, days=1)
+        for received_at in (1700000000, 1700000000 + 86400, 1700000000 + 2 * 86400):
+            archive.append('msh/aircraft/abc123', b'{}', received_at)
+        archive.close()
+
+        self.assertEqual([os.path.basename(path) for path in raw_archive.files(self.directory)],
+                         ['mqtt-20231115T22.jsonl.gz', 'mqtt-20231116T22.jsonl.gz'])
+
+
+class BenchIngestTestCase(TestCase):
+    @patch.dict(os.environ, {'MQTT_TOPIC': 'msh', 'CAMPUS': ''})
+    def test_reports_every_type_and_rolls_back(self):
+        """Test that bench_ingest reports each message type and leaves no rows behind"""
+        # migrations seed the planner station
+        stations = Station.objects.count()
+        out = StringIO()
+        call_command('bench_ingest', messages=5, stations=2, aircraft=2, batch_size=3, stdout=out)
+
+        report = out.getvalue()
+        for name in ('nodeinfo', 'position', 'telemetry', 'text', 'adsb', 'remoteid'):
+            self.assertIn(name, report)
+        self.assertFalse(Campus.objects.filter(name='Benchmark').exists())
+        self.assertEqual(Station.objects.count(), stations)
+        self.assertFalse(Aircraft.objects.exists())
+
+
+class BenchResponsesTestCase(TestCase):
+    @patch.dict(os.environ, {'CAMPUS': 'Test Campus'})
+    def test_compact_body_is_smaller(self):
+        """Test that bench_responses reports every endpoint and a saving over pretty bodies"""
+        User.objects.create_superuser(username='admin', password='x')
+        Campus.objects.create(name='Test Campus', latitude=40.0, longitude=-105.0, time_zone='America/Denver')
+        out = StringIO()
+        call_command('bench_responses', repeat=1, stdout=out, stderr=StringIO())
+
+        report = out.getvalue()
+        for url in ('/features.json', '/aircraft.json', '/texts.json', '/campuses.json'):
+            self.assertIn(url, report)
+        self.assertIn('bytes before', report)
+
+
+@patch.dict(os.environ, {'MQTT_TOPIC': 'msh'})
+class DedupTestCase(SimpleTestCase):
+    def setUp(self):
+        """Set up an empty dedup window for handler.dispatch"""
+        patcher = patch.object(dedup, 'recent', dedup.RecentMessages(size=3, seconds=60))
+        self.recent = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.payload = json.dumps(create_test_mqtt_message(message_type='position', payload={})).encode()
+
+    def test_packet_from_second_gateway_is_dropped(self):
+        """Test that a packet relayed by two gateways is processed once and counted per gateway"""
+        with patch.object(handler, 'process_message') as process:
+            handler.dispatch('msh/2/json/LongFast/!gateway1', self.payload)
+            handler.dispatch('msh/2/json/LongFast/!gateway2', self.payload)
+            handler.dispatch('msh/2/json/LongFast/!gateway3', self.payload)
+        process.assert_called_once()
+        self.assertEqual(self.recent.stats(), {
+            '!gateway1': {'accepted': 1, 'duplicates': 0},
+            '!gateway2': {'accepted': 0, 'duplicates': 1},
+            '!gateway3': {'accepted': 0, 'duplicates': 1},
+        })
+
+    def test_failed_packet_is_not_recorded(self):
+        """Test that a packet whose handling failed is processed again when it comes back"""
+        with patch.object(handler, 'process_message', side_effect=[RuntimeError('database is down'), None]) as process:
+            with self.assertRaises(RuntimeError):
+                handler.dispatch('msh/2/json/LongFast/!gateway1', self.payload)
+            handler.dispatch('msh/2/json/LongFast/!gateway2', self.payload)
+        self.assertEqual(process.call_count, 2)
+
+    def test_window_is_bounded(self):
+        """Test that the oldest keys fall out once the window is full or expired"""
+        for number in range(4):
+            self.recent.add((1, number, 'text'), '!gateway1')
+        self.assertFalse(self.recent.seen((1, 0, 'text'), '!gateway1'))
+        self.assertTrue(self.recent.seen((1, 3, 'text'), '!gateway1'))
+        with patch('time.monotonic', return_value=time.monotonic() + 61):
+            self.assertFalse(self.recent.seen((1, 3, 'text'), '!gateway1'))
+
+
+@override_settings(INGEST_CAMPUS_ROUTES={'msh/FMARS': 'FMARS', '!a1b2c3d4': 'Rover Camp'})
+@patch.dict(os.environ, {'MQTT_TOPIC': 'msh/MDRS', 'CAMPUS': 'MDRS'})
+class CampusRoutingTestCase(SimpleTestCase):
+    def setUp(self):
+        """Set up an empty dedup window so every dispatch is processed"""
+        patcher = patch.object(dedup, 'recent', dedup.RecentMessages(size=100, seconds=60))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def dispatch(self, topic, **fields):
+        message = create_test_mqtt_message(message_type='position', payload={})
+        message.update(fields)
+        with patch.object(handler, 'process_message') as process:
+            handler.dispatch(topic, json.dumps(message).encode())
+        return process.call_args.args[1]
+
+    def test_subscribes_every_topic_root(self):
+        """Test that routed topic roots are subscribed next to MQTT_TOPIC"""
+        self.assertEqual(handler.topic_roots(), ['msh/MDRS', 'msh/FMARS'])
+
+    def test_messages_routed_by_gateway_then_topic_root(self):
+        """Test that a mapped gateway wins, then the topic root, then CAMPUS"""
+        self.assertEqual(self.dispatch('msh/FMARS/2/json/LongFast/!00000001', id=1), 'FMARS')
+        self.assertEqual(self.dispatch('msh/MDRS/2/json/LongFast/!00000001', id=2), 'MDRS')
+        self.assertEqual(self.dispatch('msh/MDRS/2/json/LongFast/!a1b2c3d4', id=3), 'Rover Camp')
+        self.assertEqual(self.dispatch('msh/FMARS/2/json/LongFast/!00000002', id=4, sender='!a1b2c3d4'), 'Rover Camp')
+
+    def test_aircraft_on_routed_root(self):
+        """Test that aircraft under another campus' topic root carry that campus"""
+        with patch.object(handler, 'process_aircraft') as process:
+            handler.dispatch('msh/FMARS/aircraft/abc123', b'{"ID": "abc123"}')
+        process.assert_called_once_with('abc123', {'ID': 'abc123'}, 'FMARS')
+
+
+@override_settings(TRACK_MIN_DISTANCE_M=10, TRACK_MIN_INTERVAL_S=0, TRACK_MAX_INTERVAL_S=900, TRACK_MIN_TURN_DEG=30)
+class TrackFilterTestCase(SimpleTestCase):
+    def setUp(self):
+        """Set up an unsaved station; the filter only needs its id and configuration"""
+        track_filter.tracks.clear()
+        self.station = Station(id=1, configuration=None)
+        self.start = timezone.now()
+
+    def fix(self, north_m, east_m, seconds=0):
+        # metres from a point near 40N, 105W
+        return PositionLog(
+            latitude=40.0 + north_m / 111195,
+            longitude=-105.0 + east_m / (111195 * 0.7660),
+            timestamp=self.start + timedelta(seconds=seconds),
+        )
+
+    def kept(self, fixes):
+        return [row for fix in fixes for row in track_filter.keep(self.station, fix)]
+
+    def test_parked_tracker_stores_only_heartbeats(self):
+        """Test that jitter around one spot is dropped except every TRACK_MAX_INTERVAL_S"""
+        fixes = [self.fix((number % 3) - 1, (number % 2) * 2, seconds=number * 60) for number in range(31)]
+        self.assertEqual(self.kept(fixes), [fixes[0], fixes[15], fixes[30]])
+
+    def test_corner_is_kept(self):
+        """Test that a turn at a held-back fix stores that fix before the next one"""
+        fixes = [self.fix(0, 0), self.fix(8, 0, 10), self.fix(8, 8, 20)]
+        self.assertEqual(self.kept(fixes), [fixes[0], fixes[1]])
+
+    def test_straight_line_is_thinned(self):
+        """Test that fixes closer than the minimum distance on a straight line are dropped"""
+        fixes = [self.fix(north, 0, north) for north in range(0, 41, 4)]
+        self.assertEqual(self.kept(fixes), [fixes[0], fixes[3], fixes[6], fixes[9]])
+
+    def test_station_configuration_overrides(self):
+        """Test that Station.configuration["track_filter"] replaces the defaults"""
+        self.station.configuration = {'track_filter': {'min_distance_m': 0}}
+        fixes = [self.fix(0, 0), self.fix(1, 0, 10), self.fix(1, 1, 20)]
+        self.assertEqual(self.kept(fixes), fixes)
+
+    def test_malformed_configuration_uses_defaults(self):
+        """Test that a configuration that is not an object, or a non-object track_filter, falls back to the defaults"""
+        for configuration in (['track_filter'], 'track_filter', {'track_filter': 'off'}, {'track_filter': [1]}):
+            self.station.configuration = configuration
+            self.assertEqual(track_filter.options(self.station)['min_distance_m'], settings.TRACK_MIN_DISTANCE_M)
+
+
+@patch.dict(os.environ, {'MQTT_TOPIC': 'msh'})
+class MetricsTestCase(SimpleTestCase):
+    def setUp(self):
+        """Set up an empty registry and dedup window"""
+        for module, name, value in ((metrics, 'registry', metrics.Registry()),
+                                    (dedup, 'recent', dedup.RecentMessages(size=10, seconds=60))):
+            patcher = patch.object(module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.payload = json.dumps(create_test_mqtt_message(message_type='text', payload={'text': 'hi'})).encode()
+
+    def test_dispatch_counts_outcomes_per_type_and_gateway(self):
+        """Test that stored, duplicate, unknown-station and failed messages are counted and timed by type"""
+        with patch.object(handler, 'process_message', side_effect=[None, metrics.UNKNOWN_STATION, RuntimeError('down')]):
+            handler.dispatch('msh/2/json/LongFast/!gateway1', self.payload)
+            handler.dispatch('msh/2/json/LongFast/!gateway2', self.payload)
+            other = json.loads(self.payload)
+            other['id'] += 1
+            handler.dispatch('msh/2/json/LongFast/!gateway1', json.dumps(other).encode())
+            other['id'] += 1
+            with self.assertRaises(RuntimeError):
+                handler.dispatch('msh/2/json/LongFast/!gateway1', json.dumps(other).encode())
+
+        self.assertEqual(dict(metrics.registry.messages), {
+            ('text', '!gateway1', metrics.STORED): 1,
+            ('text', '!gateway2', metrics.DUPLICATE): 1,
+            ('text', '!gateway1', metrics.UNKNOWN_STATION): 1,
+            ('text', '!gateway1', metrics.ERROR): 1,
+        })
+        text = metrics.registry.render()
+        self.assertIn('evalink_ingest_messages_total{type="text",gateway="!gateway1",outcome="stored"} 1', text)
+        self.assertIn('evalink_ingest_seconds_count{type="text"} 4', text)
+        self.assertIn('evalink_ingest_queue_depth ', text)
+
+    def test_command_reads_served_metrics(self):
+        """Test that ingest_metrics summarizes what run_mqtt_ingest serves"""
+        metrics.registry.observe('position', '!gateway1', metrics.STORED, 0.002)
+        metrics.registry.observe('position', '!gateway1', metrics.INSIDE_FENCE, 0.004)
+        server = metrics.serve(0, host='127.0.0.1')
+        self.addCleanup(server.shutdown)
+        out = StringIO()
+        call_command('ingest_metrics', url=f'http://127.0.0.1:{server.server_port}/metrics', stdout=out)
+
+        row = next(line for line in out.getvalue().splitlines() if line.startswith('position'))
+        self.assertEqual(row.split()[:3], ['position', '2', '3.00'])
+
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_served_metrics_need_the_token(self):
+        """Test that the ingest process's metrics server refuses requests without METRICS_TOKEN"""
+        server = metrics.serve(0, token=settings.METRICS_TOKEN)
+        self.addCleanup(server.shutdown)
+        self.assertEqual(server.server_address[0], '127.0.0.1')
+        url = f'http://127.0.0.1:{server.server_port}/metrics'
+        with self.assertRaises(urllib.error.HTTPError) as refused:
+            urllib.request.urlopen(url, timeout=5)
+        self.assertEqual(refused.exception.code, 401)
+        with override_settings(METRICS_TOKEN='other'), self.assertRaises(CommandError):
+            call_command('ingest_metrics', url=url, stdout=StringIO())
+        out = StringIO()
+        call_command('ingest_metrics', url=url, raw=True, stdout=out)
+        self.assertIn('evalink_ingest_queue_depth', out.getvalue())
+
+class LiveFeedTestCase(SimpleTestCase):
+    def setUp(self):
+        """Set up a hub whose producer reads stamps from self.stamps"""
+        self.stamps = {'stations': (0, None), 'aircraft': None, 'texts': 1}
+        patcher = patch.object(live, 'read_stamps', side_effect=lambda: dict(self.stamps))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.hub = live.Hub(poll_ms=10, heartbeat_s=5)
+
+    def test_changed_channel_reaches_every_subscriber(self):
+        """Test that one stamp change is sent once to each open stream, named by channel"""
+        streams = [self.hub.stream() for _ in range(3)]
+        for stream in streams:
+            self.assertEqual(next(stream), 'retry: 5000\n\n')
+        time.sleep(0.05)
+        self.stamps['texts'] = 2
+        events = [next(stream) for stream in streams]
+        self.assertEqual(events, ['event: texts\ndata: {"sequence": 1}\n\n'] * 3)
+        for stream in streams:
+            stream.close()
+        self.assertEqual(self.hub.subscribers, 0)
+
+    def test_idle_stream_gets_heartbeat(self):
+        """Test that a stream with nothing to send yields a comment line after the heartbeat"""
+        self.hub.heartbeat = 0.05
+        stream = self.hub.stream()
+        next(stream)
+        self.assertEqual(next(stream), ': ping\n\n')
+        stream.close()
+
+    def test_async_stream_wakes_on_publish(self):
+        """Test that astream() subscribers are woken from the producer thread"""
+        async def first_event():
+            stream = self.hub.astream()
+            await stream.__anext__()
+            threading.Timer(0.05, self.hub.publish, args=[['aircraft']]).start()
+            event = await stream.__anext__()
+            await stream.aclose()
+            return event
+
+        self.assertEqual(asyncio.run(first_event()), 'event: aircraft\ndata: {"sequence": 1}\n\n')
+
+
+@override_settings(COMPRESS_MIN_BYTES=200)
+class ResponsesTestCase(SimpleTestCase):
+    def setUp(self):
+        """Set up a middleware around a view returning self.response"""
+        self.factory = RequestFactory()
+        self.middleware = responses.CompressionMiddleware(lambda request: self.response)
+        self.data = {'features': [{'id': index, 'name': f'Station {index}'} for index in range(50)]}
+
+    def get(self, query='', **headers):
+        request = self.factory.get(f'/features.json{query}', **headers)
+        self.response = responses.json_response(request, self.data)
+        self.response['ETag'] = '"v1"'
+        return self.middleware(request)
+
+    def test_json_is_compact_unless_pretty(self):
+        """Test that ?pretty=1 indents and the default has no whitespace"""
+        self.assertNotIn(b' ', self.get().content.replace(b'Station ', b''))
+        self.assertIn(b'\n  "features"', self.get('?pretty=1').content)
+
+    @patch.object(responses, 'brotli', None)
+    def test_large_body_gzipped_when_accepted(self):
+        """Test that gzip is negotiated, the ETag weakened and the encoding reused"""
+        plain = self.get().content
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['ETag'], 'W/"v1"')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), plain)
+        with patch.object(responses, 'compress') as compress:
+            self.get(HTTP_ACCEPT_ENCODING='gzip')
+            compress.assert_not_called()
+
+    def test_small_streaming_html_and_refused_bodies_pass_through(self):
+        """Test that small bodies, HTML pages, event streams and gzip;q=0 are not encoded"""
+        self.data = {'ok': True}
+        self.assertFalse(self.get(HTTP_ACCEPT_ENCODING='gzip').has_header('Content-Encoding'))
+        self.data = {'features': list(range(500))}
+        self.assertFalse(self.get(HTTP_ACCEPT_ENCODING='gzip;q=0').has_header('Content-Encoding'))
+        self.response = HttpResponse('<p>page</p>' * 500)
+        self.assertFalse(self.middleware(self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip')).has_header('Content-Encoding'))
+        self.response = StreamingHttpResponse(iter(['data: x\n\n'] * 500), content_type='text/event-stream')
+        streamed = self.middleware(self.factory.get('/live', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertFalse(streamed.has_header('Content-Encoding'))
+
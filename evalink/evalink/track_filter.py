@@ -0,0 +1,86 @@
+"""
+Ingest-time downsampling of mesh positions outside the inner geofence.
+
+A fix is stored once it is TRACK_MIN_DISTANCE_M from the last stored fix and
+TRACK_MIN_INTERVAL_S after it, or TRACK_MAX_INTERVAL_S has passed anyway.
+The latest fix in between is held back; if the track turns by
+TRACK_MIN_TURN_DEG or more at it, it is stored too, so corners survive the
+thinning. Station.configuration["track_filter"] overrides any of these per
+station with the keys min_distance_m, min_interval_s, max_interval_s and
+min_turn_deg; 0 switches a rule off.
+"""
+import math
+
+from django.conf import settings
+
+EARTH_RADIUS_M = 6371000
+OPTIONS = (
+    ('min_distance_m', 'TRACK_MIN_DISTANCE_M', 10),
+    ('min_interval_s', 'TRACK_MIN_INTERVAL_S', 0),
+    ('max_interval_s', 'TRACK_MAX_INTERVAL_S', 900),
+    ('min_turn_deg', 'TRACK_MIN_TURN_DEG', 30),
+)
+
+# station id -> (last stored PositionLog, held-back PositionLog or None)
+tracks = {}
+
+
+def options(station):
+    # configuration is free-form JSON; anything but an object falls back to the defaults
+    configuration = station.configuration if isinstance(station.configuration, dict) else {}
+    overrides = configuration.get('track_filter')
+    if not isinstance(overrides, dict):
+        overrides = {}
+    return {name: float(overrides.get(name, getattr(settings, setting, default))) for name, setting, default in OPTIONS}
+
+
+def keep(station, position, always=False):
+    """Return the PositionLog rows to store for this fix, oldest first: a held-back corner and/or the fix itself."""
+    stored, held = tracks.get(station.id, (None, None))
+    if always or stored is None:
+        tracks[station.id] = (position, None)
+        return [position]
+
+    limits = options(station)
+    rows = []
+    if held is not None and _is_corner(stored, held, position, limits):
+        rows.append(held)
+        stored = held
+    moved = distance(stored, position) >= limits['min_distance_m'] and _elapsed(stored, position) >= limits['min_interval_s']
+    stale = limits['max_interval_s'] > 0 and _elapsed(stored, position) >= limits['max_interval_s']
+    if moved or stale:
+        rows.append(position)
+        tracks[station.id] = (position, None)
+    else:
+        tracks[station.id] = (stored, position)
+    return rows
+
+
+def distance(a, b):
+    """Metres between two fixes (equirectangular; fine at track scale)."""
+    x = math.radians(b.longitude - a.longitude) * math.cos(math.radians((a.latitude + b.latitude) / 2))
+    y = math.radians(b.latitude - a.latitude)
+    return math.hypot(x, y) * EARTH_RADIUS_M
+
+
+def bearing(a, b):
+    x = math.radians(b.longitude - a.longitude) * math.cos(math.radians((a.latitude + b.latitude) / 2))
+    y = math.radians(b.latitude - a.latitude)
+    return math.degrees(math.atan2(x, y))
+
+
+def _is_corner(before, at, after, limits):
+    # both legs must be longer than GPS jitter, taken as half the minimum distance
+    if limits['min_turn_deg'] <= 0:
+        return False
+    leg = limits['min_distance_m'] / 2
+    if distance(before, at) < leg or distance(at, after) < leg:
+        return False
+    turn = abs(bearing(at, after) - bearing(before, at)) % 360
+    return min(turn, 360 - turn) >= limits['min_turn_deg']
+
+
+def _elapsed(a, b):
+    if a.timestamp is None or b.timestamp is None:
+        return 0
+    return (b.timestamp - a.timestamp).total_seconds()
@@ -24,6 +24,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path("accounts/", include("django.contrib.auth.urls")),
     path('features.json', views.features, name='features'),
+    path('live', views.live, name='live'),
     path('texts.json', views.texts, name='texts'),
     path('path.json', views.path, name='path'),
     path('point', views.point, name='point'),
@@ -39,5 +40,6 @@ urlpatterns = [
     path('aircraft.json', views.aircraft, name='aircraft'),
     path('aprs.json', views.aprs, name='aprs'),
     path('stalenode', views.stalenode, name='stalenode'),
+    path('metrics', views.metrics, name='metrics'),
     path('profile/campus', views.set_profile_campus, name='set_profile_campus'),
 ]
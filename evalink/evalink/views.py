@@ -1,11 +1,16 @@
-from django.http import JsonResponse, HttpResponseNotFound, HttpResponse
+from django.http import HttpResponseNotFound, HttpResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.conf import settings
 from evalink.models import *
 from datetime import date, timedelta, datetime
 from django.utils.dateparse import parse_date
 from django.shortcuts import render, redirect
-from django.db.models import Q
+from django.db.models import Q, Count, Max
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from dotenv import load_dotenv
 from .forms import ChatForm
 import paho.mqtt.client as mqtt
@@ -13,7 +18,13 @@ import pytz
 import os
 import json
 import zoneinfo
+import hashlib
 from . import handler
+from . import pipeline
+from . import metrics as ingest_metrics
+from . import features_cache
+from . import live as live_feed
+from .responses import json_response, pretty
 import math
 from collections import defaultdict
 import socket
@@ -68,9 +79,9 @@ def stalenode(request):
     try:
         delay_minutes = int(request.GET.get('delay', ''))
     except (ValueError, TypeError):
-        return JsonResponse({'error': 'delay parameter (integer minutes) required'}, status=400)
+        return json_response(request, {'error': 'delay parameter (integer minutes) required'}, status=400)
     if delay_minutes < 0:
-        return JsonResponse({'error': 'delay must be non-negative'}, status=400)
+        return json_response(request, {'error': 'delay must be non-negative'}, status=400)
     topic_root = (os.getenv('MQTT_TOPIC') or '').strip()
     mqtt_downlink_topic = f'{topic_root}/2/json/mqtt/' if topic_root else ''
     gateway_number = os.getenv('MQTT_NODE_NUMBER')
@@ -87,10 +98,10 @@ def stalenode(request):
     try:
         campus = Campus.objects.get(name=os.getenv('CAMPUS'))
     except Campus.DoesNotExist:
-        return JsonResponse(base)
+        return json_response(request, base)
     inner_fence = campus.inner_geofence
     if not inner_fence:
-        return JsonResponse(base)
+        return json_response(request, base)
     outer_fence = campus.outer_geofence
     cutoff = timezone.now() - timedelta(minutes=delay_minutes)
     six_hours_ago = timezone.now() - timedelta(hours=6)
@@ -118,9 +129,19 @@ def stalenode(request):
         }
         for s in stale
     ]
-    return JsonResponse(base)
+    return json_response(request, base)
 
 
+def metrics(request):
+    """Ingest metrics of this process in Prometheus text format, for staff users or the METRICS_TOKEN bearer."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorized = request.user.is_authenticated and request.user.is_staff
+    if token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        authorized = True
+    if not authorized:
+        return HttpResponseNotFound("not found")
+    return HttpResponse(ingest_metrics.registry.render(), content_type=ingest_metrics.CONTENT_TYPE)
+
 @login_required
 def index(request):
     """Render map with default campus from user profile or env; pass coords for initial map view."""
@@ -148,51 +169,97 @@ def index(request):
         'default_campus_id': default_campus_id,
         'default_latitude': default_latitude,
         'default_longitude': default_longitude,
+        'live_stream': getattr(settings, 'LIVE_STREAM', False),
     }
     return render(request, "map.html", context)
 
 
+@login_required
+def live(request):
+    """Server-Sent Events naming which of stations, aircraft and texts changed (live.py); off unless LIVE_STREAM."""
+    if not getattr(settings, 'LIVE_STREAM', False):
+        return HttpResponseNotFound("not found")
+    stream = live_feed.hub.astream() if isinstance(request, ASGIRequest) else live_feed.hub.stream()
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx would otherwise hold events back until its buffer fills
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @login_required
 def set_profile_campus(request):
     """Create or update the current user's profile and set campus to the given campus_id (POST, JSON body)."""
     if request.method != 'POST':
-        return JsonResponse({'error': 'POST required'}, status=405)
+        return json_response(request, {'error': 'POST required'}, status=405)
     try:
         body = json.loads(request.body)
         campus_id = body.get('campus_id')
     except (json.JSONDecodeError, TypeError):
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        return json_response(request, {'error': 'Invalid JSON'}, status=400)
     if campus_id is not None:
         try:
             campus_id = int(campus_id)
         except (ValueError, TypeError):
-            return JsonResponse({'error': 'campus_id must be an integer or null'}, status=400)
+            return json_response(request, {'error': 'campus_id must be an integer or null'}, status=400)
         try:
             Campus.objects.get(pk=campus_id)
         except Campus.DoesNotExist:
-            return JsonResponse({'error': 'Campus not found'}, status=404)
+            return json_response(request, {'error': 'Campus not found'}, status=404)
     profile, _ = UserProfile.objects.get_or_create(user=request.user)
     profile.campus_id = campus_id
     profile.save()
-    return JsonResponse({'ok': True, 'campus_id': profile.campus_id})
+    return json_response(request, {'ok': True, 'campus_id': profile.campus_id})
 
 
+def _etag(request, *parts):
+    """ETag for a polled endpoint from the cheap values its body depends on."""
+    return hashlib.md5(repr((pretty(request),) + parts).encode()).hexdigest()
+
+def _features_level(request):
+    return 'full-history' if request.user.groups.filter(name='full-history').exists() else 'recent'
+
+def features_etag(request):
+    campus_name = os.getenv('CAMPUS')
+    return _etag(request, 'features', campus_name, _features_level(request), request.GET.get('since'),
+                 features_cache.stamp(), features_cache.planner_position())
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=features_etag)
 def features(request):
-    campus = Campus.objects.get(name=os.getenv('CAMPUS'))
+    """
+    Campus stations as a FeatureCollection, built once per change and shared by all pollers (features_cache).
+    With ?since=<version> only the stations changed since that response come back, plus removed ids.
+    """
+    level = _features_level(request)
+    full_history = level == 'full-history'
+    campus_name = os.getenv('CAMPUS')
+    build = lambda: build_features(Campus.objects.get(name=campus_name), full_history)
+    since = request.GET.get('since')
+    if since:
+        content = features_cache.delta(campus_name, level, since, build)
+    else:
+        content = features_cache.get(campus_name, level, build)
+    if pretty(request):
+        content = json.dumps(json.loads(content), indent=2)
+    return HttpResponse(content, content_type='application/json')
+
+def build_features(campus, full_history):
     fence = campus.inner_geofence
+    tz = pytz.timezone(campus.time_zone)
+    timezone.now()
+    now = datetime.now(tz)
     data = {
         "type": "FeatureCollection",
         "features": [],
+        "now": now.isoformat(),
     }
-    tz = pytz.timezone(campus.time_zone)
-    timezone.now()
-    now = datetime.now(tz)
     # Create timezone-aware datetime for past date
     past_date = date.today() - timedelta(days = 30)
     past = datetime.combine(past_date, datetime.min.time())
     past = tz.localize(past)
-    if request.user.groups.filter(name='full-history').exists():
+    if full_history:
         top_stations = Station.objects.order_by('-updated_at').all()
     else:
         top_stations = Station.objects.filter(updated_at__gt = past).filter(~Q(station_type="ignore")).order_by('-updated_at').all()[:45]
@@ -201,6 +268,7 @@ def features(request):
             station.features['properties']['hardware_number'] = station.hardware_number
             station.features['properties']['hardware_node'] = station.hardware_node
             station.features['properties']['id'] = station.id
+            station.features['properties']['updated_at'] = station.updated_at.isoformat()
             station.features['properties']['days_old'] = (now - station.updated_at).days
             station.features['properties']['hours_old'] = (now - station.updated_at).total_seconds() / 3600.0
             
@@ -312,7 +380,7 @@ def features(request):
                         distance = 0
                     station.features['properties']['distance'] = distance
             data["features"].append(station.features)
-    return JsonResponse(data, json_dumps_params={'indent': 2})
+    return data
 
 def fully_populated(features):
     if not features: return False
@@ -323,11 +391,31 @@ def fully_populated(features):
     if features['geometry']['coordinates'] == [0, 0]: return False
     return True
 
+def texts_etag(request):
+    show_all = request.user.groups.filter(name='full-history').exists()
+    station_id = request.GET.get('station')
+    if station_id:
+        if not station_id.isdigit():
+            return None
+        rows = TextLog.objects.filter(station_id=station_id).aggregate(count=Count('id'), latest=Max('updated_at'))
+        return _etag(request, 'texts', show_all, station_id, rows['count'], rows['latest'])
+    # the message list is the five newest texts
+    return _etag(request, 'texts', show_all, *TextLog.objects.order_by('-updated_at').values_list('id', 'updated_at')[:5])
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=texts_etag)
 def texts(request):
-    text_messages = TextLog.objects.all().order_by('-updated_at')[:5:-1]
+    """Latest texts for the message list, or with ?station=<id> that station's full history oldest first."""
+    station_id = request.GET.get('station')
+    if station_id:
+        if not station_id.isdigit():
+            return json_response(request, {'error': 'station must be an integer id'}, status=400)
+        text_messages = TextLog.objects.filter(station_id=station_id).select_related('station', 'position_log').order_by('updated_at')
+    else:
+        text_messages = TextLog.objects.all().order_by('-updated_at')[:5:-1]
     show_all = request.user.groups.filter(name='full-history').exists()
-    return JsonResponse([text_message.serialize(show_all=show_all) for text_message in text_messages], safe=False, json_dumps_params={'indent': 2})
+    return json_response(request, [text_message.serialize(show_all=show_all) for text_message in text_messages], safe=False)
 
 @login_required
 def path(request):
@@ -494,7 +582,7 @@ def path(request):
     else:
         if before_date:
             result['date'] = before_date.isoformat()[0:10]
-    return JsonResponse(result, json_dumps_params={'indent': 2})
+    return json_response(request, result)
 
 def closest(time, samples):
     if samples == []: return None
@@ -520,34 +608,34 @@ def localdate(label, my_date, default):
     return my_aware_datetime
 
 def create_heard_messages(text, message_id, current_time):
-    """Create 'heard' TextLog entries for stations outside campus inner geofence but inside outer geofence"""
-    from django.db import IntegrityError
-    
+    """
+    Create 'heard' TextLog entries for stations outside campus inner geofence but inside outer geofence.
+    Returns (created, skipped); rows whose serial number is already stored are skipped.
+    """
     campus = Campus.objects.get(name=os.getenv('CAMPUS'))
     inner_fence = campus.inner_geofence
     outer_fence = campus.outer_geofence
     tz = pytz.timezone(campus.time_zone)
     
-    if inner_fence:
-        outside_stations = Station.objects.filter(
-            last_position__isnull=False
-        ).exclude(hardware_number=int(os.getenv('MQTT_NODE_NUMBER'))).exclude(station_type='infrastructure').exclude(station_type='ignore')  # Exclude the gateway station, infrastructure, and ignore stations
-
-        for outside_station in outside_stations:
-            if outside_station.outside(inner_fence) and (not outer_fence or not outside_station.outside(outer_fence)):
-                heard_text = f"heard: {text}"
-                heard_log = TextLog(
-                    station=outside_station,
-                    position_log=outside_station.last_position,
-                    serial_number=message_id + outside_station.id,  # Make unique by adding station id
-                    text=heard_text,
-                    updated_at=current_time,
-                    updated_on=current_time.astimezone(tz).date())
-                try:
-                    heard_log.save()
-                except IntegrityError:
-                    # Skip if duplicate serial number
-                    continue
+    if not inner_fence:
+        return 0, 0
+    outside_stations = Station.objects.filter(
+        last_position__isnull=False
+    ).select_related('last_position').exclude(hardware_number=int(os.getenv('MQTT_NODE_NUMBER'))).exclude(station_type='infrastructure').exclude(station_type='ignore')  # Exclude the gateway station, infrastructure, and ignore stations
+
+    heard_logs = [
+        TextLog(
+            station=outside_station,
+            position_log=outside_station.last_position,
+            serial_number=message_id + outside_station.id,  # Make unique by adding station id
+            text=f"heard: {text}",
+            updated_at=current_time,
+            updated_on=current_time.astimezone(tz).date())
+        for outside_station in outside_stations
+        if outside_station.outside(inner_fence) and (not outer_fence or not outside_station.outside(outer_fence))
+    ]
+    created = pipeline.insert_ignore(TextLog, heard_logs)
+    return created, len(heard_logs) - created
 
 @login_required
 def chat(request):
@@ -572,7 +660,7 @@ def chat(request):
         message_id = int(current_time.timestamp() * 1000000)  # Generate unique message ID
         create_heard_messages(message, message_id, current_time)
         
-        return JsonResponse({"sent": "ok"}, json_dumps_params={'indent': 2})
+        return json_response(request, {"sent": "ok"})
 
     if request.method == "POST":
         form = ChatForm(request.POST)
@@ -670,7 +758,7 @@ def point(request):
     station.last_position = position_log
     station.updated_at = time
     station.save()
-    return JsonResponse({"stored": "ok"}, json_dumps_params={'indent': 2})
+    return json_response(request, {"stored": "ok"})
 
 @login_required
 def inventory(request):
@@ -689,9 +777,15 @@ def inventory(request):
                       'updated': station.updated_at,
                       'coordinates': coordinates,
                       'battery': station.features.get('properties', {}).get('battery_level', None)})
-    return JsonResponse({'items': items}, json_dumps_params={'indent': 2})
+    return json_response(request, {'items': items})
+
+def campuses_etag(request):
+    rows = Campus.objects.aggregate(count=Count('id'), latest=Max('updated_at'))
+    return _etag(request, 'campuses', rows['count'], rows['latest'])
 
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=campuses_etag)
 def campuses(request):
     """API endpoint to list all campuses with id, name, latitude, longitude, and elevation"""
     campuses = Campus.objects.all().order_by('name')
@@ -706,7 +800,7 @@ def campuses(request):
             'elevation': campus.altitude
         })
     
-    return JsonResponse({'campuses': campus_data}, json_dumps_params={'indent': 2})
+    return json_response(request, {'campuses': campus_data})
 
 @login_required
 def add_location_to_plan(request):
@@ -736,7 +830,7 @@ def add_location_to_plan(request):
         # Find the planning station
         planner_station = Station.objects.filter(station_type='planner').first()
         if not planner_station:
-            return JsonResponse({"error": "Planning station not found"}, status=404)
+            return json_response(request, {"error": "Planning station not found"}, status=404)
         
         # Create PositionLog for the target time
         position_log = PositionLog(
@@ -771,17 +865,17 @@ def add_location_to_plan(request):
         # Create redirect URL with planner name, ID, and before_date
         redirect_url = f"/?name={planner_station.name}&id={planner_station.id}&before_date={next_day.strftime('%Y-%m-%d')}"
         
-        return JsonResponse({
+        return json_response(request, {
             "success": True,
             "message": "Location added to plan successfully",
             "position_log_id": position_log.id,
             "text_log_id": text_log.id,
             "target_datetime": target_datetime.isoformat(),
             "redirect_url": redirect_url
-        }, json_dumps_params={'indent': 2})
+        })
         
     except Exception as e:
-        return JsonResponse({
+        return json_response(request, {
             "error": f"Failed to add location to plan: {str(e)}"
         }, status=500)
 
@@ -796,16 +890,16 @@ def delete_planner_point(request):
         position_log_id = json_content.get('position_log_id')
         
         if not position_log_id:
-            return JsonResponse({"error": "position_log_id is required"}, status=400)
+            return json_response(request, {"error": "position_log_id is required"}, status=400)
         
         # Find the position log
         position_log = PositionLog.objects.filter(id=position_log_id).first()
         if not position_log:
-            return JsonResponse({"error": "Position log not found"}, status=404)
+            return json_response(request, {"error": "Position log not found"}, status=404)
         
         # Verify it's from a planner station
         if position_log.station.station_type != 'planner':
-            return JsonResponse({"error": "Only planner points can be deleted"}, status=400)
+            return json_response(request, {"error": "Only planner points can be deleted"}, status=400)
         
         # Find the associated text log
         text_log = TextLog.objects.filter(position_log=position_log).first()
@@ -829,14 +923,14 @@ def delete_planner_point(request):
         # Create redirect URL with planner name, ID, and before_date
         redirect_url = f"/?name={planner_station.name}&id={planner_station.id}&before_date={next_day.strftime('%Y-%m-%d')}"
         
-        return JsonResponse({
+        return json_response(request, {
             "success": True,
             "message": "Planner point deleted successfully",
             "redirect_url": redirect_url
-        }, json_dumps_params={'indent': 2})
+        })
         
     except Exception as e:
-        return JsonResponse({
+        return json_response(request, {
             "error": f"Failed to delete planner point: {str(e)}"
         }, status=500)
 
@@ -977,7 +1071,7 @@ def search(request):
             url = f'/?history=1&name={station.name}&after_date={after_date}'
             name = f'{station.name} on {date}'
             paths.append({'name': name, 'url': url})
-    return JsonResponse({'items': paths}, json_dumps_params={'indent': 2})
+    return json_response(request, {'items': paths})
 
 def haversine_distance(lat1, lon1, lat2, lon2):
     """Calculate the great circle distance between two points on Earth in kilometers."""
@@ -994,10 +1088,20 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     r = 6371
     return c * r
 
+AIRCRAFT_WINDOW = timedelta(minutes=15)
+
+def aircraft_etag(request):
+    # positions leaving the window change the count, so aircraft drop off without new writes too
+    rows = AircraftPositionLog.objects.filter(updated_at__gte=timezone.now() - AIRCRAFT_WINDOW).aggregate(
+        count=Count('id'), latest=Max('updated_at'))
+    return _etag(request, 'aircraft', rows['count'], rows['latest'])
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=aircraft_etag)
 def aircraft(request):
     """Return aircraft with latest positions from the last 15 minutes."""
-    cutoff_time = timezone.now() - timedelta(minutes=15)
+    cutoff_time = timezone.now() - AIRCRAFT_WINDOW
 
     # Latest position per aircraft within the freshness window.
     recent_positions = (
@@ -1047,39 +1151,58 @@ def aircraft(request):
 
         aircraft_data.append(aircraft_obj)
 
-    return JsonResponse({
+    return json_response(request, {
         'now': int(timezone.now().timestamp()),
         'aircraft': aircraft_data
-    }, json_dumps_params={'indent': 2})
+    })
 
 
+def _aprs_bounds(outer_fence):
+    """(lat_s, lat_n, lon_w, lon_e) of a geofence."""
+    return (min(outer_fence.latitude1, outer_fence.latitude2), max(outer_fence.latitude1, outer_fence.latitude2),
+            min(outer_fence.longitude1, outer_fence.longitude2), max(outer_fence.longitude1, outer_fence.longitude2))
+
+def _aprs_cached(outer_fence):
+    """APRSPosition rows from run_aprs_feed inside the fence and younger than APRS_CACHE_MAX_AGE_MINUTES."""
+    lat_s, lat_n, lon_w, lon_e = _aprs_bounds(outer_fence)
+    max_age_minutes = max(1, min(1440, int(os.getenv('APRS_CACHE_MAX_AGE_MINUTES', '30'))))
+    cutoff = timezone.now() - timedelta(minutes=max_age_minutes)
+    return APRSPosition.objects.filter(
+        latitude__gte=lat_s,
+        latitude__lte=lat_n,
+        longitude__gte=lon_w,
+        longitude__lte=lon_e,
+        updated_at__gte=cutoff,
+    )
+
+def aprs_etag(request):
+    # ?live=1 collects from APRS-IS on every call; there is nothing to compare
+    if request.GET.get('live') == '1':
+        return None
+    campus = Campus.objects.select_related('outer_geofence').get(name=os.getenv('CAMPUS'))
+    if not campus.outer_geofence:
+        return _etag(request, 'aprs', campus.id)
+    rows = _aprs_cached(campus.outer_geofence).aggregate(count=Count('id'), latest=Max('updated_at'))
+    return _etag(request, 'aprs', campus.id, _aprs_bounds(campus.outer_geofence), rows['count'], rows['latest'])
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=aprs_etag)
 def aprs(request):
     """Return APRS stations in the campus outer geofence. Serves from cache (run_aprs_feed); use ?live=1 for a one-off 12s live collection."""
     campus = Campus.objects.get(name=os.getenv('CAMPUS'))
     outer_fence = campus.outer_geofence
     if not outer_fence:
-        return JsonResponse({
+        return json_response(request, {
             'type': 'FeatureCollection',
             'features': [],
             'error': 'No outer geofence configured for this campus',
-        }, json_dumps_params={'indent': 2})
+        })
 
-    lat_n = max(outer_fence.latitude1, outer_fence.latitude2)
-    lat_s = min(outer_fence.latitude1, outer_fence.latitude2)
-    lon_w = min(outer_fence.longitude1, outer_fence.longitude2)
-    lon_e = max(outer_fence.longitude1, outer_fence.longitude2)
+    lat_s, lat_n, lon_w, lon_e = _aprs_bounds(outer_fence)
 
     if request.GET.get('live') != '1':
-        max_age_minutes = max(1, min(1440, int(os.getenv('APRS_CACHE_MAX_AGE_MINUTES', '30'))))
-        cutoff = timezone.now() - timedelta(minutes=max_age_minutes)
-        cached = APRSPosition.objects.filter(
-            latitude__gte=lat_s,
-            latitude__lte=lat_n,
-            longitude__gte=lon_w,
-            longitude__lte=lon_e,
-            updated_at__gte=cutoff,
-        )
+        cached = _aprs_cached(outer_fence)
         features = []
         for pos in cached:
             features.append({
@@ -1097,7 +1220,7 @@ def aprs(request):
                     'speed': pos.speed,
                 },
             })
-        return JsonResponse({
+        return json_response(request, {
             'type': 'FeatureCollection',
             'features': features,
             'meta': {
@@ -1105,7 +1228,7 @@ def aprs(request):
                 'features_in_geofence': len(features),
                 'geofence': {'lat_s': lat_s, 'lat_n': lat_n, 'lon_w': lon_w, 'lon_e': lon_e},
             },
-        }, json_dumps_params={'indent': 2})
+        })
 
     callsign = os.getenv('APRS_CALLSIGN', 'N0CALL')
     passwd = os.getenv('APRS_PASSCODE', '-1')
@@ -1118,11 +1241,11 @@ def aprs(request):
     collect_seconds = max(5, min(30, int(os.getenv('APRS_COLLECT_SECONDS', '12'))))
 
     if passwd == '-1' and port == 14580:
-        return JsonResponse({
+        return json_response(request, {
             'type': 'FeatureCollection',
             'features': [],
             'error': 'Port 14580 requires a verified passcode. Set APRS_PASSCODE to a valid passcode for your callsign (e.g. from aprslib.passcode("CALLSIGN")), or leave APRS_IS_PORT unset to use port 10152 with receive-only.',
-        }, json_dumps_params={'indent': 2})
+        })
 
     area_filter = 'a/%s/%s/%s/%s t/po' % (lat_n, lon_w, lat_s, lon_e) if port == 14580 else ''
 
@@ -1137,11 +1260,11 @@ def aprs(request):
         err = str(e)
         if 'login' in err.lower() and port == 14580:
             err = '%s Port 14580 requires a verified passcode; use APRS_PASSCODE or leave APRS_IS_PORT unset to use 10152.' % err
-        return JsonResponse({
+        return json_response(request, {
             'type': 'FeatureCollection',
             'features': [],
             'error': 'APRS-IS connection failed: %s' % err,
-        }, json_dumps_params={'indent': 2})
+        })
 
     def collect_from_socket():
         deadline = time.time() + collect_seconds
@@ -1235,7 +1358,7 @@ def aprs(request):
         }
         features.append(feat)
 
-    return JsonResponse({
+    return json_response(request, {
         'type': 'FeatureCollection',
         'features': features,
         'meta': {
@@ -1244,7 +1367,7 @@ def aprs(request):
             'features_in_geofence': len(features),
             'geofence': {'lat_s': lat_s, 'lat_n': lat_n, 'lon_w': lon_w, 'lon_e': lon_e},
         },
-    }, json_dumps_params={'indent': 2})
+    })
 
 
 @login_required